@@ -0,0 +1,121 @@
+"""
+Background-removal throughput benchmark: one pool job per request vs. the
+micro-batched path.
+
+Usage (from the backend directory, downloads the rembg model on first run):
+    python benchmarks/bench_bg_removal.py --requests 64 --concurrency 8
+    python benchmarks/bench_bg_removal.py --images ~/photos --batch-size 4 --max-wait-ms 15
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+import main
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def load_images(args):
+    if args.images:
+        paths = sorted(
+            os.path.join(args.images, name)
+            for name in os.listdir(args.images)
+            if name.lower().endswith((".jpg", ".jpeg", ".png", ".webp", ".heic"))
+        )
+        images = []
+        for path in paths:
+            with open(path, "rb") as f:
+                images.append(f.read())
+        return images
+
+    # Synthetic photos: noise so PNG/JPEG sizes look like real uploads
+    images = []
+    for index in range(4):
+        img = Image.effect_noise((args.width, args.height), 40 + index * 10).convert("RGB")
+        buffer = io.BytesIO()
+        img.save(buffer, "JPEG", quality=90)
+        images.append(buffer.getvalue())
+    return images
+
+
+async def drive(submit, images, total, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(index):
+        async with semaphore:
+            started = time.perf_counter()
+            await submit(images[index % len(images)])
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(total)])
+    elapsed = time.perf_counter() - started
+    return {
+        "throughput_rps": round(total / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+    }
+
+
+async def run(args):
+    images = load_images(args)
+    pool = main.ImageWorkPool(max_workers=args.workers, queue_depth=args.requests)
+
+    # Warm every worker so model loading is not part of the measurement
+    await asyncio.gather(
+        *[pool.run(main._bg_removal_job, images[0]) for _ in range(args.workers)]
+    )
+
+    sequential = await drive(
+        lambda data: pool.run(main._bg_removal_job, data),
+        images,
+        args.requests,
+        args.concurrency,
+    )
+
+    batcher = main.MicroBatcher(
+        lambda batch: pool.run(main._bg_removal_batch_job, batch),
+        max_batch_size=args.batch_size,
+        max_wait=args.max_wait_ms / 1000,
+    )
+    batched = await drive(
+        lambda data: batcher.submit((data, None)), images, args.requests, args.concurrency
+    )
+    pool.shutdown()
+
+    print(f"model={main.REMBG_MODEL} workers={args.workers} concurrency={args.concurrency}")
+    print(f"{'path':<28}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, result in [
+        ("one-at-a-time", sequential),
+        (f"batched (size={args.batch_size})", batched),
+    ]:
+        print(
+            f"{name:<28}{result['throughput_rps']:>10}{result['p50_ms']:>10}{result['p99_ms']:>10}"
+        )
+    print(f"batcher: {batcher.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--images", help="Directory of sample uploads")
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--max-wait-ms", type=float, default=10)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,107 @@
+"""
+Output encoding benchmark: bytes and encode time for each output option on a
+background-removal style cutout and on a generated photo.
+
+Usage (from the backend directory):
+    python benchmarks/bench_output_encoding.py
+    python benchmarks/bench_output_encoding.py --image cutout.png --image photo.jpg --runs 10
+
+Without --image, a synthetic RGBA cutout (subject on a transparent canvas)
+and a noisy RGB "photo" are generated. Timings include the watermark, as the
+endpoints do.
+"""
+
+import argparse
+import io
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw, ImageFilter
+
+import main
+
+VARIANTS = [
+    ("png level 1", dict(compress_level=1)),
+    ("png level 3", dict(compress_level=3)),
+    ("png level 6", dict(compress_level=6)),
+    ("png level 9", dict(compress_level=9)),
+    ("png crop", dict(crop=True)),
+    ("png crop + quantize", dict(crop=True, quantize="best")),
+    ("webp", dict(format="WEBP")),
+    ("webp crop", dict(format="WEBP", crop=True)),
+    ("jpeg", dict(format="JPEG")),
+]
+
+
+def synthetic_cutout(size: int = 1024) -> Image.Image:
+    """A soft-edged subject covering roughly a third of a transparent canvas"""
+    rng = random.Random(0)
+    photo = synthetic_photo(size)
+    mask = Image.new("L", (size, size), 0)
+    draw = ImageDraw.Draw(mask)
+    draw.ellipse((size * 0.3, size * 0.15, size * 0.7, size * 0.95), fill=255)
+    for _ in range(12):
+        x, y = rng.uniform(0.3, 0.7) * size, rng.uniform(0.15, 0.9) * size
+        draw.ellipse((x - 40, y - 40, x + 40, y + 40), fill=255)
+    # Composited onto transparent black, as rembg's naive_cutout does
+    empty = Image.new("RGBA", (size, size), 0)
+    return Image.composite(photo.convert("RGBA"), empty, mask.filter(ImageFilter.GaussianBlur(3)))
+
+
+def synthetic_photo(size: int = 1024) -> Image.Image:
+    """Smooth gradients with sensor-like noise, closer to a generated image than flat colour"""
+    gradient = Image.linear_gradient("L").resize((size, size))
+    base = Image.merge("RGB", (gradient, gradient.rotate(90), gradient.rotate(180)))
+    noise = Image.effect_noise((size, size), 24).convert("RGB")
+    return Image.blend(base, noise, 0.25)
+
+
+def measure(img: Image.Image, options: main.OutputOptions, runs: int):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        data = main.finish_image(img.copy(), options)
+        timings.append(time.perf_counter() - started)
+    return len(data), statistics.median(timings) * 1000
+
+
+def load_images(args):
+    if args.image:
+        images = []
+        for path in args.image:
+            img = Image.open(path)
+            img.load()
+            images.append((os.path.basename(path), img))
+        return images
+    return [("cutout (RGBA)", synthetic_cutout(args.size)), ("photo (RGB)", synthetic_photo(args.size))]
+
+
+def run(args):
+    print(
+        f"defaults: png compress_level={main.OUTPUT_PNG_COMPRESS_LEVEL} "
+        f"webp quality={main.OUTPUT_WEBP_QUALITY} method={main.OUTPUT_WEBP_METHOD} "
+        f"jpeg quality={main.OUTPUT_JPEG_QUALITY} runs={args.runs}"
+    )
+    for name, img in load_images(args):
+        print(f"\n{name} {img.size[0]}x{img.size[1]}")
+        print(f"{'variant':<22}{'KiB':>10}{'vs png 6':>10}{'ms':>10}")
+        results = [
+            (label, *measure(img, main.OutputOptions(**params), args.runs))
+            for label, params in VARIANTS
+        ]
+        baseline = dict((label, size) for label, size, _ in results)["png level 6"]
+        for label, size, ms in results:
+            print(f"{label:<22}{size / 1024:>10.1f}{size / baseline:>10.2f}{ms:>10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--image", action="append", help="Benchmark this image (repeatable)")
+    parser.add_argument("--size", type=int, default=1024, help="Synthetic image edge in pixels")
+    parser.add_argument("--runs", type=int, default=5)
+    run(parser.parse_args())
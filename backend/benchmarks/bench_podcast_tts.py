@@ -0,0 +1,116 @@
+"""
+Podcast TTS latency benchmark: one TTS call for the whole script vs. the
+segmented path that synthesizes speaker turns concurrently.
+
+Usage (from the backend directory):
+    GOOGLE_API_KEY=... python benchmarks/bench_podcast_tts.py --runs 3
+    python benchmarks/bench_podcast_tts.py --simulate --runs 5
+    python benchmarks/bench_podcast_tts.py --script-file my_script.txt --parallelism 6
+
+--simulate swaps Gemini for a stand-in whose latency grows linearly with the
+text length (--sim-base-s + --sim-per-char-ms), which is how the TTS model
+behaves; use a live key for real numbers.
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import types as pytypes
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+LINES = [
+    ("Emily", "Welcome back to the show! Today we are digging into something that has been all over the news this week."),
+    ("Mark", "Right, and I have to admit I am not fully convinced it is as big a deal as everyone says."),
+    ("Emily", "That is fair, but the numbers are pretty striking once you look at how quickly adoption has grown."),
+    ("Mark", "Okay, so walk me through it. What actually changed, and why should anyone listening care?"),
+    ("Emily", "Three things changed at once: the cost dropped, the tooling got easier, and big players signed on."),
+    ("Mark", "Cheaper and easier I get. But every hype cycle has big players signing on, doesn't it?"),
+]
+
+
+def build_script(words: int) -> str:
+    turns = []
+    count = 0
+    while count < words:
+        speaker, line = LINES[len(turns) % len(LINES)]
+        turns.append(f"{speaker}: {line}")
+        count += len(line.split())
+    return "\n".join(turns)
+
+
+def install_simulated_gemini(base_s: float, per_char_ms: float):
+    async def generate_content(model, contents, config=None):
+        spoken = len(contents) - len(main._podcast_audio_prompt(""))
+        await asyncio.sleep(base_s + spoken * per_char_ms / 1000)
+        # About 15 characters of speech per second of 24 kHz 16-bit audio
+        pcm = b"\x00\x00" * int(spoken / 15 * main.PODCAST_SAMPLE_RATE)
+        part = pytypes.SimpleNamespace(
+            inline_data=pytypes.SimpleNamespace(data=pcm, mime_type="audio/L16;rate=24000"),
+            text=None,
+        )
+        return pytypes.SimpleNamespace(parts=[part], text=None)
+
+    models = pytypes.SimpleNamespace(generate_content=generate_content)
+    main._genai_client = pytypes.SimpleNamespace(aio=pytypes.SimpleNamespace(models=models))
+
+
+async def measure(script: str, mode: str, runs: int):
+    latencies = []
+    audio_seconds = 0
+    for _ in range(runs):
+        started = time.perf_counter()
+        pcm = await main.synthesize_podcast(script, mode)
+        latencies.append(time.perf_counter() - started)
+        audio_seconds = len(pcm) / (main.PODCAST_SAMPLE_RATE * main.PODCAST_SAMPLE_WIDTH)
+    return {
+        "median_s": round(statistics.median(latencies), 2),
+        "min_s": round(min(latencies), 2),
+        "audio_s": round(audio_seconds, 1),
+    }
+
+
+async def run(args):
+    if args.simulate:
+        install_simulated_gemini(args.sim_base_s, args.sim_per_char_ms)
+
+    main.PODCAST_TTS_SEGMENT_CHARS = args.segment_chars
+    main.PODCAST_TTS_PARALLELISM = args.parallelism
+
+    if args.script_file:
+        with open(args.script_file, encoding="utf-8") as f:
+            scripts = [(os.path.basename(args.script_file), f.read())]
+    else:
+        scripts = [(f"{words} words", build_script(words)) for words in args.words]
+
+    print(
+        f"segment_chars={args.segment_chars} parallelism={args.parallelism} "
+        f"runs={args.runs} {'(simulated)' if args.simulate else ''}"
+    )
+    print(f"{'script':<14}{'segments':>10}{'mode':>12}{'median s':>10}{'min s':>8}{'audio s':>9}")
+    for name, script in scripts:
+        segments = len(main.podcast_segments(script, args.segment_chars))
+        for mode in ("single", "segmented"):
+            result = await measure(script, mode, args.runs)
+            print(
+                f"{name:<14}{segments:>10}{mode:>12}"
+                f"{result['median_s']:>10}{result['min_s']:>8}{result['audio_s']:>9}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--words", type=int, nargs="+", default=[200, 300, 800, 1500])
+    parser.add_argument("--script-file", help="Use this script instead of generated ones")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--segment-chars", type=int, default=main.PODCAST_TTS_SEGMENT_CHARS)
+    parser.add_argument("--parallelism", type=int, default=main.PODCAST_TTS_PARALLELISM)
+    parser.add_argument("--simulate", action="store_true")
+    parser.add_argument("--sim-base-s", type=float, default=1.5)
+    parser.add_argument("--sim-per-char-ms", type=float, default=6)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,89 @@
+"""
+Watermark microbenchmark: per-request font loading and text rasterisation
+(the previous add_watermark) vs. the cached pre-rendered overlay tiles.
+
+Usage (from the backend directory):
+    python benchmarks/bench_watermark.py --iterations 200
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw, ImageFont
+
+import main
+
+# Typical outputs: Gemini 1:1 / 2:3 / 3:4, hairstyle grid, phone cutouts
+SIZES = [(1024, 1024), (832, 1248), (896, 1152), (2048, 2048), (3024, 4032)]
+
+
+def legacy_add_watermark(img, text="toolkitai.io"):
+    """add_watermark as it was before the overlay cache"""
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGB")
+
+    draw = ImageDraw.Draw(img)
+    width, height = img.size
+    font_size = max(12, int(width * 0.02))
+
+    try:
+        font = ImageFont.truetype(
+            "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", font_size
+        )
+    except OSError:
+        try:
+            font = ImageFont.truetype(
+                "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf",
+                font_size,
+            )
+        except OSError:
+            font = ImageFont.load_default()
+
+    bbox = draw.textbbox((0, 0), text, font=font)
+    text_width = bbox[2] - bbox[0]
+    text_height = bbox[3] - bbox[1]
+    padding = max(10, int(width * 0.01))
+    x = width - text_width - padding
+    y = height - text_height - padding
+    draw.rectangle(
+        [x - 5, y - 5, x + text_width + 5, y + text_height + 5], fill=(0, 0, 0)
+    )
+    draw.text((x, y), text, fill=(255, 255, 255), font=font)
+    return img
+
+
+def measure(fn, img, iterations):
+    timings = []
+    for _ in range(iterations):
+        # Drawing mutates the image, so every run gets a fresh copy; the copy
+        # is excluded from the timing
+        target = img.copy()
+        started = time.perf_counter()
+        fn(target)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.mean(timings), statistics.median(timings)
+
+
+def run(args):
+    print(f"font: {main.WATERMARK_FONT_PATH or 'PIL default'}")
+    print(f"{'size':<12}{'mode':<6}{'before ms':>12}{'after ms':>12}{'speedup':>10}")
+    for width, height in SIZES:
+        for mode in ("RGB", "RGBA"):
+            img = Image.new(mode, (width, height), (90, 120, 150, 255)[: len(mode)])
+            before, _ = measure(legacy_add_watermark, img, args.iterations)
+            after, _ = measure(main.add_watermark, img, args.iterations)
+            print(
+                f"{f'{width}x{height}':<12}{mode:<6}{before:>12.3f}{after:>12.3f}{before / after:>9.1f}x"
+            )
+    print(f"overlay cache: {main._watermark_overlay.cache_info()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=100)
+    run(parser.parse_args())
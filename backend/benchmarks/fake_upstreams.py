@@ -0,0 +1,292 @@
+"""
+Local stand-ins for the Gemini and Replicate APIs (and an image origin for
+/api/proxy-image), so the backend can be load tested without API credits.
+
+Usage (from the backend directory):
+    python benchmarks/fake_upstreams.py --port 9100 --latency-scale 0.1
+    python benchmarks/fake_upstreams.py --rate-limit-rate 0.3 --error-rate 0.02
+
+Point the backend at it with GEMINI_BASE_URL=http://127.0.0.1:9100 and
+REPLICATE_BASE_URL=http://127.0.0.1:9100 (any API keys will do).
+benchmarks/load_test.py starts both for you.
+
+Latency per call is the model kind's base latency (--image-latency etc.)
+times --latency-scale, varied by +/- --jitter. --rate-limit-rate of the calls
+to --rate-limit-models get a 429 and --error-rate of all calls get a 500.
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from PIL import Image
+
+SCRIPT = "\n".join(
+    [
+        "Emily: Welcome back to the show! Today we are digging into something that has been all over the news.",
+        "Mark: Right, and I have to admit I am not fully convinced it is as big a deal as everyone says.",
+        "Emily: That is fair, but the numbers are pretty striking once you look at how quickly adoption grew.",
+        "Mark: Okay, so walk me through it. What actually changed, and why should anyone listening care?",
+    ]
+)
+
+# Seconds of 24 kHz speech per character of script
+TTS_SECONDS_PER_CHAR = 1 / 15
+TTS_SAMPLE_RATE = 24000
+
+
+def settings_from_env() -> dict:
+    return {
+        "latency": {
+            "image": float(os.getenv("FAKE_IMAGE_LATENCY", "12")),
+            "text": float(os.getenv("FAKE_TEXT_LATENCY", "3")),
+            "tts": float(os.getenv("FAKE_TTS_LATENCY", "8")),
+            "replicate": float(os.getenv("FAKE_REPLICATE_LATENCY", "5")),
+            "origin": float(os.getenv("FAKE_ORIGIN_LATENCY", "0.05")),
+        },
+        "latency_scale": float(os.getenv("FAKE_LATENCY_SCALE", "1")),
+        "jitter": float(os.getenv("FAKE_JITTER", "0.2")),
+        "error_rate": float(os.getenv("FAKE_ERROR_RATE", "0")),
+        "rate_limit_rate": float(os.getenv("FAKE_RATE_LIMIT_RATE", "0")),
+        "rate_limit_models": set(
+            os.getenv("FAKE_RATE_LIMIT_MODELS", "gemini-3-pro-image-preview").split(",")
+        ),
+        "image_size": int(os.getenv("FAKE_IMAGE_SIZE", "1024")),
+    }
+
+
+def noisy_image(size: int, image_format: str) -> bytes:
+    """Gradient plus noise, so encoded sizes resemble generated images"""
+    gradient = Image.linear_gradient("L").resize((size, size))
+    base = Image.merge("RGB", (gradient, gradient.rotate(90), gradient.rotate(180)))
+    noise = Image.effect_noise((size, size), 24).convert("RGB")
+    buffer = io.BytesIO()
+    Image.blend(base, noise, 0.2).save(buffer, image_format)
+    return buffer.getvalue()
+
+
+def create_app(settings: dict) -> FastAPI:
+    app = FastAPI(title="Fake upstreams")
+    image_png = noisy_image(settings["image_size"], "PNG")
+    image_b64 = base64.b64encode(image_png).decode()
+    origin_jpeg = noisy_image(2048, "JPEG")
+    counters = {"calls": 0, "rate_limited": 0, "errors": 0}
+
+    async def simulate(kind: str, model: str = None):
+        """
+        Sleep for the call's latency; returns an error response to send
+        instead of a result, or None
+        """
+        counters["calls"] += 1
+        base = settings["latency"][kind] * settings["latency_scale"]
+        await asyncio.sleep(base * random.uniform(1 - settings["jitter"], 1 + settings["jitter"]))
+
+        if model in settings["rate_limit_models"] and random.random() < settings["rate_limit_rate"]:
+            counters["rate_limited"] += 1
+            return JSONResponse(
+                {"error": {"code": 429, "message": "Resource exhausted", "status": "RESOURCE_EXHAUSTED"}},
+                status_code=429,
+            )
+        if random.random() < settings["error_rate"]:
+            counters["errors"] += 1
+            return JSONResponse(
+                {"error": {"code": 500, "message": "Internal error", "status": "INTERNAL"}},
+                status_code=500,
+            )
+        return None
+
+    def gemini_response(model: str, body: dict) -> dict:
+        config = body.get("generationConfig", {})
+        if "AUDIO" in config.get("responseModalities", []):
+            text = " ".join(
+                part.get("text", "")
+                for content in body.get("contents", [])
+                for part in content.get("parts", [])
+            )
+            samples = int(len(text) * TTS_SECONDS_PER_CHAR * TTS_SAMPLE_RATE)
+            part = {
+                "inlineData": {
+                    "mimeType": f"audio/L16;codec=pcm;rate={TTS_SAMPLE_RATE}",
+                    "data": base64.b64encode(b"\x00\x01" * samples).decode(),
+                }
+            }
+        elif "IMAGE" in config.get("responseModalities", []) or "image" in model:
+            part = {"inlineData": {"mimeType": "image/png", "data": image_b64}}
+        else:
+            part = {"text": SCRIPT}
+        return {
+            "candidates": [
+                {"content": {"role": "model", "parts": [part]}, "finishReason": "STOP", "index": 0}
+            ],
+            "modelVersion": model,
+        }
+
+    def model_kind(model: str, body: dict) -> str:
+        if "tts" in model:
+            return "tts"
+        return "image" if "image" in model else "text"
+
+    @app.post("/{version}/models/{model}:generateContent")
+    async def generate_content(version: str, model: str, request: Request):
+        body = await request.json()
+        error = await simulate(model_kind(model, body), model)
+        return error or gemini_response(model, body)
+
+    @app.post("/{version}/models/{model}:streamGenerateContent")
+    async def stream_generate_content(version: str, model: str, request: Request):
+        body = await request.json()
+        error = await simulate(model_kind(model, body), model)
+        if error is not None:
+            return error
+
+        full = gemini_response(model, body)
+        part = full["candidates"][0]["content"]["parts"][0]
+
+        async def events():
+            if "inlineData" not in part:
+                yield f"data: {json.dumps(full)}\n\n"
+                return
+            # Audio arrives in about one-second chunks
+            pcm = base64.b64decode(part["inlineData"]["data"])
+            step = TTS_SAMPLE_RATE * 2
+            for start in range(0, len(pcm), step):
+                chunk = {
+                    "candidates": [
+                        {
+                            "content": {
+                                "role": "model",
+                                "parts": [
+                                    {
+                                        "inlineData": {
+                                            "mimeType": part["inlineData"]["mimeType"],
+                                            "data": base64.b64encode(pcm[start : start + step]).decode(),
+                                        }
+                                    }
+                                ],
+                            },
+                            "index": 0,
+                        }
+                    ]
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep(0.01)
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    def prediction(prediction_id: str, base_url: str, version: str, output=None, status="succeeded"):
+        now = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+        return {
+            "id": prediction_id,
+            "model": "cdingram/face-swap",
+            "version": version,
+            "status": status,
+            "input": {},
+            "output": output,
+            "logs": "",
+            "error": None if status == "succeeded" else "Injected failure",
+            "metrics": {},
+            "created_at": now,
+            "started_at": now,
+            "completed_at": now,
+            "urls": {
+                "get": f"{base_url}v1/predictions/{prediction_id}",
+                "cancel": f"{base_url}v1/predictions/{prediction_id}/cancel",
+            },
+        }
+
+    @app.post("/v1/files")
+    async def create_file(request: Request):
+        form = await request.form()
+        upload = form["content"]
+        size = len(await upload.read())
+        file_id = uuid.uuid4().hex
+        now = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+        return {
+            "id": file_id,
+            "name": upload.filename or "upload",
+            "content_type": upload.content_type or "application/octet-stream",
+            "size": size,
+            "etag": file_id,
+            "checksums": {},
+            "metadata": {},
+            "created_at": now,
+            "expires_at": None,
+            "urls": {"get": f"{request.base_url}v1/files/{file_id}"},
+        }
+
+    @app.post("/v1/predictions")
+    async def create_prediction(request: Request):
+        body = await request.json()
+        error = await simulate("replicate", "replicate")
+        prediction_id = uuid.uuid4().hex
+        if error is not None:
+            if error.status_code == 429:
+                return error
+            return prediction(prediction_id, str(request.base_url), body.get("version"), status="failed")
+        # The client only treats https: and data: outputs as files
+        return prediction(
+            prediction_id,
+            str(request.base_url),
+            body.get("version"),
+            output=f"data:image/png;base64,{image_b64}",
+        )
+
+    @app.get("/v1/models/{owner}/{name}/versions/{version_id}")
+    async def get_version(owner: str, name: str, version_id: str):
+        return {
+            "id": version_id,
+            "created_at": "2024-01-01T00:00:00.000Z",
+            "cog_version": "0.9.0",
+            "openapi_schema": {"components": {"schemas": {"Output": {"type": "string", "format": "uri"}}}},
+        }
+
+    @app.get("/images/{name}")
+    async def origin_image(name: str):
+        # Origin for /api/proxy-image; every name is the same large JPEG
+        await simulate("origin")
+        return Response(
+            origin_jpeg,
+            media_type="image/jpeg",
+            headers={"ETag": '"origin-image"', "Cache-Control": "max-age=60"},
+        )
+
+    @app.get("/stats")
+    async def stats():
+        return counters
+
+    return app
+
+
+app = create_app(settings_from_env())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--image-latency", type=float, help="Seconds per Gemini image call")
+    parser.add_argument("--text-latency", type=float, help="Seconds per Gemini text call")
+    parser.add_argument("--tts-latency", type=float, help="Seconds per Gemini TTS call")
+    parser.add_argument("--replicate-latency", type=float, help="Seconds per Replicate prediction")
+    parser.add_argument("--latency-scale", type=float, help="Multiplier for every latency")
+    parser.add_argument("--jitter", type=float, help="Latency varies by +/- this fraction")
+    parser.add_argument("--error-rate", type=float, help="Share of calls failing with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, help="Share of calls to --rate-limit-models getting a 429")
+    parser.add_argument("--rate-limit-models", help="Comma-separated models that can be rate limited")
+    args = parser.parse_args()
+
+    for name, value in vars(args).items():
+        if value is not None and name not in ("host", "port"):
+            os.environ[f"FAKE_{name.upper()}"] = str(value)
+
+    import uvicorn
+
+    uvicorn.run(create_app(settings_from_env()), host=args.host, port=args.port, log_level="warning")
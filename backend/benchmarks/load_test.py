@@ -0,0 +1,317 @@
+"""
+Offline load test: runs the API against benchmarks/fake_upstreams.py and
+drives every endpoint at a fixed concurrency, reporting throughput and
+p50/p95/p99 latency per endpoint.
+
+Usage (from the backend directory):
+    python benchmarks/load_test.py --requests 40 --concurrency 8 --latency-scale 0.1
+    python benchmarks/load_test.py --endpoints virtual-try-on,face-swap --rate-limit-rate 0.3
+    python benchmarks/load_test.py --workers 2 --output benchmarks/results/load-before.json
+    python benchmarks/load_test.py --compare benchmarks/results/load-before.json
+
+The fake upstreams and a uvicorn server for main:app (--workers) are started
+as subprocesses, with the result cache and request coalescing disabled so
+every request reaches the fake upstreams. Other settings are taken from the
+environment, so e.g. IMAGE_POOL_WORKERS=2 python benchmarks/load_test.py
+measures that configuration. Use --api-url to drive a server you started
+yourself instead. bg-removal needs the rembg model, which is downloaded on
+first use.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from PIL import Image
+
+from report import compare, save_results, summarize
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEADERS = {"X-User-ID": "load-test"}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def photo(width: int, height: int) -> bytes:
+    """A phone-sized JPEG upload"""
+    img = Image.effect_noise((width, height), 40).convert("RGB")
+    buffer = io.BytesIO()
+    img.save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+class Scenarios:
+    """One coroutine per endpoint; each returns the final response"""
+
+    def __init__(self, upload: bytes, origin_url: str):
+        self.upload = upload
+        self.origin_url = origin_url
+
+    def files(self, *names):
+        return {name: (f"{name}.jpg", self.upload, "image/jpeg") for name in names}
+
+    async def bg_removal(self, client, index):
+        return await client.post("/api/bg-removal", files=self.files("file"))
+
+    async def virtual_try_on(self, client, index):
+        return await client.post(
+            "/api/virtual-try-on", files=self.files("person_image", "garment_image")
+        )
+
+    async def hand_drawn_portrait(self, client, index):
+        return await client.post("/api/hand-drawn-portrait", files=self.files("file"))
+
+    async def face_swap(self, client, index):
+        return await client.post(
+            "/api/face-swap", files=self.files("source_image", "target_image")
+        )
+
+    async def celebrity_selfie(self, client, index):
+        return await client.post(
+            "/api/celebrity-selfie",
+            files=self.files("source_image", "target_image"),
+            data={"custom_prompt": "at a film premiere"},
+        )
+
+    async def hairstyle_grid(self, client, index):
+        return await client.post("/api/hairstyle-grid", files=self.files("source_image"))
+
+    async def cinematic_storyboard(self, client, index):
+        return await client.post(
+            "/api/cinematic-storyboard",
+            files=self.files("source_image"),
+            data={"scene_type": "noir", "mood": "tense"},
+        )
+
+    async def podcast_creator(self, client, index):
+        # A new topic each time so the script cache does not answer
+        return await client.post("/api/podcast-creator", json={"topic": f"load test topic {index}"})
+
+    async def podcast_creator_stream(self, client, index):
+        response = await client.post(
+            "/api/podcast-creator/stream", json={"topic": f"load test stream topic {index}"}
+        )
+        if response.status_code != 200:
+            return response
+        audio_url = None
+        for line in response.text.splitlines():
+            if line.startswith("data:") and "audio_url" in line:
+                audio_url = json.loads(line[5:])["audio_url"]
+        if audio_url is None:
+            return response
+        return await client.get(audio_url)
+
+    async def proxy_image(self, client, index):
+        # A new origin URL each time: download, cache write and resize
+        return await client.get(
+            "/api/proxy-image", params={"url": f"{self.origin_url}/images/{index}.jpg", "w": 512}
+        )
+
+    async def jobs(self, client, index):
+        response = await client.post("/api/jobs/hairstyle-grid", files=self.files("source_image"))
+        if response.status_code != 202:
+            return response
+        job_id = response.json()["job_id"]
+        while True:
+            status = await client.get(f"/api/jobs/{job_id}", params={"wait": 30})
+            if status.json().get("status") in ("succeeded", "failed"):
+                break
+        return await client.get(f"/api/jobs/{job_id}/result")
+
+
+ENDPOINTS = [
+    "bg-removal",
+    "virtual-try-on",
+    "hand-drawn-portrait",
+    "face-swap",
+    "celebrity-selfie",
+    "hairstyle-grid",
+    "cinematic-storyboard",
+    "podcast-creator",
+    "podcast-creator-stream",
+    "proxy-image",
+    "jobs",
+]
+
+
+async def drive(client, scenario, total: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    statuses = {}
+
+    async def one(index):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await scenario(client, index)
+                status = str(response.status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - started
+            statuses[status] = statuses.get(status, 0) + 1
+            if status.startswith("2"):
+                latencies.append(elapsed)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(total)])
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": total,
+        "ok": len(latencies),
+        "statuses": statuses,
+        "throughput_rps": round(len(latencies) / elapsed, 3),
+        **summarize(latencies),
+    }
+
+
+def wait_until_up(url: str, process, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not start within {timeout:.0f}s")
+
+
+def start_servers(args, workdir: str):
+    fake_port = free_port()
+    fake_url = f"http://127.0.0.1:{fake_port}"
+    fake_args = [
+        sys.executable,
+        os.path.join(BACKEND_DIR, "benchmarks", "fake_upstreams.py"),
+        "--port",
+        str(fake_port),
+        "--latency-scale",
+        str(args.latency_scale),
+        "--jitter",
+        str(args.jitter),
+        "--error-rate",
+        str(args.error_rate),
+        "--rate-limit-rate",
+        str(args.rate_limit_rate),
+    ]
+    fake = subprocess.Popen(fake_args)
+    processes = [fake]
+    wait_until_up(f"{fake_url}/stats", fake)
+
+    if args.api_url:
+        return args.api_url, fake_url, processes
+
+    api_port = free_port()
+    metrics_dir = os.path.join(workdir, "prometheus")
+    os.makedirs(metrics_dir)
+    env = {
+        **os.environ,
+        "GEMINI_BASE_URL": fake_url,
+        "REPLICATE_BASE_URL": fake_url,
+        "GOOGLE_API_KEY": "load-test",
+        "REPLICATE_API_TOKEN": "load-test",
+        "CACHE_DIR": os.path.join(workdir, "cache"),
+        "RESULT_CACHE_TOOLS": "none",
+        "SINGLE_FLIGHT_ENABLED": "false",
+        "PROMETHEUS_MULTIPROC_DIR": metrics_dir,
+    }
+    api = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "main:app",
+            "--port",
+            str(api_port),
+            "--workers",
+            str(args.workers),
+            "--log-level",
+            "warning",
+        ],
+        cwd=BACKEND_DIR,
+        env=env,
+    )
+    processes.append(api)
+    api_url = f"http://127.0.0.1:{api_port}"
+    wait_until_up(api_url, api)
+    return api_url, fake_url, processes
+
+
+async def run_load(args, api_url: str, fake_url: str) -> dict:
+    scenarios = Scenarios(photo(args.width, args.height), fake_url)
+    endpoints = args.endpoints.split(",") if args.endpoints else ENDPOINTS
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    results = {}
+
+    print(
+        f"requests={args.requests} concurrency={args.concurrency} workers={args.workers} "
+        f"latency_scale={args.latency_scale} rate_limit_rate={args.rate_limit_rate} "
+        f"error_rate={args.error_rate}"
+    )
+    print(f"{'endpoint':<26}{'ok':>6}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}  statuses")
+    async with httpx.AsyncClient(
+        base_url=api_url, headers=HEADERS, timeout=args.timeout, limits=limits
+    ) as client:
+        for endpoint in endpoints:
+            scenario = getattr(scenarios, endpoint.replace("-", "_"))
+            # Warm-up request: model downloads, pool spawn, first connections
+            await drive(client, scenario, 1, 1)
+            result = await drive(client, scenario, args.requests, args.concurrency)
+            results[endpoint] = result
+            print(
+                f"{endpoint:<26}{result['ok']:>6}{result['throughput_rps']:>9}"
+                f"{result['p50_ms'] or '-':>10}{result['p95_ms'] or '-':>10}{result['p99_ms'] or '-':>10}"
+                f"  {result['statuses']}"
+            )
+    return results
+
+
+def run(args):
+    with tempfile.TemporaryDirectory(prefix="toolkitai-load-") as workdir:
+        api_url, fake_url, processes = start_servers(args, workdir)
+        try:
+            results = asyncio.run(run_load(args, api_url, fake_url))
+            upstream = httpx.get(f"{fake_url}/stats").json()
+            print(f"upstream calls: {upstream}")
+        finally:
+            for process in reversed(processes):
+                process.terminate()
+            for process in processes:
+                process.wait(timeout=30)
+
+    if args.output:
+        save_results(args.output, "load_test", args, results, upstream=upstream)
+    if args.compare:
+        compare(args.compare, results, ["throughput_rps", "p50_ms", "p95_ms", "p99_ms"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--endpoints", help=f"Comma-separated subset of: {','.join(ENDPOINTS)}")
+    parser.add_argument("--requests", type=int, default=40, help="Requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--api-url", help="Drive this server instead of starting one")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--width", type=int, default=3024, help="Upload width")
+    parser.add_argument("--height", type=int, default=4032, help="Upload height")
+    parser.add_argument("--latency-scale", type=float, default=0.1, help="Fake upstream latency multiplier")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--output", help="Save results as JSON")
+    parser.add_argument("--compare", help="Compare with an earlier --output file")
+    run(parser.parse_args())
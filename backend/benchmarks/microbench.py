@@ -0,0 +1,144 @@
+"""
+CPU microbenchmarks for the image hot paths: watermarking, upload decode and
+preparation, output encoding and rembg inference.
+
+Usage (from the backend directory):
+    python benchmarks/microbench.py --output benchmarks/results/micro-before.json
+    python benchmarks/microbench.py --compare benchmarks/results/micro-before.json
+    python benchmarks/microbench.py --only watermark,upload --iterations 50
+
+Inputs are synthetic (noisy images, so encoded sizes resemble photos). rembg
+inference downloads the model on first use and is skipped, with a note, if it
+cannot be loaded; HEIC decode is skipped when pillow-heif cannot encode the
+test image.
+"""
+
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+import main
+from report import compare, save_results
+
+GROUPS = ["watermark", "upload", "encode", "rembg"]
+
+
+def noisy(width: int, height: int, mode: str = "RGB") -> Image.Image:
+    img = Image.effect_noise((width, height), 40).convert("RGB")
+    return img.convert(mode)
+
+
+def encoded(img: Image.Image, image_format: str, **params) -> bytes:
+    buffer = io.BytesIO()
+    img.save(buffer, image_format, **params)
+    return buffer.getvalue()
+
+
+def measure(fn, iterations: int, setup=None) -> dict:
+    """Run fn (on setup()'s result, built outside the timing) and summarize"""
+    fn(setup() if setup else None)
+    timings = []
+    for _ in range(iterations):
+        arg = setup() if setup else None
+        started = time.perf_counter()
+        fn(arg)
+        timings.append((time.perf_counter() - started) * 1000)
+    return {
+        "iterations": iterations,
+        "mean_ms": round(statistics.mean(timings), 3),
+        "p50_ms": round(statistics.median(timings), 3),
+        "min_ms": round(min(timings), 3),
+    }
+
+
+def watermark_benchmarks(args):
+    for width, height in [(1024, 1024), (2048, 2048), (3024, 4032)]:
+        for mode in ("RGB", "RGBA"):
+            img = noisy(width, height, mode)
+            yield f"add_watermark {width}x{height} {mode}", lambda target: main.add_watermark(
+                target
+            ), img.copy
+
+
+def upload_benchmarks(args):
+    photo = noisy(3024, 4032)
+    jpeg = encoded(photo, "JPEG", quality=92)
+    png = encoded(photo.resize((1512, 2016)), "PNG")
+    small_jpeg = encoded(photo.resize((1024, 1365)), "JPEG", quality=90)
+    inputs = [("jpeg 12MP", jpeg), ("png 3MP", png), ("jpeg 1.4MP passthrough", small_jpeg)]
+    try:
+        inputs.append(("heic 12MP", encoded(photo, "HEIF", quality=80)))
+    except Exception as e:
+        print(f"skipping heic: {e}")
+
+    for name, data in inputs:
+        yield f"image_footprint {name}", lambda _, data=data: main.image_footprint(data), None
+        yield f"decode {name}", lambda _, data=data: Image.open(io.BytesIO(data)).load(), None
+        yield (
+            f"prepare_upload {name}",
+            lambda _, data=data: main.prepare_upload(data, main.UPLOAD_MAX_EDGE),
+            None,
+        )
+
+
+def encode_benchmarks(args):
+    cutout = noisy(1024, 1024, "RGBA")
+    photo = noisy(1024, 1024)
+    for name, img in [("cutout 1024 RGBA", cutout), ("photo 1024 RGB", photo)]:
+        for label, options in [
+            ("png", main.OutputOptions()),
+            ("webp", main.OutputOptions("WEBP")),
+            ("jpeg", main.OutputOptions("JPEG")),
+        ]:
+            yield (
+                f"finish_image {name} {label}",
+                lambda target, options=options: main.finish_image(target, options),
+                img.copy,
+            )
+
+
+def rembg_benchmarks(args):
+    try:
+        session = main.rembg_sessions.get(main.REMBG_MODEL)
+    except Exception as e:
+        print(f"skipping rembg: could not load {main.REMBG_MODEL}: {e}")
+        return
+    for size in (1024, 2048):
+        img = noisy(size, size)
+        yield f"rembg predict {main.REMBG_MODEL} {size}px", lambda _, img=img: session.predict(img), None
+    data = encoded(noisy(1536, 2048), "JPEG", quality=90)
+    yield "_bg_removal_job 1536x2048 jpeg", lambda _: main._bg_removal_job(data), None
+
+
+def run(args):
+    groups = args.only.split(",") if args.only else GROUPS
+    results = {}
+    print(f"{'benchmark':<48}{'mean ms':>10}{'p50 ms':>10}{'min ms':>10}")
+    for group in groups:
+        iterations = args.rembg_iterations if group == "rembg" else args.iterations
+        for name, fn, setup in globals()[f"{group}_benchmarks"](args):
+            result = measure(fn, iterations, setup)
+            results[name] = result
+            print(f"{name:<48}{result['mean_ms']:>10}{result['p50_ms']:>10}{result['min_ms']:>10}")
+
+    if args.output:
+        save_results(args.output, "microbench", args, results)
+    if args.compare:
+        compare(args.compare, results, ["mean_ms", "p50_ms"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--only", help=f"Comma-separated subset of: {','.join(GROUPS)}")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--rembg-iterations", type=int, default=5)
+    parser.add_argument("--output", help="Save results as JSON")
+    parser.add_argument("--compare", help="Compare with an earlier --output file")
+    run(parser.parse_args())
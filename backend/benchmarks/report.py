@@ -0,0 +1,85 @@
+"""
+Shared helpers for the load test and microbenchmarks: latency summaries and
+JSON results that later runs can be compared against.
+"""
+
+import json
+import os
+import platform
+import subprocess
+import time
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies: list) -> dict:
+    """p50/p95/p99/mean of latencies in seconds, reported in milliseconds"""
+    if not latencies:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "mean_ms": None}
+    return {
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2),
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(path: str, suite: str, args, results: dict, **extra) -> None:
+    """Write a run's results with enough context to compare it later"""
+    document = {
+        "suite": suite,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_revision": _git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "args": vars(args),
+        "results": results,
+        **extra,
+    }
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(document, f, indent=2)
+    print(f"\nresults saved to {path}")
+
+
+def compare(path: str, results: dict, metrics: list) -> None:
+    """
+    Print each metric next to the value from an earlier results file.
+    Lower is better for *_ms metrics, higher for everything else.
+    """
+    with open(path) as f:
+        previous = json.load(f)
+    print(f"\ncompared with {path} ({previous.get('created_at')}, {previous.get('git_revision')})")
+    print(f"{'name':<34}{'metric':<16}{'before':>12}{'after':>12}{'change':>10}")
+    for name, current in results.items():
+        before = previous["results"].get(name)
+        if before is None:
+            continue
+        for metric in metrics:
+            old, new = before.get(metric), current.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            worse = change > 0 if metric.endswith("_ms") else change < 0
+            flag = " !" if worse and abs(change) >= 10 else ""
+            print(f"{name:<34}{metric:<16}{old:>12}{new:>12}{change:>+9.1f}%{flag}")
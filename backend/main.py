@@ -1,9 +1,12 @@
-from fastapi import FastAPI, File, UploadFile, Response, HTTPException, Form, Request
+from fastapi import FastAPI, File, UploadFile, Response, HTTPException, Form, Request, Query, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from starlette.middleware.base import BaseHTTPMiddleware
 from pydantic import BaseModel
-from rembg import remove
-from PIL import Image, ImageDraw, ImageFont
+from rembg import remove, new_session
+from rembg.bg import fix_image_orientation, naive_cutout
+from PIL import Image, ImageColor, ImageDraw, ImageFont, ImageOps, features
+import numpy as np
 
 # Register HEIF opener for HEIC/HEIF support
 try:
@@ -13,14 +16,52 @@ except ImportError:
     # pillow-heif not installed, HEIF support will not be available
     pass
 
+# FLAC/Opus podcast audio; without it podcasts are only served as WAV
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
 import io
 import os
+import asyncio
+import random
+import multiprocessing
 import base64
+import contextvars
+import cProfile
+import fcntl
+import hashlib
+import hmac
+import json
+import math
+import re
+import sqlite3
+import struct
+import uuid
 import tempfile
+import warnings
 import logging
 import wave
-import urllib.request
-
+import time
+import threading
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import httpx
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
 from google import genai
 from google.genai import types
 import replicate
@@ -36,8 +77,8 @@ logger = logging.getLogger(__name__)
 # Authentication Middleware
 class AuthMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
-        # Skip auth for root endpoint and health checks only
-        if request.url.path in ["/", "/health"]:
+        # Skip auth for root endpoint, health checks and metrics only
+        if request.url.path in ["/", "/health", "/metrics"]:
             return await call_next(request)
 
         # Check for X-User-ID header (set by Next.js API routes)
@@ -70,1126 +111,3809 @@ class AuthMiddleware(BaseHTTPMiddleware):
         return await call_next(request)
 
 
-def add_watermark(image_path: str, text: str = "toolkitai.io") -> None:
+# Prometheus metrics. With several uvicorn workers, set PROMETHEUS_MULTIPROC_DIR
+# to an empty directory before start-up so every worker's samples are merged
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# Image generations and TTS run for tens of seconds
+SLOW_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300)
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "toolkit_http_request_duration_seconds",
+    "Time to serve a request, until the last response byte is sent",
+    ["route", "method", "status"],
+    buckets=SLOW_BUCKETS,
+)
+HTTP_REQUEST_BYTES = Counter(
+    "toolkit_http_request_bytes", "Request body bytes received", ["route"]
+)
+HTTP_RESPONSE_BYTES = Counter(
+    "toolkit_http_response_bytes", "Response body bytes sent", ["route"]
+)
+HTTP_IN_FLIGHT = Gauge(
+    "toolkit_http_requests_in_flight", "Requests being served", multiprocess_mode="livesum"
+)
+UPSTREAM_SECONDS = Histogram(
+    "toolkit_upstream_request_duration_seconds",
+    "Gemini and Replicate call latency, excluding time queued for a concurrency slot",
+    ["model", "outcome"],
+    buckets=SLOW_BUCKETS,
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "toolkit_upstream_requests_in_flight",
+    "Gemini and Replicate calls in progress",
+    ["model"],
+    multiprocess_mode="livesum",
+)
+UPSTREAM_RATE_LIMITED = Counter(
+    "toolkit_upstream_rate_limited", "Upstream calls rejected with a 429", ["model"]
+)
+MODEL_FALLBACKS = Counter(
+    "toolkit_model_fallbacks",
+    "Image generations sent to the fallback model",
+    ["model", "reason"],
+)
+IMAGE_STAGE_SECONDS = Histogram(
+    "toolkit_image_stage_seconds",
+    "CPU-bound image work per stage (decode, rembg inference, watermark, encode)",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+IMAGE_POOL_IN_FLIGHT = Gauge(
+    "toolkit_image_pool_jobs_in_flight",
+    "Image pool jobs running or queued",
+    multiprocess_mode="livesum",
+)
+MEMORY_BUDGET_IN_USE = Gauge(
+    "toolkit_memory_budget_bytes_in_use",
+    "Image decode memory reserved by in-flight requests",
+    multiprocess_mode="livesum",
+)
+
+
+# (name, seconds, description) stage timings of the request being served; the
+# list is shared with the threads and tasks the request starts
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+# Server-Timing entries kept per response
+SERVER_TIMING_MAX_ENTRIES = 30
+
+
+def note_timing(name: str, seconds: float, desc: str = None) -> None:
     """
-    Add watermark to image file in-place
-    Args:
-        image_path: Path to the image file
-        text: Watermark text
+    Add a stage to the current request's Server-Timing header
     """
-    # Load the image
-    img = Image.open(image_path)
+    timings = _request_timings.get()
+    if timings is not None and len(timings) < SERVER_TIMING_MAX_ENTRIES:
+        timings.append((name, seconds, desc))
 
-    # Convert to RGB if needed (most common format)
-    if img.mode not in ("RGB", "RGBA"):
-        img = img.convert("RGB")
 
-    # Create drawing context
-    draw = ImageDraw.Draw(img)
+def server_timing(timings: list, total: float = None) -> str:
+    entries = []
+    for name, seconds, desc in timings:
+        entry = f"{name};dur={seconds * 1000:.1f}"
+        if desc:
+            entry += f';desc="{desc}"'
+        entries.append(entry)
+    if total is not None:
+        entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
 
-    width, height = img.size
-    font_size = max(12, int(width * 0.02))
 
-    # Try to load a nice font
-    try:
-        font = ImageFont.truetype(
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", font_size
-        )
-    except:
+class MetricsMiddleware:
+    """
+    Plain ASGI middleware (no per-request task or body buffering) recording
+    latency, status and body sizes under the matched route template, adding
+    a Server-Timing header with the stages timed so far, and profiling
+    requests that opt in through request_profiler
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = 500
+        bytes_in = 0
+        bytes_out = 0
+        timings = []
+        _request_timings.set(timings)
+        profile_id = request_profiler.start(scope)
+
+        async def counting_receive():
+            nonlocal bytes_in
+            message = await receive()
+            bytes_in += len(message.get("body", b""))
+            if message["type"] == "http.request" and bytes_in and not message.get("more_body"):
+                # Includes the client's upload time, not only our parsing
+                note_timing("upload", time.perf_counter() - started)
+            return message
+
+        async def counting_send(message):
+            nonlocal status, bytes_out
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append(
+                    (
+                        b"server-timing",
+                        server_timing(timings, time.perf_counter() - started).encode("latin-1"),
+                    )
+                )
+                if profile_id is not None:
+                    headers.append((b"x-profile-id", profile_id.encode("latin-1")))
+                message = {**message, "headers": headers}
+            elif message["type"] == "http.response.body":
+                bytes_out += len(message.get("body", b""))
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
         try:
-            font = ImageFont.truetype(
-                "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf",
-                font_size,
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            if profile_id is not None:
+                request_profiler.finish(profile_id)
+            HTTP_IN_FLIGHT.dec()
+            # Route templates keep label cardinality bounded
+            route = scope.get("route")
+            route = route.path if route is not None else "unmatched"
+            HTTP_REQUEST_SECONDS.labels(route, scope["method"], str(status)).observe(
+                time.perf_counter() - started
             )
-        except:
-            font = ImageFont.load_default()
-
-    # Get text dimensions
-    bbox = draw.textbbox((0, 0), text, font=font)
-    text_width = bbox[2] - bbox[0]
-    text_height = bbox[3] - bbox[1]
-
-    # Calculate position (bottom-right with padding)
-    padding = max(10, int(width * 0.01))
-    x = width - text_width - padding
-    y = height - text_height - padding
+            HTTP_REQUEST_BYTES.labels(route).inc(bytes_in)
+            HTTP_RESPONSE_BYTES.labels(route).inc(bytes_out)
 
-    # Draw semi-transparent background
-    bg_padding = 5
-    background_bbox = [
-        x - bg_padding,
-        y - bg_padding,
-        x + text_width + bg_padding,
-        y + text_height + bg_padding,
-    ]
-    draw.rectangle(background_bbox, fill=(0, 0, 0))
 
-    # Draw white text
-    draw.text((x, y), text, fill=(255, 255, 255), font=font)
+@contextmanager
+def upstream_call(model: str):
+    """
+    Time one Gemini or Replicate call and record its outcome
+    """
+    UPSTREAM_IN_FLIGHT.labels(model).inc()
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    except (asyncio.CancelledError, GeneratorExit):
+        # Usually the losing side of a hedged request, or a closed stream
+        outcome = "cancelled"
+        raise
+    except Exception as e:
+        if is_rate_limit_error(e):
+            outcome = "rate_limited"
+            UPSTREAM_RATE_LIMITED.labels(model).inc()
+        raise
+    finally:
+        UPSTREAM_IN_FLIGHT.labels(model).dec()
+        elapsed = time.perf_counter() - started
+        UPSTREAM_SECONDS.labels(model, outcome).observe(elapsed)
+        note_timing("upstream", elapsed, f"{model} {outcome}")
 
-    # Save back to the same file
-    img.save(image_path)
 
+# Set inside image pool workers, whose stage timings are sent back to the API
+# process with each result rather than recorded in the worker
+_relayed_stages = None
 
-app = FastAPI(title="ToolkitAI API")
 
-# Get allowed origins from environment variable
-allowed_origins = os.getenv(
-    "ALLOWED_ORIGINS", "http://localhost:3000,http://localhost:3001"
-).split(",")
+def record_stage(stage: str, seconds: float) -> None:
+    if _relayed_stages is not None:
+        _relayed_stages.append((stage, seconds))
+    else:
+        IMAGE_STAGE_SECONDS.labels(stage).observe(seconds)
+        note_timing(stage, seconds)
 
-# Add authentication middleware (before CORS)
-app.add_middleware(AuthMiddleware)
 
-# Configure CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=allowed_origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+@contextmanager
+def timed_stage(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
 
 
-@app.get("/")
-def read_root():
-    logger.info("Root endpoint accessed")
-    return {"status": "online", "message": "ToolkitAI Backend is running"}
+WATERMARK_FONT_CANDIDATES = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+    "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf",
+]
 
+# Font sizes are rounded to this step so nearby output widths share one tile
+WATERMARK_FONT_STEP = int(os.getenv("WATERMARK_FONT_STEP", "2"))
 
-@app.post("/api/bg-removal")
-async def bg_removal(file: UploadFile = File(...)):
-    try:
-        logger.info(f"Processing background removal for file: {file.filename}")
-        # Read the image file
-        image_data = await file.read()
 
-        # Remove background using rembg
-        output_data = remove(image_data)
+def _resolve_watermark_font():
+    """
+    Pick the first loadable font from the fallback chain (None = PIL default)
+    """
+    for font_path in WATERMARK_FONT_CANDIDATES:
+        try:
+            ImageFont.truetype(font_path, 12)
+            return font_path
+        except OSError:
+            continue
+    logger.warning("No TrueType watermark font found, using PIL default font")
+    return None
 
-        # Save to temp file, add watermark, read back
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp_file:
-            tmp_path = tmp_file.name
-            tmp_file.write(output_data)
 
-        # Add watermark in-place
-        add_watermark(tmp_path)
+# Resolved once at startup instead of probing the font paths on every request
+WATERMARK_FONT_PATH = _resolve_watermark_font()
 
-        # Read the watermarked image
-        with open(tmp_path, "rb") as f:
-            watermarked_data = f.read()
 
-        # Clean up
-        os.remove(tmp_path)
+@lru_cache(maxsize=64)
+def _watermark_overlay(text: str, font_size: int):
+    """
+    Pre-render the watermark label as an RGBA tile
+    Returns:
+        (tile, text_width, text_height); the tile's top-left corner sits
+        bg_padding pixels above and left of the text origin
+    """
+    if WATERMARK_FONT_PATH:
+        font = ImageFont.truetype(WATERMARK_FONT_PATH, font_size)
+    else:
+        font = ImageFont.load_default()
 
-        logger.info("Background removal successful with watermark")
-        return Response(content=watermarked_data, media_type="image/png")
-    except Exception as e:
-        logger.error(f"Error in background removal: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    # Get text dimensions
+    bbox = ImageDraw.Draw(Image.new("L", (1, 1))).textbbox((0, 0), text, font=font)
+    text_width = bbox[2] - bbox[0]
+    text_height = bbox[3] - bbox[1]
 
+    # Black box behind the text; the glyphs can extend below it by the font's
+    # top bearing, so the tile is tall enough to hold both
+    bg_padding = 5
+    box_width = text_width + 2 * bg_padding + 1
+    box_height = text_height + 2 * bg_padding + 1
+    tile = Image.new(
+        "RGBA", (box_width, max(box_height, bg_padding + bbox[3])), (0, 0, 0, 0)
+    )
+    draw = ImageDraw.Draw(tile)
+    draw.rectangle([0, 0, box_width - 1, box_height - 1], fill=(0, 0, 0, 255))
 
-@app.post("/api/virtual-try-on")
-async def virtual_try_on(
-    person_image: UploadFile = File(...), garment_image: UploadFile = File(...)
-):
-    try:
-        logger.info(
-            f"Processing virtual try-on request. Person: {person_image.filename}, Garment: {garment_image.filename}"
-        )
+    # Draw white text
+    draw.text((bg_padding, bg_padding), text, fill=(255, 255, 255, 255), font=font)
 
-        # Read images
-        person_bytes = await person_image.read()
-        garment_bytes = await garment_image.read()
+    return tile, text_width, text_height
 
-        person_pil = Image.open(io.BytesIO(person_bytes))
-        garment_pil = Image.open(io.BytesIO(garment_bytes))
-
-        # Calculate aspect ratio of person image to match output
-        width, height = person_pil.size
-        aspect_ratio_map = {
-            (1, 1): "1:1",
-            (2, 3): "2:3",
-            (3, 2): "3:2",
-            (3, 4): "3:4",
-            (4, 3): "4:3",
-            (4, 5): "4:5",
-            (5, 4): "5:4",
-            (9, 16): "9:16",
-            (16, 9): "16:9",
-            (21, 9): "21:9",
-        }
 
-        # Find closest aspect ratio
-        def gcd(a, b):
-            while b:
-                a, b = b, a % b
-            return a
+def add_watermark(img: Image.Image, text: str = "toolkitai.io") -> Image.Image:
+    """
+    Draw the watermark onto an in-memory image
+    Args:
+        img: Decoded PIL image
+        text: Watermark text
+    Returns:
+        The watermarked image (converted to RGB if it was not RGB/RGBA)
+    """
+    # Convert to RGB if needed (most common format)
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGB")
 
-        divisor = gcd(width, height)
-        ratio_w = width // divisor
-        ratio_h = height // divisor
+    width, height = img.size
+    font_size = max(12, int(width * 0.02))
+    font_size -= font_size % WATERMARK_FONT_STEP
 
-        # Try to find exact match or closest
-        aspect_ratio = "1:1"  # default
-        if (ratio_w, ratio_h) in aspect_ratio_map:
-            aspect_ratio = aspect_ratio_map[(ratio_w, ratio_h)]
-        else:
-            # Find closest based on ratio value
-            target_ratio = width / height
-            closest_key = min(
-                aspect_ratio_map.keys(), key=lambda k: abs((k[0] / k[1]) - target_ratio)
-            )
-            aspect_ratio = aspect_ratio_map[closest_key]
+    tile, text_width, text_height = _watermark_overlay(text, font_size)
 
-        logger.info(f"Detected aspect ratio for person image: {aspect_ratio}")
+    # Calculate position (bottom-right with padding)
+    padding = max(10, int(width * 0.01))
+    x = width - text_width - padding
+    y = height - text_height - padding
 
-        api_key = os.getenv("GOOGLE_API_KEY")
-        if not api_key:
-            logger.error("GOOGLE_API_KEY not set")
-            raise HTTPException(status_code=500, detail="GOOGLE_API_KEY not set")
+    bg_padding = 5
+    img.paste(tile, (x - bg_padding, y - bg_padding), tile)
 
-        client = genai.Client(api_key=api_key)
+    return img
 
-        prompt = """Virtual Try-On Task:
-        1. Analyze the first image (person) and the second image (garment).
-        2. If there are multiple people in the first image, apply the garment to the person who is the center of attraction or most prominent.
-        3. If there is NO person in the first image, do NOT generate any image output.
-        4. Generate a new image of the person from the first image wearing the garment from the second image.
-        5. CRITICAL: Keep the person's identity, pose, body shape, and the original background EXACTLY as they are in the first image.
-        6. Do NOT modify the person's face, hair, or the background.
-        7. Apply the garment naturally to the person's body, adjusting for fit, lighting, and shadows to match the original scene.
-        8. Ensure high photorealism.
-        9. Do not process any undergarment or inappropriate content requests.
-        """
 
-        # Prepare the config (reusable for both models)
-        generate_config = types.GenerateContentConfig(
-            response_modalities=["IMAGE"],
-            image_config=types.ImageConfig(aspect_ratio=aspect_ratio),
-            safety_settings=[
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
-                    threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-                ),
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
-                    threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-                ),
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-                    threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-                ),
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_HARASSMENT,
-                    threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-                ),
-            ],
-        )
+# JPEG has no alpha; transparent areas (e.g. bg-removal cutouts) are filled
+# with this colour
+OUTPUT_JPEG_BACKGROUND = ImageColor.getrgb(os.getenv("OUTPUT_JPEG_BACKGROUND", "white"))
 
-        # Try primary model first, fallback to secondary on 429
-        response = None
-        model_used = "gemini-3-pro-image-preview"
-        
-        try:
-            logger.info("Sending request to Gemini API (using gemini-3-pro-image-preview)...")
-            response = client.models.generate_content(
-                model="gemini-3-pro-image-preview",
-                contents=[person_pil, garment_pil, prompt],
-                config=generate_config,
-            )
-            logger.info("Received response from Gemini API (gemini-3-pro-image-preview)")
-        except Exception as e:
-            # Check if it's a 429 rate limit error
-            error_str = str(e).lower()
-            status_code = None
-            
-            # Try to extract status code from exception
-            if hasattr(e, 'status_code'):
-                status_code = e.status_code
-            elif hasattr(e, 'response') and hasattr(e.response, 'status_code'):
-                status_code = e.response.status_code
-            elif '429' in error_str or 'rate limit' in error_str or 'too many requests' in error_str:
-                status_code = 429
-            
-            if status_code == 429:
-                logger.warning("Rate limit (429) encountered with gemini-3-pro-image-preview, falling back to gemini-2.5-flash-image")
-                try:
-                    response = client.models.generate_content(
-                        model="gemini-2.5-flash-image",
-                        contents=[person_pil, garment_pil, prompt],
-                        config=generate_config,
-                    )
-                    model_used = "gemini-2.5-flash-image"
-                    logger.info("Received response from Gemini API (gemini-2.5-flash-image fallback)")
-                except Exception as fallback_error:
-                    logger.error(f"Fallback model also failed: {fallback_error}")
-                    raise HTTPException(
-                        status_code=503,
-                        detail="Service temporarily unavailable due to rate limits. Please try again later."
-                    )
-            else:
-                # Re-raise if it's not a 429 error
-                logger.error(f"Error calling Gemini API: {e}")
-                raise
 
-        if response is None:
-            logger.error("No response received from Gemini API")
-            raise HTTPException(
-                status_code=500,
-                detail="Failed to get response from image generation service."
-            )
+def flatten_alpha(img: Image.Image) -> Image.Image:
+    """
+    Composite an image onto OUTPUT_JPEG_BACKGROUND, returning RGB
+    """
+    if "A" not in img.getbands() and "transparency" not in img.info:
+        return img.convert("RGB")
+    img = img.convert("RGBA")
+    background = Image.new("RGB", img.size, OUTPUT_JPEG_BACKGROUND)
+    background.paste(img, mask=img.getchannel("A"))
+    return background
 
-        generated_image_bytes = None
 
-        if response.parts:
-            for part in response.parts:
-                if part.inline_data:
-                    img = part.as_image()
+def encode_image(img: Image.Image, image_format: str = "PNG", **params) -> bytes:
+    """
+    Encode a PIL image to bytes in memory
+    Args:
+        img: Image to encode
+        image_format: Pillow format name (PNG, JPEG, ...)
+        params: Encoder options passed to Image.save (quality, compress_level, ...)
+    """
+    if image_format == "JPEG" and img.mode not in ("RGB", "L"):
+        img = flatten_alpha(img)
 
-                    # Save to a temporary file
-                    with tempfile.NamedTemporaryFile(
-                        suffix=".png", delete=False
-                    ) as tmp_file:
-                        tmp_path = tmp_file.name
+    buffer = io.BytesIO()
+    img.save(buffer, image_format, **params)
+    return buffer.getvalue()
 
-                    img.save(tmp_path)
 
-                    # Add watermark in-place
-                    add_watermark(tmp_path)
+OUTPUT_FORMATS = {"png": "PNG", "webp": "WEBP", "jpeg": "JPEG", "jpg": "JPEG"}
+OUTPUT_MEDIA_TYPES = {"PNG": "image/png", "WEBP": "image/webp", "JPEG": "image/jpeg"}
+# "best" uses libimagequant when Pillow is built with it
+QUANTIZE_MODES = ("fast", "best")
 
-                    # Read back the watermarked image
-                    with open(tmp_path, "rb") as f:
-                        generated_image_bytes = f.read()
+# Encoder defaults, tuned for encode time over the last few percent of size
+# (see benchmarks/bench_output_encoding.py)
+OUTPUT_PNG_COMPRESS_LEVEL = int(os.getenv("OUTPUT_PNG_COMPRESS_LEVEL", "3"))
+OUTPUT_WEBP_QUALITY = int(os.getenv("OUTPUT_WEBP_QUALITY", "85"))
+OUTPUT_WEBP_METHOD = int(os.getenv("OUTPUT_WEBP_METHOD", "2"))
+OUTPUT_JPEG_QUALITY = int(os.getenv("OUTPUT_JPEG_QUALITY", "90"))
 
-                    # Clean up the temporary file
-                    os.remove(tmp_path)
-                    break
 
-        if not generated_image_bytes:
-            # Check if there was a text refusal or safety issue
-            text_response = ""
-            if response.parts:
-                for part in response.parts:
-                    if part.text:
-                        text_response += part.text
+class OutputOptions:
+    """
+    Per-request encoding of an image endpoint's output
+    """
 
-            logger.warning(f"No image generated. Text response: {text_response}")
+    __slots__ = ("format", "quality", "compress_level", "crop", "quantize", "colors")
+
+    def __init__(
+        self,
+        format: str = "PNG",
+        quality: int = None,
+        compress_level: int = None,
+        crop: bool = False,
+        quantize: str = None,
+        colors: int = 256,
+    ):
+        self.format = format
+        self.quality = quality
+        self.compress_level = compress_level
+        self.crop = crop
+        self.quantize = quantize
+        self.colors = colors
+
+    @classmethod
+    def parse(cls, params, default_format: str = "PNG") -> "OutputOptions":
+        """
+        Build options from query parameters (format, quality, compress_level,
+        crop, quantize, colors), raising a 400 for invalid values
+        """
 
-            if text_response:
+        def number(name, low, high):
+            value = params.get(name)
+            if value in (None, ""):
+                return None
+            try:
+                value = int(value)
+            except ValueError:
+                value = None
+            if value is None or not low <= value <= high:
                 raise HTTPException(
-                    status_code=400, detail=f"Generation failed: {text_response}"
+                    status_code=400, detail=f"{name} must be an integer between {low} and {high}"
                 )
-            else:
+            return value
+
+        image_format = default_format
+        if params.get("format"):
+            image_format = OUTPUT_FORMATS.get(params["format"].lower())
+            if image_format is None:
                 raise HTTPException(
-                    status_code=500,
-                    detail="Failed to generate image. The model might have blocked the request due to safety filters.",
+                    status_code=400,
+                    detail=f"Unsupported output format: {params['format']}. Use one of: png, webp, jpeg",
                 )
 
-        logger.info(f"Virtual try-on successful using {model_used}, returning image.")
-        return Response(content=generated_image_bytes, media_type="image/png")
+        quantize = params.get("quantize") or None
+        if quantize is not None and quantize not in QUANTIZE_MODES:
+            raise HTTPException(
+                status_code=400, detail=f"quantize must be one of: {', '.join(QUANTIZE_MODES)}"
+            )
+
+        return cls(
+            format=image_format,
+            quality=number("quality", 1, 100),
+            compress_level=number("compress_level", 0, 9),
+            crop=str(params.get("crop", "")).lower() in ("1", "true", "yes"),
+            quantize=quantize,
+            colors=number("colors", 2, 256) or 256,
+        )
 
-    except HTTPException as he:
-        logger.error(f"HTTP Exception in virtual try-on: {he.detail}")
-        raise he
-    except Exception as e:
-        logger.error(f"Unexpected error in virtual try-on: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    @property
+    def media_type(self) -> str:
+        return OUTPUT_MEDIA_TYPES[self.format]
 
+    def cache_key(self) -> str:
+        return ":".join(str(getattr(self, name)) for name in self.__slots__)
 
-@app.post("/api/hand-drawn-portrait")
-async def hand_drawn_portrait(file: UploadFile = File(...)):
-    try:
-        logger.info(f"Processing hand-drawn portrait request. Image: {file.filename}")
 
-        # Read image
-        image_bytes = await file.read()
-        image_pil = Image.open(io.BytesIO(image_bytes))
-
-        # Calculate aspect ratio of input image to match output
-        width, height = image_pil.size
-        aspect_ratio_map = {
-            (1, 1): "1:1",
-            (2, 3): "2:3",
-            (3, 2): "3:2",
-            (3, 4): "3:4",
-            (4, 3): "4:3",
-            (4, 5): "4:5",
-            (5, 4): "5:4",
-            (9, 16): "9:16",
-            (16, 9): "16:9",
-            (21, 9): "21:9",
-        }
+def output_options(default_format: str = "PNG"):
+    """
+    FastAPI dependency reading OutputOptions from the query string
+    """
 
-        # Find closest aspect ratio
-        def gcd(a, b):
-            while b:
-                a, b = b, a % b
-            return a
+    def dependency(
+        format: str = Query(None),
+        quality: int = Query(None),
+        compress_level: int = Query(None),
+        crop: bool = Query(False),
+        quantize: str = Query(None),
+        colors: int = Query(None),
+    ) -> OutputOptions:
+        return OutputOptions.parse(
+            {
+                "format": format,
+                "quality": quality,
+                "compress_level": compress_level,
+                "crop": crop,
+                "quantize": quantize,
+                "colors": colors,
+            },
+            default_format,
+        )
 
-        divisor = gcd(width, height)
-        ratio_w = width // divisor
-        ratio_h = height // divisor
+    return dependency
 
-        # Try to find exact match or closest
-        aspect_ratio = "1:1"  # default
-        if (ratio_w, ratio_h) in aspect_ratio_map:
-            aspect_ratio = aspect_ratio_map[(ratio_w, ratio_h)]
-        else:
-            # Find closest based on ratio value
-            target_ratio = width / height
-            closest_key = min(
-                aspect_ratio_map.keys(), key=lambda k: abs((k[0] / k[1]) - target_ratio)
-            )
-            aspect_ratio = aspect_ratio_map[closest_key]
 
-        logger.info(f"Detected aspect ratio for input image: {aspect_ratio}")
+def quantize_image(img: Image.Image, mode: str, colors: int) -> Image.Image:
+    if mode == "best" and features.check_feature("libimagequant"):
+        method = Image.Quantize.LIBIMAGEQUANT
+    elif img.mode == "RGBA":
+        # The only built-in quantizer that keeps alpha
+        method = Image.Quantize.FASTOCTREE
+    else:
+        method = Image.Quantize.MEDIANCUT if mode == "best" else Image.Quantize.FASTOCTREE
 
-        api_key = os.getenv("GOOGLE_API_KEY")
-        if not api_key:
-            logger.error("GOOGLE_API_KEY not set")
-            raise HTTPException(status_code=500, detail="GOOGLE_API_KEY not set")
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+    return img.quantize(colors, method=method)
 
-        client = genai.Client(api_key=api_key)
-
-        prompt = """Generate a hand-drawn portrait illustration in black and red pen on notebook paper, inspired by doodle art and comic annotations. Keep full likeness of the subject, expressive lines, spontaneous gestures, bold outline glow, handwritten notes around, realistic pen stroke textur,"""
-
-        # Prepare the config (reusable for both models)
-        generate_config = types.GenerateContentConfig(
-            response_modalities=["IMAGE"],
-            image_config=types.ImageConfig(aspect_ratio=aspect_ratio),
-            safety_settings=[
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
-                    threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-                ),
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
-                    threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-                ),
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-                    threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-                ),
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_HARASSMENT,
-                    threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-                ),
-            ],
+
+def encode_output(img: Image.Image, options: OutputOptions) -> bytes:
+    """
+    Encode a finished image as requested by options
+    """
+    if options.format == "PNG":
+        if options.quantize:
+            img = quantize_image(img, options.quantize, options.colors)
+        level = options.compress_level
+        return encode_image(img, "PNG", compress_level=OUTPUT_PNG_COMPRESS_LEVEL if level is None else level)
+    if options.format == "WEBP":
+        return encode_image(
+            img,
+            "WEBP",
+            quality=options.quality or OUTPUT_WEBP_QUALITY,
+            method=OUTPUT_WEBP_METHOD,
         )
+    return encode_image(img, "JPEG", quality=options.quality or OUTPUT_JPEG_QUALITY)
 
-        # Try primary model first, fallback to secondary on 429
-        response = None
-        model_used = "gemini-3-pro-image-preview"
-        
-        try:
-            logger.info("Sending request to Gemini API (using gemini-3-pro-image-preview)...")
-            response = client.models.generate_content(
-                model="gemini-3-pro-image-preview",
-                contents=[image_pil, prompt],
-                config=generate_config,
-            )
-            logger.info("Received response from Gemini API (gemini-3-pro-image-preview)")
-        except Exception as e:
-            # Check if it's a 429 rate limit error
-            error_str = str(e).lower()
-            status_code = None
-            
-            # Try to extract status code from exception
-            if hasattr(e, 'status_code'):
-                status_code = e.status_code
-            elif hasattr(e, 'response') and hasattr(e.response, 'status_code'):
-                status_code = e.response.status_code
-            elif '429' in error_str or 'rate limit' in error_str or 'too many requests' in error_str:
-                status_code = 429
-            
-            if status_code == 429:
-                logger.warning("Rate limit (429) encountered with gemini-3-pro-image-preview, falling back to gemini-2.5-flash-image")
-                try:
-                    response = client.models.generate_content(
-                        model="gemini-2.5-flash-image",
-                        contents=[image_pil, prompt],
-                        config=generate_config,
-                    )
-                    model_used = "gemini-2.5-flash-image"
-                    logger.info("Received response from Gemini API (gemini-2.5-flash-image fallback)")
-                except Exception as fallback_error:
-                    logger.error(f"Fallback model also failed: {fallback_error}")
-                    raise HTTPException(
-                        status_code=503,
-                        detail="Service temporarily unavailable due to rate limits. Please try again later."
-                    )
-            else:
-                # Re-raise if it's not a 429 error
-                logger.error(f"Error calling Gemini API: {e}")
-                raise
 
-        if response is None:
-            logger.error("No response received from Gemini API")
-            raise HTTPException(
-                status_code=500,
-                detail="Failed to get response from image generation service."
-            )
+def finish_image(img: Image.Image, options: OutputOptions = None) -> bytes:
+    """
+    Crop (if requested), watermark and encode an output image
+    """
+    options = options or OutputOptions()
+    with timed_stage("watermark"):
+        if options.crop and "A" in img.getbands():
+            # Drop fully transparent padding around a cutout
+            bbox = img.getchannel("A").getbbox()
+            if bbox and bbox != (0, 0, *img.size):
+                img = img.crop(bbox)
+        img = add_watermark(img)
+    with timed_stage("encode"):
+        return encode_output(img, options)
+
+
+def watermark_image_bytes(image_data: bytes, options: OutputOptions = None) -> bytes:
+    """
+    Decode an image, watermark it and encode it once as options request
+    """
+    with timed_stage("decode"):
+        img = Image.open(io.BytesIO(image_data))
+        img.load()
+    return finish_image(img, options)
 
-        generated_image_bytes = None
 
-        if response.parts:
-            for part in response.parts:
-                if part.inline_data:
-                    img = part.as_image()
+def response_has_image(response) -> bool:
+    """
+    Whether a Gemini response contains inline image data
+    """
+    return any(part.inline_data for part in response.parts or [])
 
-                    # Save to a temporary file
-                    with tempfile.NamedTemporaryFile(
-                        suffix=".png", delete=False
-                    ) as tmp_file:
-                        tmp_path = tmp_file.name
 
-                    img.save(tmp_path)
+async def watermarked_image_from_response(response, options: OutputOptions = None):
+    """
+    Watermark the first inline image of a Gemini response and encode it (PNG
+    unless options say otherwise), off the event loop.
+    Returns None when the response contains no image.
+    """
+    if response.parts:
+        for part in response.parts:
+            if part.inline_data:
+                return await asyncio.to_thread(
+                    watermark_image_bytes, part.inline_data.data, options
+                )
+    return None
 
-                    # Add watermark in-place
-                    add_watermark(tmp_path)
 
-                    # Read back the watermarked image
-                    with open(tmp_path, "rb") as f:
-                        generated_image_bytes = f.read()
+class RembgSessionRegistry:
+    """
+    Process-wide cache of rembg ONNX sessions keyed by model name.
+    Sessions are loaded once, evicted least-recently-used when more than
+    max_sessions models are resident, and unloaded after idle_timeout seconds
+    without use so small instances get their memory back.
+    """
 
-                    # Clean up the temporary file
-                    os.remove(tmp_path)
-                    break
+    def __init__(self, max_sessions: int = 1, idle_timeout: float = 600.0):
+        self.max_sessions = max(1, max_sessions)
+        self.idle_timeout = idle_timeout
+        self._sessions = OrderedDict()  # model_name -> (session, last_used)
+        self._lock = threading.Lock()
+        self._reaper = None
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+        self.idle_unloads = 0
+
+    def get(self, model_name: str = "u2net"):
+        with self._lock:
+            entry = self._sessions.get(model_name)
+            if entry is not None:
+                self._sessions[model_name] = (entry[0], time.monotonic())
+                self._sessions.move_to_end(model_name)
+                self.hits += 1
+                return entry[0]
+
+            # Loading under the lock keeps concurrent callers from building the
+            # same ONNX graph twice
+            logger.info(f"Loading rembg session for model: {model_name}")
+            started = time.monotonic()
+            session = new_session(model_name)
+            self.loads += 1
+            logger.info(
+                f"Loaded rembg session {model_name} in {time.monotonic() - started:.2f}s"
+            )
 
-        if not generated_image_bytes:
-            # Check if there was a text refusal or safety issue
-            text_response = ""
-            if response.parts:
-                for part in response.parts:
-                    if part.text:
-                        text_response += part.text
+            self._sessions[model_name] = (session, time.monotonic())
+            while len(self._sessions) > self.max_sessions:
+                evicted, _ = self._sessions.popitem(last=False)
+                self.evictions += 1
+                logger.info(f"Evicted rembg session for model: {evicted}")
+
+            self._start_reaper()
+            return session
+
+    def unload_idle(self) -> None:
+        if self.idle_timeout <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for model_name, (_, last_used) in list(self._sessions.items()):
+                if now - last_used >= self.idle_timeout:
+                    del self._sessions[model_name]
+                    self.idle_unloads += 1
+                    logger.info(f"Unloaded idle rembg session for model: {model_name}")
+
+    def _start_reaper(self) -> None:
+        if self.idle_timeout <= 0 or self._reaper is not None:
+            return
+
+        def reap():
+            while True:
+                time.sleep(max(1.0, self.idle_timeout / 2))
+                self.unload_idle()
+
+        self._reaper = threading.Thread(
+            target=reap, name="rembg-session-reaper", daemon=True
+        )
+        self._reaper.start()
+
+    def stats(self) -> dict:
+        with self._lock:
+            loaded = list(self._sessions.keys())
+        return {
+            "loaded_models": loaded,
+            "loads": self.loads,
+            "hits": self.hits,
+            "evictions": self.evictions,
+            "idle_unloads": self.idle_unloads,
+            "max_sessions": self.max_sessions,
+            "idle_timeout": self.idle_timeout,
+        }
 
-            logger.warning(f"No image generated. Text response: {text_response}")
 
-            if text_response:
-                raise HTTPException(
-                    status_code=400, detail=f"Generation failed: {text_response}"
-                )
-            else:
-                raise HTTPException(
-                    status_code=500,
-                    detail="Failed to generate image. The model might have blocked the request due to safety filters.",
-                )
+REMBG_MODEL = os.getenv("REMBG_MODEL", "u2net")
+
+rembg_sessions = RembgSessionRegistry(
+    max_sessions=int(os.getenv("REMBG_MAX_SESSIONS", "1")),
+    idle_timeout=float(os.getenv("REMBG_IDLE_TIMEOUT", "600")),
+)
 
-        logger.info(f"Hand-drawn portrait successful using {model_used}, returning image.")
-        return Response(content=generated_image_bytes, media_type="image/png")
 
-    except HTTPException as he:
-        logger.error(f"HTTP Exception in hand-drawn portrait: {he.detail}")
-        raise he
-    except Exception as e:
-        logger.error(f"Unexpected error in hand-drawn portrait: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+class PoolSaturatedError(Exception):
+    """Raised when the image work pool has no free worker or queue slot"""
 
+    def __init__(self, retry_after: int):
+        super().__init__("Image processing queue is full")
+        self.retry_after = retry_after
 
-@app.post("/api/face-swap")
-async def face_swap(
-    source_image: UploadFile = File(...), target_image: UploadFile = File(...)
-):
+
+def _run_in_worker(fn, *args):
+    """
+    Executes fn inside a pool process and reports the worker's rembg session
+    counters and stage timings back so the parent can expose them
+    """
+    global _relayed_stages
+    _relayed_stages = []
     try:
-        logger.info(
-            f"Processing face swap request. Source: {source_image.filename}, Target: {target_image.filename}"
-        )
+        result = fn(*args)
+        return result, os.getpid(), rembg_sessions.stats(), _relayed_stages
+    finally:
+        _relayed_stages = None
 
-        # Read images as bytes
-        source_bytes = await source_image.read()
-        target_bytes = await target_image.read()
 
-        # Check for Replicate API key
-        replicate_api_key = os.getenv("REPLICATE_API_TOKEN")
-        if not replicate_api_key:
-            logger.error("REPLICATE_API_TOKEN not set")
-            raise HTTPException(status_code=500, detail="REPLICATE_API_TOKEN not set")
-
-        # Set Replicate API token
-        os.environ["REPLICATE_API_TOKEN"] = replicate_api_key
-
-        logger.info("Sending request to Replicate API for Face Swap...")
-
-        # Prepare image inputs as file-like objects (BytesIO)
-        # Reset to beginning in case BytesIO was read before
-        source_file = io.BytesIO(source_bytes)
-        target_file = io.BytesIO(target_bytes)
-        source_file.seek(0)
-        target_file.seek(0)
-
-        # Run the Replicate model
-        # swap_image = source face (face to be copied)
-        # input_image = target image (image to receive the face)
-        output = replicate.run(
-            "cdingram/face-swap:d1d6ea8c8be89d664a07a457526f7128109dee7030fdac424788d762c71ed111",
-            input={
-                "swap_image": source_file,
-                "input_image": target_file,
-            },
-        )
+class ImageWorkPool:
+    """
+    Bounded process pool for CPU-bound image work (rembg inference, watermarking)
+    so it never runs on the uvicorn event loop. At most max_workers jobs run and
+    queue_depth more may wait; anything beyond that is rejected immediately with
+    PoolSaturatedError instead of queueing until the proxy times out.
+    """
 
-        logger.info("Received response from Replicate API")
+    def __init__(self, max_workers: int = 1, queue_depth: int = 4, retry_after: int = 5):
+        self.max_workers = max(1, max_workers)
+        self.queue_depth = max(0, queue_depth)
+        self.retry_after = retry_after
+        self._executor = None
+        self._pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.worker_sessions = {}  # worker pid -> last reported rembg session stats
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # Spawn rather than fork: forking a process that already holds
+            # onnxruntime/uvicorn threads can deadlock the child
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
 
-        # Save output to temporary file
-        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as tmp_file:
-            tmp_path = tmp_file.name
-            tmp_file.write(output.read())
+    async def run(self, fn, *args):
+        if self._pending >= self.max_workers + self.queue_depth:
+            self.rejected += 1
+            raise PoolSaturatedError(self.retry_after)
 
-        # Add watermark in-place
-        add_watermark(tmp_path)
+        self._pending += 1
+        IMAGE_POOL_IN_FLIGHT.inc()
+        try:
+            loop = asyncio.get_running_loop()
+            result, pid, session_stats, stages = await loop.run_in_executor(
+                self._get_executor(), _run_in_worker, fn, *args
+            )
+        except BrokenProcessPool:
+            # A worker died (usually OOM); start a fresh pool for the next request
+            logger.error("Image work pool is broken, recreating it")
+            self.shutdown()
+            raise
+        finally:
+            self._pending -= 1
+            IMAGE_POOL_IN_FLIGHT.dec()
+
+        self.completed += 1
+        self.worker_sessions[pid] = session_stats
+        for stage, seconds in stages:
+            record_stage(stage, seconds)
+        return result
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "queue_depth": self.queue_depth,
+            "pending": self._pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "worker_sessions": self.worker_sessions,
+        }
 
-        # Read back the watermarked image
-        with open(tmp_path, "rb") as f:
-            watermarked_image_bytes = f.read()
 
-        # Clean up temporary file
-        os.remove(tmp_path)
+image_pool = ImageWorkPool(
+    max_workers=int(os.getenv("IMAGE_POOL_WORKERS", "1")),
+    queue_depth=int(os.getenv("IMAGE_POOL_QUEUE_DEPTH", "4")),
+    retry_after=int(os.getenv("IMAGE_POOL_RETRY_AFTER", "5")),
+)
 
-        logger.info("Face swap successful, returning image.")
-        return Response(content=watermarked_image_bytes, media_type="image/jpeg")
 
-    except HTTPException as he:
-        logger.error(f"HTTP Exception in face swap: {he.detail}")
-        raise he
+def pool_saturated_exception(e: PoolSaturatedError) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Server is busy processing other images. Please try again shortly.",
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+
+# Largest image accepted for decoding, in pixels. Pillow only warns at its own
+# limit, so the warning is made an error and covers every decode in the process
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", "50000000"))
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+warnings.simplefilter("error", Image.DecompressionBombWarning)
+
+# Working memory per decoded pixel: the decoded RGBA frame plus the copies
+# made while orienting, resizing, cutting out and watermarking it
+MEMORY_BYTES_PER_PIXEL = int(os.getenv("MEMORY_BYTES_PER_PIXEL", "12"))
+
+
+class MemoryBudgetExceeded(Exception):
+    """Raised when image memory stays reserved for longer than a caller may wait"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Image memory budget is exhausted")
+        self.retry_after = retry_after
+
+
+class MemoryBudget:
+    """
+    Per-process budget for the memory held by in-flight image decodes.
+    Callers reserve their estimated footprint before decoding; when the budget
+    is spent they wait first-come first-served for up to max_wait seconds, and
+    once queue_depth callers are waiting new ones are rejected immediately.
+    A single reservation larger than the whole budget runs on its own.
+    """
+
+    def __init__(
+        self, limit_bytes: int, queue_depth: int = 8, max_wait: float = 10.0, retry_after: int = 5
+    ):
+        self.limit_bytes = max(1, limit_bytes)
+        self.queue_depth = max(0, queue_depth)
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.in_use = 0
+        self.peak = 0
+        self._waiters = deque()  # (nbytes, future) in arrival order
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def _take(self, nbytes: int) -> None:
+        self.in_use += nbytes
+        MEMORY_BUDGET_IN_USE.inc(nbytes)
+        self.peak = max(self.peak, self.in_use)
+        self.admitted += 1
+
+    def _wake(self) -> None:
+        # Strict FIFO: a large head waiter is not starved by smaller ones
+        while self._waiters:
+            nbytes, future = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+            if self.in_use + nbytes > self.limit_bytes:
+                break
+            self._waiters.popleft()
+            self._take(nbytes)
+            future.set_result(None)
+
+    async def _wait(self, nbytes: int) -> None:
+        if len(self._waiters) >= self.queue_depth:
+            self.rejected += 1
+            raise MemoryBudgetExceeded(self.retry_after)
+
+        self.queued += 1
+        entry = (nbytes, asyncio.get_running_loop().create_future())
+        self._waiters.append(entry)
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(entry[1], self.max_wait)
+            note_timing("memory_wait", time.perf_counter() - started)
+        except BaseException as e:
+            if entry in self._waiters:
+                self._waiters.remove(entry)
+            if entry[1].done() and not entry[1].cancelled():
+                # Admitted just as the wait ended; hand the bytes back
+                self.in_use -= nbytes
+                MEMORY_BUDGET_IN_USE.dec(nbytes)
+            self._wake()
+            if isinstance(e, asyncio.TimeoutError):
+                self.timeouts += 1
+                raise MemoryBudgetExceeded(self.retry_after)
+            raise
+
+    @asynccontextmanager
+    async def reserve(self, nbytes: int):
+        nbytes = min(nbytes, self.limit_bytes)
+        if self._waiters or self.in_use + nbytes > self.limit_bytes:
+            await self._wait(nbytes)
+        else:
+            self._take(nbytes)
+        try:
+            yield
+        finally:
+            self.in_use -= nbytes
+            MEMORY_BUDGET_IN_USE.dec(nbytes)
+            self._wake()
+
+    def stats(self) -> dict:
+        return {
+            "limit_mb": round(self.limit_bytes / 1024 / 1024, 1),
+            "in_use_mb": round(self.in_use / 1024 / 1024, 1),
+            "peak_mb": round(self.peak / 1024 / 1024, 1),
+            "waiting": len(self._waiters),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+        }
+
+
+memory_budget = MemoryBudget(
+    limit_bytes=int(os.getenv("MEMORY_BUDGET_MB", "1024")) * 1024 * 1024,
+    queue_depth=int(os.getenv("MEMORY_QUEUE_DEPTH", "8")),
+    max_wait=float(os.getenv("MEMORY_MAX_WAIT", "10")),
+    retry_after=int(os.getenv("MEMORY_RETRY_AFTER", "5")),
+)
+
+
+def image_footprint(data: bytes) -> int:
+    """
+    Estimated working memory for decoding and processing an image, read from
+    its header only. Raises a 413 for images over MAX_IMAGE_PIXELS and a 400
+    for unreadable ones.
+    """
+    try:
+        width, height = Image.open(io.BytesIO(data)).size
+    except (Image.DecompressionBombError, Image.DecompressionBombWarning):
+        width, height = MAX_IMAGE_PIXELS + 1, 1
     except Exception as e:
-        logger.error(f"Unexpected error in face swap: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise HTTPException(status_code=400, detail=f"Invalid image file: {e}")
 
+    if width * height > MAX_IMAGE_PIXELS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image is too large. The maximum is {MAX_IMAGE_PIXELS // 1_000_000} megapixels.",
+        )
+    return width * height * MEMORY_BYTES_PER_PIXEL + len(data)
 
-@app.post("/api/celebrity-selfie")
-async def celebrity_selfie(
-    source_image: UploadFile = File(...),
-    target_image: UploadFile = File(...),
-    custom_prompt: str = Form(""),
-):
+
+@asynccontextmanager
+async def admit_images(*uploads: bytes):
     """
-    Celebrity Selfie endpoint - uses same face-swap logic
-    User uploads their photo (source) and celebrity photo (target)
-    Optional custom_prompt for specific instructions
+    Hold memory_budget for decoding uploads, waiting while other requests'
+    decodes use it up; a 503 with Retry-After when the wait runs out
     """
+    footprint = sum(image_footprint(data) for data in uploads)
     try:
-        logger.info(
-            f"Processing celebrity selfie request. User: {source_image.filename}, Celebrity: {target_image.filename}, Custom prompt: {custom_prompt}"
+        async with memory_budget.reserve(footprint):
+            yield
+    except MemoryBudgetExceeded as e:
+        logger.warning(f"Rejected {footprint // 1024 // 1024}MB image decode - memory budget is full")
+        raise HTTPException(
+            status_code=503,
+            detail="Server is busy processing other images. Please try again shortly.",
+            headers={"Retry-After": str(e.retry_after)},
         )
 
-        # Read images
-        source_bytes = await source_image.read()
-        target_bytes = await target_image.read()
 
-        source_pil = Image.open(io.BytesIO(source_bytes))
-        target_pil = Image.open(io.BytesIO(target_bytes))
-
-        # Calculate aspect ratio of target image to match output
-        width, height = target_pil.size
-        aspect_ratio_map = {
-            (1, 1): "1:1",
-            (2, 3): "2:3",
-            (3, 2): "3:2",
-            (3, 4): "3:4",
-            (4, 3): "4:3",
-            (4, 5): "4:5",
-            (5, 4): "5:4",
-            (9, 16): "9:16",
-            (16, 9): "16:9",
-            (21, 9): "21:9",
+class MicroBatcher:
+    """
+    Groups calls that arrive within max_wait seconds into a single batch_fn call
+    of up to max_batch_size items, then hands each caller its own result.
+    batch_fn receives a list of items and must return a list of results in the
+    same order.
+    """
+
+    def __init__(self, batch_fn, max_batch_size: int = 4, max_wait: float = 0.01):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self._pending = []  # (item, future)
+        self._timer = None
+        self._tasks = set()
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.max_wait, self._flush
+            )
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch = self._pending[: self.max_batch_size]
+        self._pending = self._pending[self.max_batch_size :]
+        if self._pending:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.max_wait, self._flush
+            )
+        if not batch:
+            return
+
+        self.batches += 1
+        self.items += len(batch)
+        task = asyncio.ensure_future(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch) -> None:
+        try:
+            results = await self.batch_fn([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0,
         }
 
-        # Find closest aspect ratio
-        def gcd(a, b):
-            while b:
-                a, b = b, a % b
-            return a
 
-        divisor = gcd(width, height)
-        ratio_w = width // divisor
-        ratio_h = height // divisor
+def _parse_limits(value: str) -> dict:
+    """
+    Parse "name=limit,name=limit" into a dict
+    """
+    limits = {}
+    for item in value.split(","):
+        if "=" in item:
+            model, limit = item.split("=", 1)
+            limits[model.strip()] = int(limit)
+    return limits
+
+
+GEMINI_MAX_CONNECTIONS = int(os.getenv("GEMINI_MAX_CONNECTIONS", "20"))
+GEMINI_MAX_KEEPALIVE = int(os.getenv("GEMINI_MAX_KEEPALIVE", "10"))
+# Give up before nginx's 300s proxy_read_timeout does
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "280"))
+GEMINI_DEFAULT_CONCURRENCY = int(os.getenv("GEMINI_DEFAULT_CONCURRENCY", "8"))
+GEMINI_MODEL_CONCURRENCY = _parse_limits(os.getenv("GEMINI_MODEL_CONCURRENCY", ""))
+# Alternative Gemini API endpoint, e.g. the stand-in used by benchmarks/load_test.py
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL") or None
 
-        # Try to find exact match or closest
-        aspect_ratio = "1:1"  # default
-        if (ratio_w, ratio_h) in aspect_ratio_map:
-            aspect_ratio = aspect_ratio_map[(ratio_w, ratio_h)]
-        else:
-            # Find closest based on ratio value
-            target_ratio = width / height
-            closest_key = min(
-                aspect_ratio_map.keys(), key=lambda k: abs((k[0] / k[1]) - target_ratio)
-            )
-            aspect_ratio = aspect_ratio_map[closest_key]
+_genai_client = None
+_model_semaphores = {}
+_model_waiting = {}
 
-        logger.info(f"Detected aspect ratio for celebrity image: {aspect_ratio}")
 
+def get_genai_client() -> genai.Client:
+    """
+    Process-wide Gemini client so TLS connections are pooled and reused
+    across requests instead of being rebuilt per call
+    """
+    global _genai_client
+    if _genai_client is None:
         api_key = os.getenv("GOOGLE_API_KEY")
         if not api_key:
             logger.error("GOOGLE_API_KEY not set")
             raise HTTPException(status_code=500, detail="GOOGLE_API_KEY not set")
 
-        client = genai.Client(api_key=api_key)
+        _genai_client = genai.Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(
+                base_url=GEMINI_BASE_URL,
+                timeout=int(GEMINI_TIMEOUT * 1000),
+                async_client_args={
+                    "limits": httpx.Limits(
+                        max_connections=GEMINI_MAX_CONNECTIONS,
+                        max_keepalive_connections=GEMINI_MAX_KEEPALIVE,
+                    )
+                },
+            ),
+        )
+    return _genai_client
+
 
-        # Base prompt
-        prompt = """Selfie Task:
-Analyze the user's selfie photo (FIRST IMAGE) and the celebrity image (SECOND IMAGE).
-The goal is to generate a new image where the user and the celebrity appear to be taking a selfie together, seamlessly integrated into the user's original environment.
-Here's how to achieve it:
-Extract and Isolate: Isolate the user from their background in the FIRST IMAGE and the celebrity from their background in the SECOND IMAGE.
-Environmental Alignment: The celebrity must be inserted naturally and realistically into the user's original environment (background, lighting, composition) from the FIRST IMAGE.
-Pose and Placement: Position the celebrity alongside the user, as if they are both genuinely in the same photo. The celebrity should be facing the camera, with appropriate perspective and scale relative to the user.
-Seamless Integration: Adjust the celebrity's lighting, shadows, skin tones, and overall aesthetic to perfectly match the lighting conditions, time of day, and ambient light of the user's selfie environment. The integration must be so flawless that it appears they were always together in the original shot.
-Realistic Interaction: Ensure the poses and expressions suggest a natural, spontaneous selfie moment.
-High Photo-realism: The final image must be of extremely high quality, realistic, and completely believable, with no visible seams, artifacts, or inconsistencies that betray the composite nature. It should look like an authentic, single photograph taken at that moment.
-Match Camera Angle and Focal Length: Ensure the perspective, focal length, and general camera characteristics of the celebrity image align with those of the user's selfie
+def _model_semaphore(model: str) -> asyncio.Semaphore:
+    if model not in _model_semaphores:
+        _model_semaphores[model] = asyncio.Semaphore(
+            GEMINI_MODEL_CONCURRENCY.get(model, GEMINI_DEFAULT_CONCURRENCY)
+        )
+        _model_waiting[model] = 0
+    return _model_semaphores[model]
 
-NOTE:
-- DO NOT ALTER THE USER'S SELFIE PHOTO IN ANY WAY. VERY IMPORTANT.
-        """
 
-        prompt = (
-            prompt
-            + f"""
-        Additional User Instructions while adding the celebrity to the selfie:
-        {custom_prompt}
+async def _acquire_model_slot(model: str) -> asyncio.Semaphore:
+    semaphore = _model_semaphore(model)
+    if not semaphore.locked():
+        await semaphore.acquire()
+        return semaphore
+
+    started = time.perf_counter()
+    _model_waiting[model] += 1
+    try:
+        await semaphore.acquire()
+    finally:
+        _model_waiting[model] -= 1
+        note_timing("upstream_queue", time.perf_counter() - started, model)
+    return semaphore
+
+
+async def generate_content(model: str, contents, config=None):
+    """
+    Call Gemini through the shared async client without blocking the event loop.
+    At most GEMINI_MODEL_CONCURRENCY[model] calls per model run at once on this
+    worker; the rest wait their turn.
+    """
+    client = get_genai_client()
+    semaphore = await _acquire_model_slot(model)
+    try:
+        with upstream_call(model):
+            return await client.aio.models.generate_content(
+                model=model, contents=contents, config=config
+            )
+    finally:
+        semaphore.release()
+
+
+async def generate_content_stream(model: str, contents, config=None):
+    """
+    Streaming variant of generate_content: yields response chunks as Gemini
+    produces them, holding the model's concurrency slot until the stream ends
+    """
+    client = get_genai_client()
+    semaphore = await _acquire_model_slot(model)
+    try:
+        with upstream_call(model):
+            stream = await client.aio.models.generate_content_stream(
+                model=model, contents=contents, config=config
+            )
+            async for chunk in stream:
+                yield chunk
+    finally:
+        semaphore.release()
+
+
+def gemini_stats() -> dict:
+    return {
+        "client_ready": _genai_client is not None,
+        "max_connections": GEMINI_MAX_CONNECTIONS,
+        "models": {
+            model: {
+                "limit": GEMINI_MODEL_CONCURRENCY.get(model, GEMINI_DEFAULT_CONCURRENCY),
+                "available": semaphore._value,
+                "waiting": _model_waiting[model],
+            }
+            for model, semaphore in _model_semaphores.items()
+        },
+    }
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    """
+    Whether an upstream exception is a 429 / quota error
+    """
+    # Try to extract status code from exception
+    if hasattr(e, "status_code"):
+        return e.status_code == 429
+    if hasattr(e, "response") and hasattr(e.response, "status_code"):
+        return e.response.status_code == 429
+    if hasattr(e, "code") and isinstance(e.code, int):
+        return e.code == 429
+
+    error_str = str(e).lower()
+    return "429" in error_str or "rate limit" in error_str or "too many requests" in error_str
+
+
+class ModelRouter:
+    """
+    Routes generation requests between a primary and a fallback model with a
+    circuit breaker on the primary's rate limits.
+
+    closed:    traffic goes to the primary; a 429 falls back for that request
+    open:      after failure_threshold 429s within window seconds, traffic goes
+               straight to the fallback for cooldown seconds
+    half_open: after the cooldown one probe request at a time tries the
+               primary; a success closes the breaker, a 429 re-opens it
+
+    With hedging enabled, a primary call that is still running after the
+    hedge_percentile of recent primary latencies gets a parallel fallback call;
+    the first image wins and the other call is cancelled. At most
+    hedge_max_ratio of primary calls may be hedged.
+    """
+
+    def __init__(
+        self,
+        primary: str,
+        fallback: str,
+        failure_threshold: int = 3,
+        window: float = 60.0,
+        cooldown: float = 120.0,
+        hedge_enabled: bool = False,
+        hedge_percentile: float = 95.0,
+        hedge_max_ratio: float = 0.1,
+        hedge_min_samples: int = 20,
+        hedge_default_delay: float = 60.0,
+    ):
+        self.primary = primary
+        self.fallback = fallback
+        self.failure_threshold = max(1, failure_threshold)
+        self.window = window
+        self.cooldown = cooldown
+        self.state = "closed"
+        self._rate_limits = deque()  # monotonic timestamps of recent primary 429s
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.hedge_enabled = hedge_enabled
+        self.hedge_percentile = hedge_percentile
+        self.hedge_max_ratio = hedge_max_ratio
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_default_delay = hedge_default_delay
+        self._primary_latencies = deque(maxlen=500)
+        self.counters = {
+            "primary_calls": 0,
+            "fallback_calls": 0,
+            "rate_limited": 0,
+            "short_circuited": 0,
+            "probes": 0,
+            "opened": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "hedge_losses": 0,
+            "hedges_over_budget": 0,
+        }
+
+    def _route(self) -> str:
         """
-        )
+        Pick the model for the next call: "primary", "probe" or "fallback"
+        """
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.cooldown:
+                return "fallback"
+            self.state = "half_open"
+            logger.info(f"Circuit breaker for {self.primary} half-open, probing primary")
+
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                return "fallback"
+            self._probe_in_flight = True
+            return "probe"
+
+        return "primary"
+
+    def _record_success(self, route: str) -> None:
+        if route == "probe":
+            self.state = "closed"
+            self._rate_limits.clear()
+            logger.info(f"Circuit breaker for {self.primary} closed, primary recovered")
+
+    def _record_rate_limit(self, route: str) -> None:
+        now = time.monotonic()
+        self.counters["rate_limited"] += 1
+        self._rate_limits.append(now)
+        while self._rate_limits and now - self._rate_limits[0] > self.window:
+            self._rate_limits.popleft()
+
+        if route == "probe" or len(self._rate_limits) >= self.failure_threshold:
+            if self.state != "open":
+                self.counters["opened"] += 1
+                logger.warning(
+                    f"Circuit breaker for {self.primary} opened for {self.cooldown:.0f}s, routing to {self.fallback}"
+                )
+            self.state = "open"
+            self._opened_at = now
 
-        # Prepare the config (reusable for both models)
-        generate_config = types.GenerateContentConfig(
-            response_modalities=["IMAGE"],
-            image_config=types.ImageConfig(aspect_ratio=aspect_ratio),
-            safety_settings=[
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_HARASSMENT,
-                    threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-                ),
-                # Sometimes face swaps trigger "Sexually Explicit" falsely due to skin exposure
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-                    threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-                ),
-            ],
-        )
+    def hedge_delay(self) -> float:
+        """
+        Seconds to wait on the primary before hedging
+        """
+        if len(self._primary_latencies) < self.hedge_min_samples:
+            return self.hedge_default_delay
+        ordered = sorted(self._primary_latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))
+        return ordered[index]
 
-        # Try primary model first, fallback to secondary on 429
-        response = None
-        model_used = "gemini-3-pro-image-preview"
-        
+    async def _call_primary(self, route: str, contents, config, label: str):
+        """
+        Returns the primary's response, or None when it was rate limited
+        """
         try:
-            logger.info("Sending request to Gemini API for Celebrity Selfie (using gemini-3-pro-image-preview)...")
-            response = client.models.generate_content(
-                model="gemini-3-pro-image-preview",
-                contents=[source_pil, target_pil, prompt],
-                config=generate_config,
+            logger.info(f"Sending request to Gemini API for {label} (using {self.primary})...")
+            started = time.monotonic()
+            response = await generate_content(
+                model=self.primary, contents=contents, config=config
             )
-            logger.info("Received response from Gemini API (gemini-3-pro-image-preview)")
+            self._primary_latencies.append(time.monotonic() - started)
+            logger.info(f"Received response from Gemini API ({self.primary})")
+        except asyncio.CancelledError:
+            # A primary that lost the hedge race would have taken at least
+            # this long; leaving it out would let the percentile drift down.
+            # Earlier cancellations (client gone) say nothing about the tail.
+            elapsed = time.monotonic() - started
+            if elapsed >= self.hedge_delay():
+                self._primary_latencies.append(elapsed)
+            raise
         except Exception as e:
-            # Check if it's a 429 rate limit error
-            error_str = str(e).lower()
-            status_code = None
-            
-            # Try to extract status code from exception
-            if hasattr(e, 'status_code'):
-                status_code = e.status_code
-            elif hasattr(e, 'response') and hasattr(e.response, 'status_code'):
-                status_code = e.response.status_code
-            elif '429' in error_str or 'rate limit' in error_str or 'too many requests' in error_str:
-                status_code = 429
-            
-            if status_code == 429:
-                logger.warning("Rate limit (429) encountered with gemini-3-pro-image-preview, falling back to gemini-2.5-flash-image")
-                try:
-                    response = client.models.generate_content(
-                        model="gemini-2.5-flash-image",
-                        contents=[source_pil, target_pil, prompt],
-                        config=generate_config,
-                    )
-                    model_used = "gemini-2.5-flash-image"
-                    logger.info("Received response from Gemini API (gemini-2.5-flash-image fallback)")
-                except Exception as fallback_error:
-                    logger.error(f"Fallback model also failed: {fallback_error}")
-                    raise HTTPException(
-                        status_code=503,
-                        detail="Service temporarily unavailable due to rate limits. Please try again later."
-                    )
-            else:
+            if not is_rate_limit_error(e):
                 # Re-raise if it's not a 429 error
                 logger.error(f"Error calling Gemini API: {e}")
                 raise
+            self._record_rate_limit(route)
+            logger.warning(
+                f"Rate limit (429) encountered with {self.primary}, falling back to {self.fallback}"
+            )
+            return None
+        finally:
+            # Also runs on cancellation so a dropped client cannot leave the
+            # breaker waiting on a probe forever
+            if route == "probe":
+                self._probe_in_flight = False
+
+        self._record_success(route)
+        return response
+
+    async def _call_fallback(self, contents, config, reason: str):
+        self.counters["fallback_calls"] += 1
+        MODEL_FALLBACKS.labels(self.fallback, reason).inc()
+        response = await generate_content(
+            model=self.fallback, contents=contents, config=config
+        )
+        logger.info(f"Received response from Gemini API ({self.fallback} fallback)")
+        return response
 
-        if response is None:
-            logger.error("No response received from Gemini API")
-            raise HTTPException(
-                status_code=500,
-                detail="Failed to get response from image generation service."
+    async def _hedged(self, primary, contents, config, label: str):
+        """
+        Waits on the primary call, racing it against the fallback once it is
+        slower than the hedge delay
+        Returns:
+            (response, model_used); response is None when the primary was
+            rate limited before a hedge was started
+        """
+        done, _ = await asyncio.wait({primary}, timeout=self.hedge_delay())
+        if done:
+            return await primary, self.primary
+
+        if self.counters["hedges"] >= self.hedge_max_ratio * self.counters["primary_calls"]:
+            self.counters["hedges_over_budget"] += 1
+            return await primary, self.primary
+
+        self.counters["hedges"] += 1
+        logger.info(f"{label} request to {self.primary} is slow, hedging with {self.fallback}")
+        hedge = asyncio.ensure_future(self._call_fallback(contents, config, "hedge"))
+
+        pending = {primary, hedge}
+        imageless = None  # a response that finished but carries no image
+        primary_error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    model = self.primary if task is primary else self.fallback
+                    if task.exception() is not None:
+                        if task is primary:
+                            primary_error = task.exception()
+                        else:
+                            logger.warning(f"Hedge request to {self.fallback} failed: {task.exception()}")
+                        continue
+
+                    response = task.result()
+                    if response is None:
+                        continue
+                    if response_has_image(response):
+                        counter = "hedge_losses" if task is primary else "hedge_wins"
+                        self.counters[counter] += 1
+                        return response, model
+                    imageless = imageless or (response, model)
+        finally:
+            primary.cancel()
+            hedge.cancel()
+
+        if imageless is not None:
+            return imageless
+        if primary_error is not None:
+            raise primary_error
+        # Primary was rate limited and the hedge (the fallback) failed too
+        raise self._unavailable()
+
+    async def generate(self, contents, config, label: str = "generation"):
+        """
+        Generate with the primary model, falling back on rate limits
+        Returns:
+            (response, model_used)
+        """
+        route = self._route()
+        reason = "circuit_open"
+
+        if route == "fallback":
+            self.counters["short_circuited"] += 1
+            logger.info(
+                f"Circuit breaker {self.state}, sending {label} request straight to {self.fallback}"
             )
+        else:
+            self.counters["primary_calls"] += 1
+            if route == "probe":
+                self.counters["probes"] += 1
 
-        generated_image_bytes = None
+            primary = asyncio.ensure_future(
+                self._call_primary(route, contents, config, label)
+            )
+            try:
+                if route == "primary" and self.hedge_enabled:
+                    response, model_used = await self._hedged(
+                        primary, contents, config, label
+                    )
+                else:
+                    response, model_used = await primary, self.primary
+            finally:
+                primary.cancel()
 
-        if response.parts:
-            for part in response.parts:
-                if part.inline_data:
-                    img = part.as_image()
+            if response is not None:
+                return response, model_used
+            reason = "rate_limited"
 
-                    # Save to a temporary file
-                    with tempfile.NamedTemporaryFile(
-                        suffix=".png", delete=False
-                    ) as tmp_file:
-                        tmp_path = tmp_file.name
+        try:
+            return await self._call_fallback(contents, config, reason), self.fallback
+        except Exception as fallback_error:
+            logger.error(f"Fallback model also failed: {fallback_error}")
+            raise self._unavailable()
+
+    def _unavailable(self) -> HTTPException:
+        return HTTPException(
+            status_code=503,
+            detail="Service temporarily unavailable due to rate limits. Please try again later.",
+        )
 
-                    img.save(tmp_path)
+    def stats(self) -> dict:
+        cooldown_remaining = 0.0
+        if self.state == "open":
+            cooldown_remaining = max(0.0, self.cooldown - (time.monotonic() - self._opened_at))
+        return {
+            "primary": self.primary,
+            "fallback": self.fallback,
+            "state": self.state,
+            "recent_rate_limits": len(self._rate_limits),
+            "cooldown_remaining": round(cooldown_remaining, 1),
+            "hedge_enabled": self.hedge_enabled,
+            "hedge_delay": round(self.hedge_delay(), 2),
+            **self.counters,
+        }
 
-                    # Add watermark in-place
-                    add_watermark(tmp_path)
 
-                    # Read back the watermarked image
-                    with open(tmp_path, "rb") as f:
-                        generated_image_bytes = f.read()
+image_model_router = ModelRouter(
+    primary="gemini-3-pro-image-preview",
+    fallback="gemini-2.5-flash-image",
+    failure_threshold=int(os.getenv("GEMINI_BREAKER_THRESHOLD", "3")),
+    window=float(os.getenv("GEMINI_BREAKER_WINDOW", "60")),
+    cooldown=float(os.getenv("GEMINI_BREAKER_COOLDOWN", "120")),
+    hedge_enabled=os.getenv("GEMINI_HEDGE_ENABLED", "false").lower() == "true",
+    hedge_percentile=float(os.getenv("GEMINI_HEDGE_PERCENTILE", "95")),
+    hedge_max_ratio=float(os.getenv("GEMINI_HEDGE_MAX_RATIO", "0.1")),
+    hedge_min_samples=int(os.getenv("GEMINI_HEDGE_MIN_SAMPLES", "20")),
+    hedge_default_delay=float(os.getenv("GEMINI_HEDGE_DEFAULT_DELAY", "60")),
+)
 
-                    os.remove(tmp_path)
-                    break
 
-        if not generated_image_bytes:
-            text_response = ""
-            if response.parts:
-                for part in response.parts:
-                    if part.text:
-                        text_response += part.text
+FACE_SWAP_MODEL = "cdingram/face-swap:d1d6ea8c8be89d664a07a457526f7128109dee7030fdac424788d762c71ed111"
+PODCAST_SCRIPT_MODEL = "gemini-2.5-flash"
+PODCAST_TTS_MODEL = "gemini-2.5-flash-preview-tts"
 
-            logger.warning(f"No image generated. Text response: {text_response}")
+# Model identities folded into result cache keys, so switching models never
+# serves output generated by the previous one
+IMAGE_MODELS_KEY = f"{image_model_router.primary}|{image_model_router.fallback}"
+PODCAST_MODELS_KEY = f"{PODCAST_SCRIPT_MODEL}|{PODCAST_TTS_MODEL}"
 
-            if text_response:
-                raise HTTPException(
-                    status_code=400, detail=f"Generation failed: {text_response}"
-                )
-            else:
-                raise HTTPException(
-                    status_code=500,
-                    detail="Failed to generate image. The model might have failed to process the request.",
-                )
 
-        logger.info(f"Celebrity selfie successful using {model_used}, returning image.")
-        return Response(content=generated_image_bytes, media_type="image/png")
+class ResultCache:
+    """
+    Size-capped on-disk LRU of finished endpoint outputs keyed by a content
+    hash. Entries are plain files in one directory so every uvicorn worker
+    shares them; recency is the file mtime (touched on every hit) and each
+    worker keeps an in-memory index of entry sizes that is reconciled with
+    the directory before evicting.
 
-    except HTTPException as he:
-        logger.error(f"HTTP Exception in celebrity selfie: {he.detail}")
-        raise he
-    except Exception as e:
-        logger.error(f"Unexpected error in celebrity selfie: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    File layout: one JSON metadata line, then the raw payload.
+    """
 
+    def __init__(self, directory: str, max_bytes: int, ttl: float, reconcile_interval: float = 60.0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.reconcile_interval = reconcile_interval
+        self._index = {}  # key -> entry size in bytes
+        self._last_reconcile = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expired = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        """
+        sha256 over length-prefixed parts (bytes or anything str()-able)
+        """
+        digest = hashlib.sha256()
+        for part in parts:
+            data = part if isinstance(part, bytes) else str(part).encode("utf-8")
+            digest.update(len(data).to_bytes(8, "big"))
+            digest.update(data)
+        return digest.hexdigest()
 
-@app.post("/api/hairstyle-grid")
-async def hairstyle_grid(source_image: UploadFile = File(...)):
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.bin")
+
+    def get(self, key: str):
+        """
+        Returns (payload, metadata) or None
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                meta = json.loads(f.readline())
+                payload = f.read()
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # Entries may carry their own shorter ttl (single-flight hand-offs)
+        ttl = meta.get("ttl", self.ttl)
+        if ttl > 0 and time.time() - meta["created_at"] > ttl:
+            self._remove(key)
+            with self._lock:
+                self.expired += 1
+                self.misses += 1
+            return None
+
+        try:
+            # Bump recency for the LRU shared with the other workers
+            os.utime(path)
+        except OSError:
+            pass
+
+        with self._lock:
+            self.hits += 1
+            self._index[key] = os.path.getsize(path) if os.path.exists(path) else 0
+        return payload, meta
+
+    def put(self, key: str, payload: bytes, meta: dict) -> None:
+        header = json.dumps({**meta, "created_at": time.time()}).encode("utf-8") + b"\n"
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            f.write(payload)
+        # Atomic rename so readers in other workers never see a partial entry
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self.stores += 1
+            self._index[key] = len(header) + len(payload)
+            over_budget = sum(self._index.values()) > self.max_bytes
+            stale = time.monotonic() - self._last_reconcile > self.reconcile_interval
+
+        if over_budget or stale:
+            self._reconcile()
+
+    def _remove(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+        with self._lock:
+            self._index.pop(key, None)
+
+    def _reconcile(self) -> None:
+        """
+        Rebuild the index from the directory (which includes other workers'
+        entries) and evict least-recently-used entries down to 90% of the cap
+        """
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".bin"):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+
+        entries.sort()
+        total = sum(size for _, _, size in entries)
+        target = self.max_bytes * 0.9 if total > self.max_bytes else total
+        evicted = 0
+        while entries and total > target:
+            _, key, size = entries.pop(0)
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            total -= size
+            evicted += 1
+
+        with self._lock:
+            self._index = {key: size for _, key, size in entries}
+            self._last_reconcile = time.monotonic()
+            self.evictions += evicted
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._index),
+                "bytes": sum(self._index.values()),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "expired": self.expired,
+            }
+
+
+CACHE_ROOT = os.getenv(
+    "CACHE_DIR", os.path.join(tempfile.gettempdir(), "toolkitai-cache")
+)
+RESULT_CACHE_TOOLS = {
+    tool.strip() for tool in os.getenv("RESULT_CACHE_TOOLS", "*").split(",") if tool.strip()
+}
+
+result_cache = ResultCache(
+    directory=os.path.join(CACHE_ROOT, "results"),
+    max_bytes=int(float(os.getenv("RESULT_CACHE_MAX_MB", "512")) * 1024 * 1024),
+    ttl=float(os.getenv("RESULT_CACHE_TTL", "86400")),
+)
+
+
+# Never result-cached: podcasts are grounded in current search results, so
+# only their scripts are reused, through the shorter-lived podcast script cache
+RESULT_CACHE_EXCLUDED_TOOLS = {"podcast-creator"}
+
+
+def result_cache_enabled(tool: str) -> bool:
+    return (
+        result_cache.max_bytes > 0
+        and tool not in RESULT_CACHE_EXCLUDED_TOOLS
+        and ("*" in RESULT_CACHE_TOOLS or tool in RESULT_CACHE_TOOLS)
+    )
+
+
+class SingleFlight:
     """
-    Hairstyle Grid endpoint - generates a 3x3 grid with 9 different hairstyles
-    User uploads their photo and gets back a grid showing them with different hairstyles
+    Coalesces concurrent identical requests onto a single upstream call.
+    Within a worker, callers share one task. Across workers, an flock on
+    <directory>/<key>.lock marks the leader; the other worker waits for the
+    lock to be released and then reads the leader's output from the result
+    cache, only producing it itself if the leader failed.
     """
-    try:
-        logger.info(
-            f"Processing hairstyle grid request. User photo: {source_image.filename}"
-        )
 
-        # Read image
-        source_bytes = await source_image.read()
-        source_pil = Image.open(io.BytesIO(source_bytes))
+    def __init__(self, directory: str, wait_timeout: float, poll_interval: float = 0.25):
+        self.directory = directory
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.tasks = {}  # key -> asyncio.Task shared by local callers
+        self._last_sweep = time.monotonic()
+        self.leaders = 0
+        self.coalesced_local = 0
+        self.coalesced_remote = 0
+        self.lock_timeouts = 0
+        os.makedirs(directory, exist_ok=True)
+
+    async def acquire(self, key: str):
+        """
+        Take the cross-worker lock for key without blocking the event loop
+        Returns:
+            (fd, waited); fd is None if the wait timed out
+        """
+        path = os.path.join(self.directory, f"{key}.lock")
+        fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o644)
+        deadline = time.monotonic() + self.wait_timeout
+        waited = False
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if not self._is_current(fd, path):
+                    # Swept while we waited; lock the file that replaced it
+                    os.close(fd)
+                    fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o644)
+                    continue
+                # Marks the lock as in use for _sweep
+                os.utime(fd)
+                return fd, waited
+            except BlockingIOError:
+                if time.monotonic() > deadline:
+                    os.close(fd)
+                    self.lock_timeouts += 1
+                    return None, waited
+                waited = True
+                await asyncio.sleep(self.poll_interval)
+
+    def release(self, fd) -> None:
+        if fd is None:
+            return
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+        if time.monotonic() - self._last_sweep > 600:
+            self._sweep()
+
+    @staticmethod
+    def _is_current(fd, path: str) -> bool:
+        """
+        Whether fd is still the lock file at path, i.e. it was not swept
+        """
+        try:
+            return os.path.samestat(os.fstat(fd), os.stat(path))
+        except FileNotFoundError:
+            return False
+
+    def _sweep(self) -> None:
+        """
+        Delete lock files nobody has used for a while. A file is only removed
+        while this worker holds its lock, so a current leader's lock is never
+        deleted from under it; waiters that opened a removed file notice in
+        acquire() and retry on the new one.
+        """
+        self._last_sweep = time.monotonic()
+        cutoff = time.time() - 2 * self.wait_timeout
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                try:
+                    if entry.stat().st_mtime >= cutoff:
+                        continue
+                    fd = os.open(entry.path, os.O_RDWR)
+                except OSError:
+                    continue
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    if self._is_current(fd, entry.path):
+                        os.remove(entry.path)
+                except OSError:
+                    # BlockingIOError: held by a leader right now
+                    pass
+                finally:
+                    os.close(fd)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self.tasks),
+            "leaders": self.leaders,
+            "coalesced_local": self.coalesced_local,
+            "coalesced_remote": self.coalesced_remote,
+            "lock_timeouts": self.lock_timeouts,
+        }
 
-        # For a 3x3 grid, use 1:1 aspect ratio (square)
-        aspect_ratio = "1:1"
 
-        logger.info(f"Using aspect ratio: {aspect_ratio} for 3x3 grid")
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+# How long a finished result stays readable for coalesced requests when the
+# tool's result caching is disabled
+SINGLE_FLIGHT_RESULT_TTL = float(os.getenv("SINGLE_FLIGHT_RESULT_TTL", "60"))
 
-        api_key = os.getenv("GOOGLE_API_KEY")
-        if not api_key:
-            logger.error("GOOGLE_API_KEY not set")
-            raise HTTPException(status_code=500, detail="GOOGLE_API_KEY not set")
+single_flight = SingleFlight(
+    directory=os.path.join(CACHE_ROOT, "flights"),
+    wait_timeout=GEMINI_TIMEOUT + 30,
+)
 
-        client = genai.Client(api_key=api_key)
+# Headers that are recomputed for every response rather than replayed
+_UNCACHED_HEADERS = {"content-length", "content-type", "x-cache"}
 
-        # Prompt for generating 3x3 hairstyle grid
-        prompt = """Hairstyle Grid Task:
-Analyze the uploaded photo (FIRST IMAGE) of a person.
-Generate a 3x3 grid image showing the same person with 9 different hairstyles.
 
-Requirements:
-1. The grid must be exactly 3 rows by 3 columns (9 total images).
-2. Each cell in the grid should show the person with a DIFFERENT hairstyle.
-3. Keep the person's face, facial features, expression, pose, clothing, and background EXACTLY the same across all 9 variations. ONLY change the hairstyle.
-4. The hairstyles should be diverse and include:
-   - Short styles (buzz cut, crew cut, short textured)
-   - Medium styles (parted, slicked back, wavy, curly)
-   - Long styles (straight long, wavy long, braided/cornrows, top knot/man bun)
-   - Various textures (straight, wavy, curly, braided)
-5. Ensure high photorealism - each hairstyle should look natural and realistic.
-6. Maintain consistent lighting, shadows, and perspective across all 9 images.
-7. The grid should be perfectly aligned with equal spacing between cells.
-8. Each hairstyle should be clearly visible and distinct from the others.
-9. The person's identity and all other features must remain identical - only the hair changes.
+def _cached_response(payload: bytes, meta: dict, source: str) -> Response:
+    headers = dict(meta.get("headers", {}))
+    headers["X-Cache"] = source
+    return Response(content=payload, media_type=meta["media_type"], headers=headers)
 
-Output: A single image containing a 3x3 grid with 9 different hairstyle variations of the same person.
-"""
 
-        # Prepare the config (reusable for both models)
-        generate_config = types.GenerateContentConfig(
-            response_modalities=["IMAGE"],
-            image_config=types.ImageConfig(aspect_ratio=aspect_ratio),
-            safety_settings=[
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_HARASSMENT,
-                    threshold=types.HarmBlockThreshold.OFF,
-                ),
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-                    threshold=types.HarmBlockThreshold.OFF,
-                ),
-            ],
-        )
+async def _produce_and_store(tool: str, key: str, produce, caching: bool):
+    """
+    Run produce() and store a successful response under key
+    Returns:
+        (payload, meta)
+    """
+    response = await produce()
+    meta = {
+        "tool": tool,
+        "media_type": response.media_type,
+        "headers": {
+            name: value
+            for name, value in response.headers.items()
+            if name not in _UNCACHED_HEADERS
+        },
+    }
+    if response.status_code == 200:
+        if not caching:
+            # Only kept long enough for coalesced requests in other workers
+            meta["ttl"] = SINGLE_FLIGHT_RESULT_TTL
+        await asyncio.to_thread(result_cache.put, key, response.body, meta)
+    return response.body, meta
+
+
+async def _lead_flight(tool: str, key: str, produce, caching: bool):
+    """
+    Produce the output for key while holding the cross-worker lock
+    Returns:
+        (payload, meta, source)
+    """
+    fd, waited = await single_flight.acquire(key)
+    try:
+        if waited:
+            # Another worker ran the same request; use its output if it succeeded
+            cached = await asyncio.to_thread(result_cache.get, key)
+            if cached is not None:
+                single_flight.coalesced_remote += 1
+                logger.info(f"Coalesced {tool} request with another worker's in-flight call")
+                return cached[0], cached[1], "COALESCED"
+
+        single_flight.leaders += 1
+        payload, meta = await _produce_and_store(tool, key, produce, caching)
+        return payload, meta, "MISS"
+    finally:
+        single_flight.release(fd)
+
+
+async def cached_result(tool: str, key_parts: list, produce) -> Response:
+    """
+    Serve a tool's output from the result cache, or run produce() and cache
+    the response it returns. Concurrent identical requests, in this worker
+    or the other ones, share a single produce() call. Tools call this through
+    a _cached_<tool> helper, so an endpoint and its job build the same key.
+    Args:
+        tool: Tool name, used for per-tool enablement (RESULT_CACHE_TOOLS)
+        key_parts: Model identity, prompt fields and input bytes for the key
+        produce: Coroutine function returning the endpoint's Response
+    """
+    caching = result_cache_enabled(tool)
+    if not caching and not SINGLE_FLIGHT_ENABLED:
+        return await produce()
+
+    # Hashing a large upload is too slow to do on the event loop
+    started = time.perf_counter()
+    key = await asyncio.to_thread(ResultCache.make_key, tool, *key_parts)
+
+    if caching:
+        cached = await asyncio.to_thread(result_cache.get, key)
+        note_timing("cache", time.perf_counter() - started, "hit" if cached else "miss")
+        if cached is not None:
+            logger.info(f"Result cache hit for {tool}, returning cached output")
+            return _cached_response(cached[0], cached[1], "HIT")
+
+    if not SINGLE_FLIGHT_ENABLED:
+        payload, meta = await _produce_and_store(tool, key, produce, caching)
+        return _cached_response(payload, meta, "MISS")
+
+    task = single_flight.tasks.get(key)
+    coalesced = task is not None
+    if coalesced:
+        single_flight.coalesced_local += 1
+        logger.info(f"Coalesced {tool} request with an identical in-flight request")
+    else:
+        # Detached from the caller so a disconnecting leader does not cancel
+        # the upstream call the other waiters depend on
+        task = asyncio.ensure_future(_lead_flight(tool, key, produce, caching))
+        single_flight.tasks[key] = task
+        task.add_done_callback(lambda _: single_flight.tasks.pop(key, None))
+
+    payload, meta, source = await asyncio.shield(task)
+    return _cached_response(payload, meta, "COALESCED" if coalesced else source)
+
+
+class RequestProfiler:
+    """
+    Opt-in cProfile capture of single requests. A request is profiled when its
+    X-Profile-Token header matches token and it wins a sample_rate draw; at
+    most one request per worker is profiled at a time. The profile covers all
+    event-loop work while the request runs (other requests' coroutines
+    included) but not threads or image pool workers, which Server-Timing
+    covers. Profiles are written to directory as <profile id>.prof, for
+    python -m pstats or snakeviz, and only the newest keep are retained.
+    """
 
-        # Try primary model first, fallback to secondary on 429
-        response = None
-        model_used = "gemini-3-pro-image-preview"
-        
+    def __init__(self, directory: str, token: str, sample_rate: float = 1.0, keep: int = 100):
+        self.directory = directory
+        self.token = token
+        self.sample_rate = sample_rate
+        self.keep = max(1, keep)
+        self._profile = None
+        self._saving = set()  # dump tasks, referenced until they finish
+        self.captured = 0
+        self.skipped = 0
+
+    def start(self, scope) -> str:
+        """
+        Start profiling the request if it asked to be; returns its profile id
+        """
+        if not self.token:
+            return None
+        provided = dict(scope["headers"]).get(b"x-profile-token")
+        if provided is None or not hmac.compare_digest(provided, self.token.encode()):
+            return None
+        if self._profile is not None or random.random() >= self.sample_rate:
+            self.skipped += 1
+            return None
+
+        slug = re.sub(r"[^A-Za-z0-9-]+", "_", scope["path"].strip("/"))[:60]
+        profile_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{slug}-{uuid.uuid4().hex[:8]}"
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        return profile_id
+
+    def finish(self, profile_id: str) -> None:
+        """
+        Stop profiling and save the profile in the background
+        """
+        profile, self._profile = self._profile, None
+        profile.disable()
+        task = asyncio.ensure_future(asyncio.to_thread(self._save, profile, profile_id))
+        self._saving.add(task)
+        task.add_done_callback(self._saving.discard)
+
+    def _save(self, profile: cProfile.Profile, profile_id: str) -> None:
         try:
-            logger.info("Sending request to Gemini API for Hairstyle Grid (using gemini-3-pro-image-preview)...")
-            response = client.models.generate_content(
-                model="gemini-3-pro-image-preview",
-                contents=[source_pil, prompt],
-                config=generate_config,
+            os.makedirs(self.directory, exist_ok=True)
+            profile.dump_stats(os.path.join(self.directory, f"{profile_id}.prof"))
+            self.captured += 1
+            logger.info(f"Saved request profile {profile_id}")
+
+            saved = sorted(
+                entry for entry in os.listdir(self.directory) if entry.endswith(".prof")
             )
-            logger.info("Received response from Gemini API (gemini-3-pro-image-preview)")
-        except Exception as e:
-            # Check if it's a 429 rate limit error
-            error_str = str(e).lower()
-            status_code = None
-            
-            # Try to extract status code from exception
-            if hasattr(e, 'status_code'):
-                status_code = e.status_code
-            elif hasattr(e, 'response') and hasattr(e.response, 'status_code'):
-                status_code = e.response.status_code
-            elif '429' in error_str or 'rate limit' in error_str or 'too many requests' in error_str:
-                status_code = 429
-            
-            if status_code == 429:
-                logger.warning("Rate limit (429) encountered with gemini-3-pro-image-preview, falling back to gemini-2.5-flash-image")
-                try:
-                    response = client.models.generate_content(
-                        model="gemini-2.5-flash-image",
-                        contents=[source_pil, prompt],
-                        config=generate_config,
-                    )
-                    model_used = "gemini-2.5-flash-image"
-                    logger.info("Received response from Gemini API (gemini-2.5-flash-image fallback)")
-                except Exception as fallback_error:
-                    logger.error(f"Fallback model also failed: {fallback_error}")
-                    raise HTTPException(
-                        status_code=503,
-                        detail="Service temporarily unavailable due to rate limits. Please try again later."
-                    )
-            else:
-                # Re-raise if it's not a 429 error
-                logger.error(f"Error calling Gemini API: {e}")
-                raise
+            for entry in saved[: -self.keep]:
+                os.remove(os.path.join(self.directory, entry))
+        except OSError as e:
+            logger.warning(f"Could not save request profile {profile_id}: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "enabled": bool(self.token),
+            "sample_rate": self.sample_rate,
+            "captured": self.captured,
+            "skipped": self.skipped,
+        }
+
+
+request_profiler = RequestProfiler(
+    directory=os.getenv("PROFILE_DIR", os.path.join(CACHE_ROOT, "profiles")),
+    token=os.getenv("PROFILE_TOKEN", ""),
+    sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", "1.0")),
+    keep=int(os.getenv("PROFILE_KEEP", "100")),
+)
+
+
+app = FastAPI(title="ToolkitAI API")
+
+# Get allowed origins from environment variable
+allowed_origins = os.getenv(
+    "ALLOWED_ORIGINS", "http://localhost:3000,http://localhost:3001"
+).split(",")
+
+# Add authentication middleware (before CORS)
+app.add_middleware(AuthMiddleware)
+
+# Configure CORS
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=allowed_origins,
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# Outermost, so rejected and failed requests are measured too
+app.add_middleware(MetricsMiddleware)
+
+
+@app.get("/")
+def read_root():
+    logger.info("Root endpoint accessed")
+    return {"status": "online", "message": "ToolkitAI Backend is running"}
+
+
+@app.on_event("startup")
+async def start_job_store():
+    await asyncio.to_thread(job_store.init)
+
+
+@app.on_event("shutdown")
+async def shutdown_workers():
+    image_pool.shutdown()
+    if _genai_client is not None:
+        await _genai_client.aio.aclose()
+    if _proxy_client is not None:
+        await _proxy_client.aclose()
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+@app.get("/metrics")
+def metrics():
+    """
+    Prometheus metrics; merged across workers when PROMETHEUS_MULTIPROC_DIR
+    is set (not exposed through nginx)
+    """
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/api/stats")
+def runtime_stats():
+    """
+    Internal runtime counters for this worker (not exposed through nginx)
+    """
+    return {
+        "pid": os.getpid(),
+        "rembg_sessions": rembg_sessions.stats(),
+        "image_pool": image_pool.stats(),
+        "memory_budget": memory_budget.stats(),
+        "bg_removal_batcher": bg_removal_batcher.stats(),
+        "gemini": gemini_stats(),
+        "image_model_router": image_model_router.stats(),
+        "result_cache": result_cache.stats(),
+        "podcast_script_cache": podcast_script_cache.stats(),
+        "proxy_cache": proxy_cache.stats(),
+        "single_flight": single_flight.stats(),
+        "jobs": job_runner.stats(),
+        "request_profiler": request_profiler.stats(),
+    }
+
+
+def _bg_removal_job(image_data: bytes, options: OutputOptions = None) -> bytes:
+    """
+    Background removal + watermark, executed inside an image pool worker
+    """
+    # Remove background using the process-wide rembg session; passing a PIL
+    # image keeps the cutout in memory so it is encoded only once
+    session = rembg_sessions.get(REMBG_MODEL)
+    with timed_stage("decode"):
+        img = Image.open(io.BytesIO(image_data))
+        img.load()
+    with timed_stage("rembg_inference"):
+        cutout = remove(img, session=session)
+    return finish_image(cutout, options)
+
+
+# rembg models whose predict() is the plain single-output U2Net head, so their
+# forward pass can be run for several images at once
+BATCHABLE_REMBG_MODELS = {"u2net", "u2netp", "u2net_human_seg", "silueta"}
+
+
+def _u2net_masks(session, images: list) -> list:
+    """
+    Computes U2Net masks for several images, using a single ONNX run when the
+    graph has a dynamic batch dimension
+    """
+    feeds = [
+        session.normalize(
+            img, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)
+        )
+        for img in images
+    ]
+    input_name = next(iter(feeds[0]))
+
+    batch_dim = session.inner_session.get_inputs()[0].shape[0]
+    if isinstance(batch_dim, int):
+        # Graph was exported with a fixed batch size, run images one by one
+        preds = np.concatenate(
+            [session.inner_session.run(None, feed)[0][:, 0] for feed in feeds]
+        )
+    else:
+        batch = np.concatenate([feed[input_name] for feed in feeds])
+        preds = session.inner_session.run(None, {input_name: batch})[0][:, 0]
+
+    masks = []
+    for img, pred in zip(images, preds):
+        # Same per-image normalisation as rembg's U2netSession.predict
+        ma = np.max(pred)
+        mi = np.min(pred)
+        pred = (pred - mi) / (ma - mi)
+        mask = Image.fromarray((pred * 255).astype("uint8"), mode="L")
+        masks.append(mask.resize(img.size, Image.LANCZOS))
+    return masks
+
+
+def _bg_removal_batch_job(items: list) -> list:
+    """
+    Background removal + watermark for a micro-batch of (upload, OutputOptions)
+    items, executed inside an image pool worker. Returns ("ok", image_bytes)
+    or ("error", message) per item so one bad upload does not fail the rest of
+    the batch.
+    """
+    if REMBG_MODEL not in BATCHABLE_REMBG_MODELS:
+        results = []
+        for image_data, options in items:
+            try:
+                results.append(("ok", _bg_removal_job(image_data, options)))
+            except Exception as e:
+                results.append(("error", str(e)))
+        return results
+
+    session = rembg_sessions.get(REMBG_MODEL)
+    results = [None] * len(items)
+    decoded = []
+    for index, (image_data, _) in enumerate(items):
+        try:
+            with timed_stage("decode"):
+                img = fix_image_orientation(Image.open(io.BytesIO(image_data)))
+                img.load()
+            decoded.append((index, img))
+        except Exception as e:
+            results[index] = ("error", str(e))
+
+    if decoded:
+        with timed_stage("rembg_inference"):
+            masks = _u2net_masks(session, [img for _, img in decoded])
+        for (index, img), mask in zip(decoded, masks):
+            try:
+                cutout = naive_cutout(img, mask)
+                results[index] = ("ok", finish_image(cutout, items[index][1]))
+            except Exception as e:
+                results[index] = ("error", str(e))
+
+    return results
+
+
+bg_removal_batcher = MicroBatcher(
+    lambda items: image_pool.run(_bg_removal_batch_job, items),
+    max_batch_size=int(os.getenv("BG_BATCH_MAX_SIZE", "1")),
+    max_wait=float(os.getenv("BG_BATCH_MAX_WAIT_MS", "10")) / 1000,
+)
+
+
+async def _bg_removal(image_data: bytes, options: OutputOptions = None) -> Response:
+    options = options or OutputOptions()
+    # Run inference and watermarking off the event loop, micro-batched with
+    # other concurrent uploads when BG_BATCH_MAX_SIZE > 1
+    async with admit_images(image_data):
+        if bg_removal_batcher.max_batch_size > 1:
+            status, payload = await bg_removal_batcher.submit((image_data, options))
+            if status != "ok":
+                raise ValueError(payload)
+            watermarked_data = payload
+        else:
+            watermarked_data = await image_pool.run(_bg_removal_job, image_data, options)
+
+    logger.info("Background removal successful with watermark")
+    return Response(content=watermarked_data, media_type=options.media_type)
+
+
+@app.post("/api/bg-removal")
+async def bg_removal(
+    file: UploadFile = File(...),
+    options: OutputOptions = Depends(output_options("PNG")),
+):
+    """
+    Remove the background. Query parameters select the output encoding:
+    format (png|webp|jpeg), quality, compress_level, crop (trim transparent
+    padding), quantize (fast|best palette) and colors.
+    """
+    try:
+        logger.info(f"Processing background removal for file: {file.filename}")
+        # Read the image file
+        image_data = await file.read()
+
+        return await cached_result(
+            "bg-removal",
+            [REMBG_MODEL, options.cache_key(), image_data],
+            lambda: _bg_removal(image_data, options),
+        )
+    except PoolSaturatedError as e:
+        logger.warning("Background removal rejected - image pool queue is full")
+        raise pool_saturated_exception(e)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in background removal: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def displayed_size(img: Image.Image) -> tuple:
+    """
+    Image size after EXIF orientation is applied, read from the header only
+    """
+    if img.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+        return img.size[::-1]
+    return img.size
+
+
+def decode_oriented(img: Image.Image, target: tuple) -> Image.Image:
+    """
+    Decode an opened (not yet loaded) image straight to target, its displayed
+    size after EXIF orientation. JPEGs are decoded at reduced scale via
+    draft(), and resize() uses reducing_gap so large downscales start with a
+    cheap integer reduce.
+    """
+    if img.format == "JPEG":
+        rotated = displayed_size(img) != img.size
+        img.draft(img.mode, target[::-1] if rotated else target)
+
+    img = ImageOps.exif_transpose(img)
+    if img.size != target:
+        img = img.resize(target, Image.LANCZOS, reducing_gap=3.0)
+    return img
+
+
+# Uploads are scaled down to this long edge before they are sent to Gemini or
+# Replicate; the models work well below phone-camera resolution
+UPLOAD_MAX_EDGE = int(os.getenv("UPLOAD_MAX_EDGE", "1536"))
+UPLOAD_TOOL_MAX_EDGE = _parse_limits(os.getenv("UPLOAD_TOOL_MAX_EDGE", ""))
+UPLOAD_JPEG_QUALITY = int(os.getenv("UPLOAD_JPEG_QUALITY", "90"))
+# Formats sent unchanged when they need no resize or rotation
+UPLOAD_PASSTHROUGH_FORMATS = {"JPEG", "PNG", "WEBP"}
+
+
+class PreparedUpload:
+    """
+    Encoded upload ready to send upstream, with its MIME type and displayed size
+    """
+
+    __slots__ = ("data", "mime_type", "size")
+
+    def __init__(self, data: bytes, mime_type: str, size: tuple):
+        self.data = data
+        self.mime_type = mime_type
+        self.size = size
+
+    def part(self) -> types.Part:
+        # Inline bytes go to Gemini as-is; a PIL image would be re-encoded by the SDK
+        return types.Part.from_bytes(data=self.data, mime_type=self.mime_type)
+
+
+def prepare_upload(data: bytes, max_edge: int) -> PreparedUpload:
+    """
+    Cap an upload's long edge at max_edge, apply its EXIF orientation and
+    re-encode it compactly (JPEG, or PNG when it has transparency). Uploads
+    that already fit are passed through untouched; only their header is read.
+    """
+    try:
+        img = Image.open(io.BytesIO(data))
+        width, height = displayed_size(img)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid image file: {e}")
+
+    rotated = img.getexif().get(0x0112, 1) != 1
+    if max(width, height) <= max_edge and not rotated and img.format in UPLOAD_PASSTHROUGH_FORMATS:
+        return PreparedUpload(data, Image.MIME[img.format], (width, height))
+
+    scale = min(1.0, max_edge / max(width, height))
+    img = decode_oriented(img, (max(1, round(width * scale)), max(1, round(height * scale))))
+
+    buffer = io.BytesIO()
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        img.save(buffer, "PNG")
+        mime_type = "image/png"
+    else:
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.save(buffer, "JPEG", quality=UPLOAD_JPEG_QUALITY)
+        mime_type = "image/jpeg"
+    return PreparedUpload(buffer.getvalue(), mime_type, img.size)
+
+
+def _timed_prepare_upload(data: bytes, max_edge: int) -> PreparedUpload:
+    with timed_stage("upload_prepare"):
+        return prepare_upload(data, max_edge)
+
+
+async def prepare_uploads(tool: str, *uploads: bytes) -> list:
+    """
+    prepare_upload for each of a tool's uploads, off the event loop, using the
+    tool's UPLOAD_TOOL_MAX_EDGE (or UPLOAD_MAX_EDGE)
+    """
+    max_edge = UPLOAD_TOOL_MAX_EDGE.get(tool, UPLOAD_MAX_EDGE)
+    async with admit_images(*uploads):
+        prepared = await asyncio.gather(
+            *[asyncio.to_thread(_timed_prepare_upload, data, max_edge) for data in uploads]
+        )
+    before = sum(map(len, uploads))
+    after = sum(len(upload.data) for upload in prepared)
+    if before != after:
+        logger.info(f"Prepared {tool} uploads: {before} -> {after} bytes")
+    return prepared
+
+
+# Aspect ratios the Gemini image models can produce
+ASPECT_RATIOS = {
+    (1, 1): "1:1",
+    (2, 3): "2:3",
+    (3, 2): "3:2",
+    (3, 4): "3:4",
+    (4, 3): "4:3",
+    (4, 5): "4:5",
+    (5, 4): "5:4",
+    (9, 16): "9:16",
+    (16, 9): "16:9",
+    (21, 9): "21:9",
+}
+
+
+def closest_aspect_ratio(width: int, height: int) -> str:
+    """
+    Gemini aspect ratio matching an image exactly, or the closest one
+    """
+    divisor = math.gcd(width, height)
+    ratio = (width // divisor, height // divisor)
+    if ratio in ASPECT_RATIOS:
+        return ASPECT_RATIOS[ratio]
+
+    target_ratio = width / height
+    closest_key = min(ASPECT_RATIOS, key=lambda k: abs((k[0] / k[1]) - target_ratio))
+    return ASPECT_RATIOS[closest_key]
+
+
+async def _virtual_try_on(person_bytes: bytes, garment_bytes: bytes, options: OutputOptions = None) -> Response:
+    options = options or OutputOptions()
+    person, garment = await prepare_uploads("virtual-try-on", person_bytes, garment_bytes)
+
+    # Calculate aspect ratio of person image to match output
+    aspect_ratio = closest_aspect_ratio(*person.size)
+    logger.info(f"Detected aspect ratio for person image: {aspect_ratio}")
+
+    prompt = """Virtual Try-On Task:
+        1. Analyze the first image (person) and the second image (garment).
+        2. If there are multiple people in the first image, apply the garment to the person who is the center of attraction or most prominent.
+        3. If there is NO person in the first image, do NOT generate any image output.
+        4. Generate a new image of the person from the first image wearing the garment from the second image.
+        5. CRITICAL: Keep the person's identity, pose, body shape, and the original background EXACTLY as they are in the first image.
+        6. Do NOT modify the person's face, hair, or the background.
+        7. Apply the garment naturally to the person's body, adjusting for fit, lighting, and shadows to match the original scene.
+        8. Ensure high photorealism.
+        9. Do not process any undergarment or inappropriate content requests.
+        """
+
+    # Prepare the config (reusable for both models)
+    generate_config = types.GenerateContentConfig(
+        response_modalities=["IMAGE"],
+        image_config=types.ImageConfig(aspect_ratio=aspect_ratio),
+        safety_settings=[
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+                threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+            ),
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+                threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+            ),
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+                threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+            ),
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_HARASSMENT,
+                threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+            ),
+        ],
+    )
+
+    # Primary model first; the router falls back (or skips straight to the
+    # fallback while its circuit breaker is open) on rate limits
+    response, model_used = await image_model_router.generate(
+        contents=[person.part(), garment.part(), prompt],
+        config=generate_config,
+        label="Virtual Try-On",
+    )
+
+    generated_image_bytes = await watermarked_image_from_response(response, options)
+
+    if not generated_image_bytes:
+        # Check if there was a text refusal or safety issue
+        text_response = ""
+        if response.parts:
+            for part in response.parts:
+                if part.text:
+                    text_response += part.text
+
+        logger.warning(f"No image generated. Text response: {text_response}")
+
+        if text_response:
+            raise HTTPException(
+                status_code=400, detail=f"Generation failed: {text_response}"
+            )
+        else:
+            raise HTTPException(
+                status_code=500,
+                detail="Failed to generate image. The model might have blocked the request due to safety filters.",
+            )
+
+    logger.info(f"Virtual try-on successful using {model_used}, returning image.")
+    return Response(content=generated_image_bytes, media_type=options.media_type)
+
+
+def _cached_virtual_try_on(person_bytes: bytes, garment_bytes: bytes, options: OutputOptions):
+    return cached_result(
+        "virtual-try-on",
+        [IMAGE_MODELS_KEY, options.cache_key(), person_bytes, garment_bytes],
+        lambda: _virtual_try_on(person_bytes, garment_bytes, options),
+    )
+
+
+@app.post("/api/virtual-try-on")
+async def virtual_try_on(
+    person_image: UploadFile = File(...),
+    garment_image: UploadFile = File(...),
+    options: OutputOptions = Depends(output_options("PNG")),
+):
+    try:
+        logger.info(
+            f"Processing virtual try-on request. Person: {person_image.filename}, Garment: {garment_image.filename}"
+        )
+
+        # Read images
+        person_bytes = await person_image.read()
+        garment_bytes = await garment_image.read()
+
+        return await _cached_virtual_try_on(person_bytes, garment_bytes, options)
+
+    except HTTPException as he:
+        logger.error(f"HTTP Exception in virtual try-on: {he.detail}")
+        raise he
+    except Exception as e:
+        logger.error(f"Unexpected error in virtual try-on: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def _hand_drawn_portrait(image_bytes: bytes, options: OutputOptions = None) -> Response:
+    options = options or OutputOptions()
+    (image,) = await prepare_uploads("hand-drawn-portrait", image_bytes)
+
+    # Calculate aspect ratio of input image to match output
+    aspect_ratio = closest_aspect_ratio(*image.size)
+    logger.info(f"Detected aspect ratio for input image: {aspect_ratio}")
+
+    prompt = """Generate a hand-drawn portrait illustration in black and red pen on notebook paper, inspired by doodle art and comic annotations. Keep full likeness of the subject, expressive lines, spontaneous gestures, bold outline glow, handwritten notes around, realistic pen stroke textur,"""
+
+    # Prepare the config (reusable for both models)
+    generate_config = types.GenerateContentConfig(
+        response_modalities=["IMAGE"],
+        image_config=types.ImageConfig(aspect_ratio=aspect_ratio),
+        safety_settings=[
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+                threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+            ),
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+                threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+            ),
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+                threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+            ),
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_HARASSMENT,
+                threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+            ),
+        ],
+    )
+
+    # Primary model first; the router falls back (or skips straight to the
+    # fallback while its circuit breaker is open) on rate limits
+    response, model_used = await image_model_router.generate(
+        contents=[image.part(), prompt],
+        config=generate_config,
+        label="Hand-Drawn Portrait",
+    )
+
+    generated_image_bytes = await watermarked_image_from_response(response, options)
+
+    if not generated_image_bytes:
+        # Check if there was a text refusal or safety issue
+        text_response = ""
+        if response.parts:
+            for part in response.parts:
+                if part.text:
+                    text_response += part.text
+
+        logger.warning(f"No image generated. Text response: {text_response}")
+
+        if text_response:
+            raise HTTPException(
+                status_code=400, detail=f"Generation failed: {text_response}"
+            )
+        else:
+            raise HTTPException(
+                status_code=500,
+                detail="Failed to generate image. The model might have blocked the request due to safety filters.",
+            )
+
+    logger.info(f"Hand-drawn portrait successful using {model_used}, returning image.")
+    return Response(content=generated_image_bytes, media_type=options.media_type)
+
+
+def _cached_hand_drawn_portrait(image_bytes: bytes, options: OutputOptions):
+    return cached_result(
+        "hand-drawn-portrait",
+        [IMAGE_MODELS_KEY, options.cache_key(), image_bytes],
+        lambda: _hand_drawn_portrait(image_bytes, options),
+    )
+
+
+@app.post("/api/hand-drawn-portrait")
+async def hand_drawn_portrait(
+    file: UploadFile = File(...),
+    options: OutputOptions = Depends(output_options("PNG")),
+):
+    try:
+        logger.info(f"Processing hand-drawn portrait request. Image: {file.filename}")
+
+        # Read image
+        image_bytes = await file.read()
+
+        return await _cached_hand_drawn_portrait(image_bytes, options)
+
+    except HTTPException as he:
+        logger.error(f"HTTP Exception in hand-drawn portrait: {he.detail}")
+        raise he
+    except Exception as e:
+        logger.error(f"Unexpected error in hand-drawn portrait: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def _face_swap(source_bytes: bytes, target_bytes: bytes, options: OutputOptions = None) -> Response:
+    options = options or OutputOptions("JPEG")
+    # Check for Replicate API key
+    replicate_api_key = os.getenv("REPLICATE_API_TOKEN")
+    if not replicate_api_key:
+        logger.error("REPLICATE_API_TOKEN not set")
+        raise HTTPException(status_code=500, detail="REPLICATE_API_TOKEN not set")
+
+    # Set Replicate API token
+    os.environ["REPLICATE_API_TOKEN"] = replicate_api_key
+
+    logger.info("Sending request to Replicate API for Face Swap...")
+
+    source, target = await prepare_uploads("face-swap", source_bytes, target_bytes)
+
+    # Prepare image inputs as file-like objects (BytesIO)
+    # Reset to beginning in case BytesIO was read before
+    source_file = io.BytesIO(source.data)
+    target_file = io.BytesIO(target.data)
+    source_file.seek(0)
+    target_file.seek(0)
+
+    # Run the Replicate model
+    # swap_image = source face (face to be copied)
+    # input_image = target image (image to receive the face)
+    # The Replicate client is blocking (the prediction poll and the output
+    # download), so both run in a thread to keep the event loop free
+    with upstream_call(FACE_SWAP_MODEL.split(":")[0]):
+        output = await asyncio.to_thread(
+            replicate.run,
+            FACE_SWAP_MODEL,
+            input={
+                "swap_image": source_file,
+                "input_image": target_file,
+            },
+        )
+        output_bytes = await asyncio.to_thread(output.read)
+
+    logger.info("Received response from Replicate API")
+
+    # Watermark in memory and re-encode once (JPEG unless options say otherwise)
+    watermarked_image_bytes = await asyncio.to_thread(watermark_image_bytes, output_bytes, options)
+
+    logger.info("Face swap successful, returning image.")
+    return Response(content=watermarked_image_bytes, media_type=options.media_type)
+
+
+def _cached_face_swap(source_bytes: bytes, target_bytes: bytes, options: OutputOptions):
+    return cached_result(
+        "face-swap",
+        [FACE_SWAP_MODEL, options.cache_key(), source_bytes, target_bytes],
+        lambda: _face_swap(source_bytes, target_bytes, options),
+    )
+
+
+@app.post("/api/face-swap")
+async def face_swap(
+    source_image: UploadFile = File(...),
+    target_image: UploadFile = File(...),
+    options: OutputOptions = Depends(output_options("JPEG")),
+):
+    try:
+        logger.info(
+            f"Processing face swap request. Source: {source_image.filename}, Target: {target_image.filename}"
+        )
+
+        # Read images as bytes
+        source_bytes = await source_image.read()
+        target_bytes = await target_image.read()
+
+        return await _cached_face_swap(source_bytes, target_bytes, options)
+
+    except HTTPException as he:
+        logger.error(f"HTTP Exception in face swap: {he.detail}")
+        raise he
+    except Exception as e:
+        logger.error(f"Unexpected error in face swap: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def _celebrity_selfie(source_bytes: bytes, target_bytes: bytes, custom_prompt: str, options: OutputOptions = None) -> Response:
+    options = options or OutputOptions()
+    source, target = await prepare_uploads("celebrity-selfie", source_bytes, target_bytes)
+
+    # Calculate aspect ratio of target image to match output
+    aspect_ratio = closest_aspect_ratio(*target.size)
+    logger.info(f"Detected aspect ratio for celebrity image: {aspect_ratio}")
+
+    # Base prompt
+    prompt = """Selfie Task:
+Analyze the user's selfie photo (FIRST IMAGE) and the celebrity image (SECOND IMAGE).
+The goal is to generate a new image where the user and the celebrity appear to be taking a selfie together, seamlessly integrated into the user's original environment.
+Here's how to achieve it:
+Extract and Isolate: Isolate the user from their background in the FIRST IMAGE and the celebrity from their background in the SECOND IMAGE.
+Environmental Alignment: The celebrity must be inserted naturally and realistically into the user's original environment (background, lighting, composition) from the FIRST IMAGE.
+Pose and Placement: Position the celebrity alongside the user, as if they are both genuinely in the same photo. The celebrity should be facing the camera, with appropriate perspective and scale relative to the user.
+Seamless Integration: Adjust the celebrity's lighting, shadows, skin tones, and overall aesthetic to perfectly match the lighting conditions, time of day, and ambient light of the user's selfie environment. The integration must be so flawless that it appears they were always together in the original shot.
+Realistic Interaction: Ensure the poses and expressions suggest a natural, spontaneous selfie moment.
+High Photo-realism: The final image must be of extremely high quality, realistic, and completely believable, with no visible seams, artifacts, or inconsistencies that betray the composite nature. It should look like an authentic, single photograph taken at that moment.
+Match Camera Angle and Focal Length: Ensure the perspective, focal length, and general camera characteristics of the celebrity image align with those of the user's selfie
+
+NOTE:
+- DO NOT ALTER THE USER'S SELFIE PHOTO IN ANY WAY. VERY IMPORTANT.
+        """
+
+    prompt = (
+        prompt
+        + f"""
+        Additional User Instructions while adding the celebrity to the selfie:
+        {custom_prompt}
+        """
+    )
+
+    # Prepare the config (reusable for both models)
+    generate_config = types.GenerateContentConfig(
+        response_modalities=["IMAGE"],
+        image_config=types.ImageConfig(aspect_ratio=aspect_ratio),
+        safety_settings=[
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_HARASSMENT,
+                threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+            ),
+            # Sometimes face swaps trigger "Sexually Explicit" falsely due to skin exposure
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+                threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+            ),
+        ],
+    )
+
+    # Primary model first; the router falls back (or skips straight to the
+    # fallback while its circuit breaker is open) on rate limits
+    response, model_used = await image_model_router.generate(
+        contents=[source.part(), target.part(), prompt],
+        config=generate_config,
+        label="Celebrity Selfie",
+    )
+
+    generated_image_bytes = await watermarked_image_from_response(response, options)
+
+    if not generated_image_bytes:
+        text_response = ""
+        if response.parts:
+            for part in response.parts:
+                if part.text:
+                    text_response += part.text
+
+        logger.warning(f"No image generated. Text response: {text_response}")
+
+        if text_response:
+            raise HTTPException(
+                status_code=400, detail=f"Generation failed: {text_response}"
+            )
+        else:
+            raise HTTPException(
+                status_code=500,
+                detail="Failed to generate image. The model might have failed to process the request.",
+            )
+
+    logger.info(f"Celebrity selfie successful using {model_used}, returning image.")
+    return Response(content=generated_image_bytes, media_type=options.media_type)
+
+
+def _cached_celebrity_selfie(
+    source_bytes: bytes, target_bytes: bytes, custom_prompt: str, options: OutputOptions
+):
+    return cached_result(
+        "celebrity-selfie",
+        [IMAGE_MODELS_KEY, options.cache_key(), custom_prompt, source_bytes, target_bytes],
+        lambda: _celebrity_selfie(source_bytes, target_bytes, custom_prompt, options),
+    )
+
+
+@app.post("/api/celebrity-selfie")
+async def celebrity_selfie(
+    source_image: UploadFile = File(...),
+    target_image: UploadFile = File(...),
+    custom_prompt: str = Form(""),
+    options: OutputOptions = Depends(output_options("PNG")),
+):
+    """
+    Celebrity Selfie endpoint - uses same face-swap logic
+    User uploads their photo (source) and celebrity photo (target)
+    Optional custom_prompt for specific instructions
+    """
+    try:
+        logger.info(
+            f"Processing celebrity selfie request. User: {source_image.filename}, Celebrity: {target_image.filename}, Custom prompt: {custom_prompt}"
+        )
+
+        # Read images
+        source_bytes = await source_image.read()
+        target_bytes = await target_image.read()
+
+        return await _cached_celebrity_selfie(source_bytes, target_bytes, custom_prompt, options)
+
+    except HTTPException as he:
+        logger.error(f"HTTP Exception in celebrity selfie: {he.detail}")
+        raise he
+    except Exception as e:
+        logger.error(f"Unexpected error in celebrity selfie: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def _hairstyle_grid(source_bytes: bytes, options: OutputOptions = None) -> Response:
+    options = options or OutputOptions()
+    (source,) = await prepare_uploads("hairstyle-grid", source_bytes)
+
+    # For a 3x3 grid, use 1:1 aspect ratio (square)
+    aspect_ratio = "1:1"
+
+    logger.info(f"Using aspect ratio: {aspect_ratio} for 3x3 grid")
+
+    # Prompt for generating 3x3 hairstyle grid
+    prompt = """Hairstyle Grid Task:
+Analyze the uploaded photo (FIRST IMAGE) of a person.
+Generate a 3x3 grid image showing the same person with 9 different hairstyles.
+
+Requirements:
+1. The grid must be exactly 3 rows by 3 columns (9 total images).
+2. Each cell in the grid should show the person with a DIFFERENT hairstyle.
+3. Keep the person's face, facial features, expression, pose, clothing, and background EXACTLY the same across all 9 variations. ONLY change the hairstyle.
+4. The hairstyles should be diverse and include:
+   - Short styles (buzz cut, crew cut, short textured)
+   - Medium styles (parted, slicked back, wavy, curly)
+   - Long styles (straight long, wavy long, braided/cornrows, top knot/man bun)
+   - Various textures (straight, wavy, curly, braided)
+5. Ensure high photorealism - each hairstyle should look natural and realistic.
+6. Maintain consistent lighting, shadows, and perspective across all 9 images.
+7. The grid should be perfectly aligned with equal spacing between cells.
+8. Each hairstyle should be clearly visible and distinct from the others.
+9. The person's identity and all other features must remain identical - only the hair changes.
+
+Output: A single image containing a 3x3 grid with 9 different hairstyle variations of the same person.
+"""
+
+    # Prepare the config (reusable for both models)
+    generate_config = types.GenerateContentConfig(
+        response_modalities=["IMAGE"],
+        image_config=types.ImageConfig(aspect_ratio=aspect_ratio),
+        safety_settings=[
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_HARASSMENT,
+                threshold=types.HarmBlockThreshold.OFF,
+            ),
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+                threshold=types.HarmBlockThreshold.OFF,
+            ),
+        ],
+    )
+
+    # Primary model first; the router falls back (or skips straight to the
+    # fallback while its circuit breaker is open) on rate limits
+    response, model_used = await image_model_router.generate(
+        contents=[source.part(), prompt],
+        config=generate_config,
+        label="Hairstyle Grid",
+    )
+
+    generated_image_bytes = await watermarked_image_from_response(response, options)
+
+    if not generated_image_bytes:
+        text_response = ""
+        if response.parts:
+            for part in response.parts:
+                if part.text:
+                    text_response += part.text
+
+        logger.warning(f"No image generated. Text response: {text_response}")
+
+        if text_response:
+            raise HTTPException(
+                status_code=400, detail=f"Generation failed: {text_response}"
+            )
+        else:
+            raise HTTPException(
+                status_code=500,
+                detail="Failed to generate image. The model might have failed to process the request.",
+            )
+
+    logger.info(f"Hairstyle grid successful using {model_used}, returning image.")
+    return Response(content=generated_image_bytes, media_type=options.media_type)
+
+
+def _cached_hairstyle_grid(source_bytes: bytes, options: OutputOptions):
+    return cached_result(
+        "hairstyle-grid",
+        [IMAGE_MODELS_KEY, options.cache_key(), source_bytes],
+        lambda: _hairstyle_grid(source_bytes, options),
+    )
+
+
+@app.post("/api/hairstyle-grid")
+async def hairstyle_grid(
+    source_image: UploadFile = File(...),
+    options: OutputOptions = Depends(output_options("PNG")),
+):
+    """
+    Hairstyle Grid endpoint - generates a 3x3 grid with 9 different hairstyles
+    User uploads their photo and gets back a grid showing them with different hairstyles
+    """
+    try:
+        logger.info(
+            f"Processing hairstyle grid request. User photo: {source_image.filename}"
+        )
+
+        # Read image
+        source_bytes = await source_image.read()
+
+        return await _cached_hairstyle_grid(source_bytes, options)
+
+    except HTTPException as he:
+        logger.error(f"HTTP Exception in hairstyle grid: {he.detail}")
+        raise he
+    except Exception as e:
+        logger.error(f"Unexpected error in hairstyle grid: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+class PodcastRequest(BaseModel):
+    topic: str
+    language: str = "en-US"
+
+
+# Gemini TTS returns raw 16-bit mono PCM at 24 kHz
+PODCAST_SAMPLE_RATE = 24000
+PODCAST_SAMPLE_WIDTH = 2
+PODCAST_CHANNELS = 1
+
+# How long a streamed script stays available for its audio request
+PODCAST_STREAM_TTL = float(os.getenv("PODCAST_STREAM_TTL", "600"))
+# Comment lines keep idle proxies from closing the event stream during grounding
+PODCAST_SSE_HEARTBEAT = float(os.getenv("PODCAST_SSE_HEARTBEAT", "15"))
+
+
+# Grounded scripts for the same topic are reused for this long; 0 disables
+PODCAST_SCRIPT_CACHE_TTL = float(os.getenv("PODCAST_SCRIPT_CACHE_TTL", "1800"))
+
+podcast_script_cache = ResultCache(
+    directory=os.path.join(CACHE_ROOT, "podcast-scripts"),
+    max_bytes=int(float(os.getenv("PODCAST_SCRIPT_CACHE_MAX_MB", "16")) * 1024 * 1024),
+    ttl=PODCAST_SCRIPT_CACHE_TTL,
+)
+
+
+def podcast_script_key(request: PodcastRequest) -> str:
+    """
+    Cache key for a topic/language pair, insensitive to case and spacing
+    """
+    topic = " ".join(request.topic.split()).casefold()
+    language = request.language.strip().casefold()
+    return ResultCache.make_key(PODCAST_SCRIPT_MODEL, topic, language)
+
+
+async def podcast_script(request: PodcastRequest):
+    """
+    Grounded script for the request, from the script cache when the same
+    topic and language were researched within PODCAST_SCRIPT_CACHE_TTL
+    Returns:
+        (script_text, cached)
+    """
+    caching = PODCAST_SCRIPT_CACHE_TTL > 0 and podcast_script_cache.max_bytes > 0
+    if caching:
+        key = podcast_script_key(request)
+        cached = await asyncio.to_thread(podcast_script_cache.get, key)
+        if cached is not None:
+            logger.info(f"Podcast script cache hit for topic: {request.topic}")
+            return cached[0].decode("utf-8"), True
+
+    script_text = await _podcast_script(request)
+    if caching:
+        await asyncio.to_thread(
+            podcast_script_cache.put,
+            key,
+            script_text.encode("utf-8"),
+            {"tool": "podcast-script", "media_type": "text/plain"},
+        )
+    return script_text, False
+
+
+async def _podcast_script(request: PodcastRequest) -> str:
+    """
+    Step 1: Generate the script with Grounding
+    """
+    grounding_tool = types.Tool(google_search=types.GoogleSearch())
+
+    text_prompt = f"""
+        You are a scriptwriter for a podcast. Write a dialogue between two hosts, Emily and Mark, about the following topic:
+        Topic: "{request.topic}"
+        Language: "{request.language}"
+        
+        Characters:
+        - Emily: Enthusiastic, knowledgeable, and high-energy host.
+        - Mark: Skeptical, curious, and slightly sarcastic co-host who asks the questions the audience might have.
+        
+        Rules:
+        1. Use Google Search to find the latest facts and information about the topic.
+        2. Explain the concept clearly and engagingly.
+        3. Keep the dialogue natural and conversational.
+        4. Length: Around 200-300 words.
+        5. Output: The dialogue script, with speaker names (Emily: ... Mark: ...).
+        """
+
+    text_response = await generate_content(
+        model=PODCAST_SCRIPT_MODEL,
+        contents=text_prompt,
+        config=types.GenerateContentConfig(tools=[grounding_tool]),
+    )
+
+    if not text_response.text:
+        raise HTTPException(
+            status_code=500, detail="Failed to generate podcast script"
+        )
+
+    script_text = text_response.text.strip()
+    logger.info(f"Generated podcast script length: {len(script_text)}")
+    return script_text
+
+
+def _podcast_audio_prompt(script_text: str) -> str:
+    return f"""TTS the following conversation between Mark and Emily:
+        {script_text}
+        """
+
+
+PODCAST_VOICES = {
+    "Emily": "Zephyr",  # Energetic
+    "Mark": "Puck",  # Skeptical/Curious
+}
+
+
+def _podcast_speech_config() -> types.GenerateContentConfig:
+    # Using multi-speaker configuration
+    return types.GenerateContentConfig(
+        response_modalities=["AUDIO"],
+        speech_config=types.SpeechConfig(
+            multi_speaker_voice_config=types.MultiSpeakerVoiceConfig(
+                speaker_voice_configs=[
+                    types.SpeakerVoiceConfig(
+                        speaker=speaker,
+                        voice_config=types.VoiceConfig(
+                            prebuilt_voice_config=types.PrebuiltVoiceConfig(
+                                voice_name=voice_name,
+                            )
+                        ),
+                    )
+                    for speaker, voice_name in PODCAST_VOICES.items()
+                ]
+            )
+        ),
+    )
+
+
+# "single" sends the whole script in one TTS call; "segmented" splits it at
+# speaker turns and synthesizes the pieces concurrently
+PODCAST_TTS_MODE = os.getenv("PODCAST_TTS_MODE", "single")
+PODCAST_TTS_SEGMENT_CHARS = int(os.getenv("PODCAST_TTS_SEGMENT_CHARS", "400"))
+PODCAST_TTS_PARALLELISM = int(os.getenv("PODCAST_TTS_PARALLELISM", "4"))
+
+# "Emily: ...", "**Mark:** ..." etc. at the start of a line
+_SPEAKER_TURN = re.compile(
+    rf"^\W*({'|'.join(PODCAST_VOICES)})\W*:", re.IGNORECASE | re.MULTILINE
+)
+
+
+def podcast_segments(script_text: str, max_chars: int) -> list:
+    """
+    Split a script at speaker turns into segments of whole turns, each up to
+    max_chars long (a single longer turn becomes its own segment)
+    """
+    starts = [match.start() for match in _SPEAKER_TURN.finditer(script_text)]
+    if not starts:
+        return [script_text]
+    # Anything before the first speaker belongs to the first turn
+    starts[0] = 0
+    turns = [
+        script_text[start:end].strip()
+        for start, end in zip(starts, starts[1:] + [len(script_text)])
+    ]
+
+    segments = []
+    current = ""
+    for turn in turns:
+        if current and len(current) + len(turn) + 1 > max_chars:
+            segments.append(current)
+            current = turn
+        else:
+            current = f"{current}\n{turn}" if current else turn
+    segments.append(current)
+    return segments
+
+
+async def _synthesize_single(script_text: str) -> bytes:
+    audio_response = await generate_content(
+        model=PODCAST_TTS_MODEL,
+        contents=_podcast_audio_prompt(script_text),
+        config=_podcast_speech_config(),
+    )
+    pcm_bytes = next(_audio_parts(audio_response), None)
+    if not pcm_bytes:
+        raise HTTPException(status_code=500, detail="Failed to generate audio")
+    return pcm_bytes
+
+
+async def _synthesize_segments(segments: list, parallelism: int) -> bytes:
+    """
+    Synthesize segments concurrently, at most parallelism at a time, and
+    stitch their PCM together in script order
+    """
+    semaphore = asyncio.Semaphore(parallelism)
+
+    async def synthesize(segment):
+        async with semaphore:
+            return await _synthesize_single(segment)
+
+    tasks = [asyncio.ensure_future(synthesize(segment)) for segment in segments]
+    try:
+        pcm_parts = await asyncio.gather(*tasks)
+    except BaseException:
+        # One missing segment spoils the whole podcast; stop the others
+        for task in tasks:
+            task.cancel()
+        raise
+
+    # Keep every segment sample-aligned so later ones are not shifted by a byte
+    return b"".join(part[: len(part) - len(part) % PODCAST_SAMPLE_WIDTH] for part in pcm_parts)
+
+
+async def synthesize_podcast(script_text: str, mode: str = None) -> bytes:
+    """
+    Step 2: Generate audio
+    Returns:
+        Raw 24 kHz 16-bit mono PCM for the script
+    """
+    if (mode or PODCAST_TTS_MODE) == "segmented":
+        segments = podcast_segments(script_text, PODCAST_TTS_SEGMENT_CHARS)
+        if len(segments) > 1:
+            started = time.monotonic()
+            pcm_bytes = await _synthesize_segments(segments, PODCAST_TTS_PARALLELISM)
+            logger.info(
+                f"Synthesized podcast in {len(segments)} segments "
+                f"in {time.monotonic() - started:.1f}s"
+            )
+            return pcm_bytes
+    return await _synthesize_single(script_text)
+
+
+def _audio_parts(response):
+    """
+    PCM payloads of a (possibly partial) TTS response, in order
+    """
+    for part in response.parts or []:
+        if part.inline_data and part.inline_data.data:
+            yield part.inline_data.data
+
+
+def pcm_to_wav(pcm_bytes: bytes) -> bytes:
+    """
+    Wrap raw TTS PCM in a WAV container, in memory
+    """
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(PODCAST_CHANNELS)
+        wav_file.setsampwidth(PODCAST_SAMPLE_WIDTH)
+        wav_file.setframerate(PODCAST_SAMPLE_RATE)
+        wav_file.writeframes(pcm_bytes)
+    return buffer.getvalue()
+
+
+# format -> (media type, soundfile format, soundfile subtype)
+PODCAST_AUDIO_FORMATS = {
+    "wav": ("audio/wav", None, None),
+    "flac": ("audio/flac", "FLAC", "PCM_16"),
+    "opus": ("audio/ogg; codecs=opus", "OGG", "OPUS"),
+}
+
+# Accept media types that select a binary audio format
+PODCAST_AUDIO_ACCEPT = {
+    "audio/flac": "flac",
+    "audio/x-flac": "flac",
+    "audio/ogg": "opus",
+    "audio/opus": "opus",
+    "audio/wav": "wav",
+    "audio/x-wav": "wav",
+    "audio/wave": "wav",
+}
+
+
+def parse_accept(accept: str) -> list:
+    """
+    Media ranges of an Accept header as (media_range, q, position) tuples;
+    a malformed q counts as 1
+    """
+    ranges = []
+    for position, item in enumerate((accept or "").split(",")):
+        media_range, *params = [part.strip() for part in item.split(";")]
+        if not media_range:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = min(max(float(value), 0.0), 1.0)
+                except ValueError:
+                    pass
+        ranges.append((media_range.lower(), q, position))
+    return ranges
+
+
+def preferred_media_type(ranges: list, candidates: list):
+    """
+    The candidate the client rates highest, or None if none is acceptable
+    Args:
+        ranges: parse_accept() output
+        candidates: (media_type, exact) pairs in server preference order;
+            exact candidates only match their own type, not type/* or */*
+    Each candidate takes the q of its most specific matching range; q=0 rules
+    it out. Ties go to the range the client listed first, then server order.
+    """
+    best, best_rank = None, None
+    for order, (media_type, exact) in enumerate(candidates):
+        matches = [media_type] if exact else [media_type, media_type.split("/")[0] + "/*", "*/*"]
+        for pattern in matches:
+            found = [(q, position) for media_range, q, position in ranges if media_range == pattern]
+            if found:
+                q, position = found[0]
+                rank = (-q, position, order)
+                if q > 0 and (best_rank is None or rank < best_rank):
+                    best, best_rank = media_type, rank
+                break
+    return best
+
+
+def negotiate_audio_format(requested, accept: str):
+    """
+    Pick the podcast response format from the format query parameter or,
+    failing that, the Accept header
+    Returns:
+        A PODCAST_AUDIO_FORMATS key, or None for the JSON/base64 WAV response
+    """
+    if requested:
+        requested = requested.lower()
+        if requested == "json":
+            return None
+        if requested not in PODCAST_AUDIO_FORMATS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unsupported audio format: {requested}. "
+                f"Use one of: json, {', '.join(PODCAST_AUDIO_FORMATS)}",
+            )
+        if soundfile is None and PODCAST_AUDIO_FORMATS[requested][1]:
+            raise HTTPException(
+                status_code=406, detail=f"{requested} encoding is not available"
+            )
+        return requested
+
+    # JSON wins ties with audio/* or */*, and stays the default when the
+    # client accepts none of these
+    candidates = [("application/json", False)] + [
+        (media_type, False)
+        for media_type, audio_format in PODCAST_AUDIO_ACCEPT.items()
+        if soundfile is not None or audio_format == "wav"
+    ]
+    media_type = preferred_media_type(parse_accept(accept), candidates)
+    return PODCAST_AUDIO_ACCEPT.get(media_type)
+
+
+def encode_podcast_audio(pcm_bytes: bytes, audio_format: str) -> bytes:
+    """
+    Encode raw TTS PCM as WAV, FLAC or Opus, in memory
+    """
+    _, container, subtype = PODCAST_AUDIO_FORMATS[audio_format]
+    if container is None:
+        return pcm_to_wav(pcm_bytes)
+
+    samples = np.frombuffer(pcm_bytes[: len(pcm_bytes) // 2 * 2], dtype="<i2")
+    buffer = io.BytesIO()
+    soundfile.write(
+        buffer, samples, PODCAST_SAMPLE_RATE, format=container, subtype=subtype
+    )
+    return buffer.getvalue()
+
+
+def streaming_wav_header() -> bytes:
+    """
+    44-byte WAV header for a stream whose length is not known yet. The RIFF and
+    data sizes are set to the maximum, which browsers and players treat as
+    "read until the connection closes".
+    """
+    block_align = PODCAST_CHANNELS * PODCAST_SAMPLE_WIDTH
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF",
+        0xFFFFFFFF,
+        b"WAVE",
+        b"fmt ",
+        16,
+        1,  # PCM
+        PODCAST_CHANNELS,
+        PODCAST_SAMPLE_RATE,
+        PODCAST_SAMPLE_RATE * block_align,
+        block_align,
+        PODCAST_SAMPLE_WIDTH * 8,
+        b"data",
+        0xFFFFFFFF,
+    )
+
+
+async def _podcast_creator(request: PodcastRequest, audio_format=None) -> Response:
+    script_text, script_cached = await podcast_script(request)
+
+    pcm_bytes = await synthesize_podcast(script_text)
+
+    if audio_format is not None:
+        # Binary body; the script travels base64-encoded (UTF-8) in a header
+        audio_bytes = await asyncio.to_thread(encode_podcast_audio, pcm_bytes, audio_format)
+        logger.info(
+            f"Encoded podcast audio as {audio_format} in memory. "
+            f"Size: {len(audio_bytes)} bytes (PCM: {len(pcm_bytes)} bytes)"
+        )
+        return Response(
+            content=audio_bytes,
+            media_type=PODCAST_AUDIO_FORMATS[audio_format][0],
+            headers={
+                "X-Podcast-Script": base64.b64encode(script_text.encode("utf-8")).decode("ascii"),
+                "X-Script-Cache": "HIT" if script_cached else "MISS",
+            },
+        )
+
+    wav_bytes = pcm_to_wav(pcm_bytes)
+    logger.info(f"Converted PCM to WAV in memory. Size: {len(wav_bytes)} bytes")
+
+    return JSONResponse(
+        content={
+            "script_text": script_text,
+            "script_cached": script_cached,
+            "audio_data": base64.b64encode(wav_bytes).decode("utf-8"),
+        }
+    )
+
+
+def _cached_podcast_creator(request: PodcastRequest, audio_format=None):
+    # Coalescing only (see RESULT_CACHE_EXCLUDED_TOOLS), on the same
+    # normalized topic as the script cache
+    key_parts = [PODCAST_MODELS_KEY, podcast_script_key(request)]
+    if audio_format is not None:
+        key_parts.append(audio_format)
+    return cached_result(
+        "podcast-creator",
+        key_parts,
+        lambda: _podcast_creator(request, audio_format),
+    )
+
+
+@app.post("/api/podcast-creator")
+async def podcast_creator(
+    request: PodcastRequest,
+    http_request: Request,
+    audio_format: str = Query(None, alias="format"),
+):
+    """
+    Generate a podcast. By default returns JSON with the script and base64 WAV.
+    With ?format=flac|opus|wav, or an Accept header naming one of those audio
+    types, returns the audio as a binary body with the script base64-encoded
+    in the X-Podcast-Script header.
+    """
+    try:
+        audio_format = negotiate_audio_format(audio_format, http_request.headers.get("Accept"))
+        logger.info(
+            f"Processing podcast generation for topic: {request.topic} in language: {request.language}"
+            f" (format: {audio_format or 'json'})"
+        )
+
+        response = await _cached_podcast_creator(request, audio_format)
+        response.headers["Vary"] = "Accept"
+        return response
+
+    except HTTPException as he:
+        logger.error(f"HTTP error in podcast creator: {he.detail}")
+        raise he
+    except Exception as e:
+        logger.error(f"Error in podcast creator: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _sse_event(event: str, data: dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+
+
+@app.post("/api/podcast-creator/stream")
+async def podcast_creator_stream(request: PodcastRequest, http_request: Request):
+    """
+    Streaming podcast generation. Returns a text/event-stream that sends a
+    "script" event as soon as the script is written, carrying the script text
+    and an audio_url. GET audio_url to receive the audio as a chunked WAV
+    stream that can be played while synthesis is still running.
+    """
+    user_id = http_request.headers.get("X-User-ID")
+    logger.info(
+        f"Streaming podcast generation for topic: {request.topic} in language: {request.language}"
+    )
+
+    async def events():
+        yield _sse_event("status", {"stage": "script"})
+
+        script_task = asyncio.ensure_future(podcast_script(request))
+        try:
+            while True:
+                done, _ = await asyncio.wait({script_task}, timeout=PODCAST_SSE_HEARTBEAT)
+                if done:
+                    break
+                yield b": keep-alive\n\n"
+            script_text, script_cached = script_task.result()
+        except HTTPException as he:
+            logger.error(f"Error in podcast stream: {he.detail}")
+            yield _sse_event("error", {"detail": he.detail})
+            return
+        except Exception as e:
+            logger.error(f"Error in podcast stream: {e}")
+            yield _sse_event("error", {"detail": str(e)})
+            return
+        finally:
+            script_task.cancel()
+
+        # The audio request may land on another worker, so the script is
+        # handed over through the shared on-disk cache
+        script_id = ResultCache.make_key("podcast-script", user_id, script_text)
+        await asyncio.to_thread(
+            result_cache.put,
+            script_id,
+            script_text.encode("utf-8"),
+            {
+                "tool": "podcast-script",
+                "media_type": "text/plain",
+                "user_id": user_id,
+                "ttl": PODCAST_STREAM_TTL,
+            },
+        )
+
+        yield _sse_event(
+            "script",
+            {
+                "script_text": script_text,
+                "script_cached": script_cached,
+                "audio_url": f"/api/podcast-creator/audio/{script_id}",
+            },
+        )
+        yield _sse_event("done", {})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/api/podcast-creator/audio/{script_id}")
+async def podcast_creator_audio(script_id: str, http_request: Request):
+    """
+    Synthesize a script produced by /api/podcast-creator/stream and stream the
+    audio back as 24 kHz 16-bit mono WAV while Gemini generates it
+    """
+    cached = await asyncio.to_thread(result_cache.get, script_id)
+    if cached is None or cached[1].get("user_id") != http_request.headers.get("X-User-ID"):
+        raise HTTPException(status_code=404, detail="Podcast script not found or expired")
+    script_text = cached[0].decode("utf-8")
+
+    stream = generate_content_stream(
+        model=PODCAST_TTS_MODEL,
+        contents=_podcast_audio_prompt(script_text),
+        config=_podcast_speech_config(),
+    )
+
+    # Wait for the first audio before committing to a 200 so that upstream
+    # failures still surface as a proper error status
+    try:
+        first_chunk = b""
+        async for response in stream:
+            first_chunk = b"".join(_audio_parts(response))
+            if first_chunk:
+                break
+    except Exception as e:
+        await stream.aclose()
+        logger.error(f"Error starting podcast audio stream: {e}")
+        if isinstance(e, HTTPException):
+            raise e
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if not first_chunk:
+        raise HTTPException(status_code=500, detail="Failed to generate audio")
+
+    async def audio():
+        total = 0
+        # Keep every chunk sample-aligned; an odd byte waits for the next one
+        pending = first_chunk
+        try:
+            yield streaming_wav_header()
+            while True:
+                aligned = len(pending) - len(pending) % PODCAST_SAMPLE_WIDTH
+                if aligned:
+                    yield pending[:aligned]
+                    total += aligned
+                    pending = pending[aligned:]
+                response = await anext(stream, None)
+                if response is None:
+                    break
+                pending += b"".join(_audio_parts(response))
+        finally:
+            await stream.aclose()
+            logger.info(f"Streamed podcast audio: {total} PCM bytes")
+
+    return StreamingResponse(audio(), media_type="audio/wav")
+
+
+# Remote image fetching for the proxy
+PROXY_CONNECT_TIMEOUT = float(os.getenv("PROXY_CONNECT_TIMEOUT", "5"))
+PROXY_READ_TIMEOUT = float(os.getenv("PROXY_READ_TIMEOUT", "30"))
+PROXY_MAX_CONNECTIONS = int(os.getenv("PROXY_MAX_CONNECTIONS", "20"))
+PROXY_MAX_BYTES = int(float(os.getenv("PROXY_MAX_MB", "50")) * 1024 * 1024)
+PROXY_CHUNK_SIZE = 64 * 1024
+
+# Request headers passed on to the origin, and response headers passed back
+PROXY_FORWARD_REQUEST_HEADERS = ("range", "if-range")
+PROXY_FORWARD_RESPONSE_HEADERS = (
+    "content-length",
+    "content-range",
+    "accept-ranges",
+    "etag",
+    "last-modified",
+)
 
-        if response is None:
-            logger.error("No response received from Gemini API")
-            raise HTTPException(
-                status_code=500,
-                detail="Failed to get response from image generation service."
-            )
+_proxy_client = None
 
-        generated_image_bytes = None
 
-        if response.parts:
-            for part in response.parts:
-                if part.inline_data:
-                    img = part.as_image()
+def get_proxy_client() -> httpx.AsyncClient:
+    """
+    Process-wide HTTP client for proxy_image so connections to S3 are pooled
+    """
+    global _proxy_client
+    if _proxy_client is None:
+        _proxy_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(PROXY_READ_TIMEOUT, connect=PROXY_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=PROXY_MAX_CONNECTIONS,
+                max_keepalive_connections=PROXY_MAX_CONNECTIONS,
+            ),
+            follow_redirects=True,
+            # Bodies are relayed byte for byte, so ask for them unencoded
+            headers={"Accept-Encoding": "identity"},
+        )
+    return _proxy_client
 
-                    # Save to a temporary file
-                    with tempfile.NamedTemporaryFile(
-                        suffix=".png", delete=False
-                    ) as tmp_file:
-                        tmp_path = tmp_file.name
 
-                    img.save(tmp_path)
+class ProxyBodyTooLarge(Exception):
+    pass
 
-                    # Add watermark in-place
-                    add_watermark(tmp_path)
 
-                    # Read back the watermarked image
-                    with open(tmp_path, "rb") as f:
-                        generated_image_bytes = f.read()
+class ProxyCache:
+    """
+    Disk cache of proxied objects on top of a ResultCache. Entries younger
+    than fresh_for are served as-is; older ones are revalidated against the
+    origin with If-None-Match / If-Modified-Since, so an unchanged object
+    costs a 304 instead of a full download.
+    """
 
-                    os.remove(tmp_path)
-                    break
+    def __init__(self, store: ResultCache, fresh_for: float, max_object_bytes: int):
+        self.store = store
+        self.fresh_for = fresh_for
+        self.max_object_bytes = max_object_bytes
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.refreshed = 0
+        self.stale_served = 0
+        self.not_modified = 0
+        self.bytes_saved = 0
+        self.variant_hits = 0
+        self.variants_rendered = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.store.max_bytes > 0
+
+    @staticmethod
+    def key(url: str) -> str:
+        return ResultCache.make_key("proxy-image", url)
+
+    async def get(self, url: str):
+        if not self.enabled:
+            return None
+        return await asyncio.to_thread(self.store.get, self.key(url))
+
+    async def put(self, url: str, payload: bytes, meta: dict) -> dict:
+        """
+        Store a whole object
+        Returns:
+            The metadata as stored (with an ETag filled in if the origin sent none)
+        """
+        meta = {**meta, "validated_at": time.time()}
+        if not meta.get("etag"):
+            meta["etag"] = f'"{hashlib.sha256(payload).hexdigest()[:32]}"'
+        if not self.enabled or len(payload) > self.max_object_bytes:
+            return meta
+        await asyncio.to_thread(self.store.put, self.key(url), payload, meta)
+        return meta
+
+    async def remove(self, url: str) -> None:
+        await asyncio.to_thread(self.store._remove, self.key(url))
+
+    def is_fresh(self, meta: dict) -> bool:
+        return time.time() - meta.get("validated_at", 0) < self.fresh_for
+
+    def stats(self) -> dict:
+        return {
+            "store": self.store.stats(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidated": self.revalidated,
+            "refreshed": self.refreshed,
+            "stale_served": self.stale_served,
+            "not_modified": self.not_modified,
+            "bytes_saved": self.bytes_saved,
+            "variant_hits": self.variant_hits,
+            "variants_rendered": self.variants_rendered,
+        }
 
-        if not generated_image_bytes:
-            text_response = ""
-            if response.parts:
-                for part in response.parts:
-                    if part.text:
-                        text_response += part.text
 
-            logger.warning(f"No image generated. Text response: {text_response}")
+proxy_cache = ProxyCache(
+    ResultCache(
+        directory=os.path.join(CACHE_ROOT, "proxy"),
+        max_bytes=int(float(os.getenv("PROXY_CACHE_MAX_MB", "1024")) * 1024 * 1024),
+        ttl=float(os.getenv("PROXY_CACHE_TTL", str(7 * 86400))),
+    ),
+    fresh_for=float(os.getenv("PROXY_CACHE_FRESH", "300")),
+    max_object_bytes=int(float(os.getenv("PROXY_CACHE_MAX_OBJECT_MB", "20")) * 1024 * 1024),
+)
 
-            if text_response:
-                raise HTTPException(
-                    status_code=400, detail=f"Generation failed: {text_response}"
-                )
-            else:
-                raise HTTPException(
-                    status_code=500,
-                    detail="Failed to generate image. The model might have failed to process the request.",
-                )
+# Browsers may reuse a proxied image this long before asking again
+PROXY_CLIENT_MAX_AGE = int(os.getenv("PROXY_CLIENT_MAX_AGE", "86400"))
+PROXY_CACHE_CONTROL = f"private, max-age={PROXY_CLIENT_MAX_AGE}"
 
-        logger.info(f"Hairstyle grid successful using {model_used}, returning image.")
-        return Response(content=generated_image_bytes, media_type="image/png")
 
-    except HTTPException as he:
-        logger.error(f"HTTP Exception in hairstyle grid: {he.detail}")
-        raise he
-    except Exception as e:
-        logger.error(f"Unexpected error in hairstyle grid: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, as RFC 9110 requires for If-None-Match
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in candidates
 
 
-class PodcastRequest(BaseModel):
-    topic: str
-    language: str = "en-US"
+def client_has_current(request: Request, meta: dict) -> bool:
+    """
+    Whether the caller's conditional headers match the cached object
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        return _etag_matches(if_none_match, meta["etag"])
 
+    if_modified_since = request.headers.get("if-modified-since")
+    last_modified = meta.get("last_modified")
+    if if_modified_since and last_modified:
+        try:
+            return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
 
-@app.post("/api/podcast-creator")
-async def podcast_creator(request: PodcastRequest):
-    try:
-        logger.info(
-            f"Processing podcast generation for topic: {request.topic} in language: {request.language}"
-        )
 
-        api_key = os.getenv("GOOGLE_API_KEY")
-        if not api_key:
-            raise HTTPException(status_code=500, detail="GOOGLE_API_KEY not set")
+def _upstream_meta(upstream: httpx.Response) -> dict:
+    return {
+        "media_type": upstream.headers.get("content-type", "image/jpeg"),
+        "etag": upstream.headers.get("etag"),
+        "last_modified": upstream.headers.get("last-modified"),
+    }
 
-        client = genai.Client(api_key=api_key)
 
-        # Step 1: Generate the script with Grounding
-        grounding_tool = types.Tool(google_search=types.GoogleSearch())
+def _proxy_validators(meta: dict) -> dict:
+    headers = {"ETag": meta["etag"], "Cache-Control": PROXY_CACHE_CONTROL}
+    if meta.get("last_modified"):
+        headers["Last-Modified"] = meta["last_modified"]
+    return headers
 
-        text_prompt = f"""
-        You are a scriptwriter for a podcast. Write a dialogue between two hosts, Emily and Mark, about the following topic:
-        Topic: "{request.topic}"
-        Language: "{request.language}"
-        
-        Characters:
-        - Emily: Enthusiastic, knowledgeable, and high-energy host.
-        - Mark: Skeptical, curious, and slightly sarcastic co-host who asks the questions the audience might have.
-        
-        Rules:
-        1. Use Google Search to find the latest facts and information about the topic.
-        2. Explain the concept clearly and engagingly.
-        3. Keep the dialogue natural and conversational.
-        4. Length: Around 200-300 words.
-        5. Output: The dialogue script, with speaker names (Emily: ... Mark: ...).
-        """
 
-        text_response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=text_prompt,
-            config=types.GenerateContentConfig(tools=[grounding_tool]),
+def _serve_cached(request: Request, payload: bytes, meta: dict, source: str) -> Response:
+    headers = {**_proxy_validators(meta), "X-Cache": source}
+    if client_has_current(request, meta):
+        proxy_cache.not_modified += 1
+        return Response(status_code=304, headers=headers)
+    return Response(content=payload, media_type=meta["media_type"], headers=headers)
+
+
+async def _stream_upstream(upstream: httpx.Response, max_bytes: int, cache_url: str = None):
+    """
+    Relay the upstream body chunk by chunk, giving up once it passes max_bytes.
+    With cache_url, a complete body small enough to cache is stored afterwards.
+    """
+    received = 0
+    chunks = [] if cache_url else None
+    try:
+        async for chunk in upstream.aiter_raw(PROXY_CHUNK_SIZE):
+            received += len(chunk)
+            if received > max_bytes:
+                logger.error(f"Proxied image exceeded {max_bytes} bytes, aborting")
+                raise ProxyBodyTooLarge(f"Image larger than {max_bytes} bytes")
+            if chunks is not None:
+                if received <= proxy_cache.max_object_bytes:
+                    chunks.append(chunk)
+                else:
+                    chunks = None
+            yield chunk
+    finally:
+        await upstream.aclose()
+
+    if chunks is not None:
+        await proxy_cache.put(cache_url, b"".join(chunks), _upstream_meta(upstream))
+
+
+def _forwarded_response(upstream: httpx.Response, body) -> StreamingResponse:
+    headers = {
+        name: upstream.headers[name]
+        for name in PROXY_FORWARD_RESPONSE_HEADERS
+        if name in upstream.headers
+    }
+    if upstream.status_code == 200:
+        headers["Cache-Control"] = PROXY_CACHE_CONTROL
+    return StreamingResponse(
+        body,
+        status_code=upstream.status_code,
+        media_type=upstream.headers.get("content-type", "image/jpeg"),
+        headers=headers,
+    )
+
+
+async def _open_upstream(url: str, headers: dict) -> httpx.Response:
+    """
+    Start a streamed GET to the origin; errors and oversized bodies raise
+    HTTPException before any of the body is read
+    """
+    client = get_proxy_client()
+    upstream = await client.send(client.build_request("GET", url, headers=headers), stream=True)
+
+    if upstream.status_code >= 400:
+        await upstream.aclose()
+        logger.error(f"HTTP error fetching image: {upstream.status_code} {upstream.reason_phrase}")
+        raise HTTPException(
+            status_code=upstream.status_code,
+            detail=f"Failed to fetch image: {upstream.reason_phrase}",
         )
 
-        if not text_response.text:
-            raise HTTPException(
-                status_code=500, detail="Failed to generate podcast script"
-            )
+    content_length = upstream.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > PROXY_MAX_BYTES:
+        await upstream.aclose()
+        raise HTTPException(status_code=413, detail="Image too large to proxy")
+    return upstream
 
-        script_text = text_response.text.strip()
-        logger.info(f"Generated podcast script length: {len(script_text)}")
 
-        # Step 2: Generate audio
-        # Using multi-speaker configuration
-        audio_prompt = f"""TTS the following conversation between Mark and Emily:
-        {script_text}
-        """
+PROXY_MAX_DIMENSION = int(os.getenv("PROXY_MAX_DIMENSION", "2048"))
+PROXY_FIT_MODES = ("inside", "cover")
+# Quality used when q is not given
+PROXY_DEFAULT_QUALITY = {"WEBP": 80, "JPEG": 82}
 
-        audio_response = client.models.generate_content(
-            model="gemini-2.5-flash-preview-tts",
-            contents=audio_prompt,
-            config=types.GenerateContentConfig(
-                response_modalities=["AUDIO"],
-                speech_config=types.SpeechConfig(
-                    multi_speaker_voice_config=types.MultiSpeakerVoiceConfig(
-                        speaker_voice_configs=[
-                            types.SpeakerVoiceConfig(
-                                speaker="Emily",
-                                voice_config=types.VoiceConfig(
-                                    prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                                        voice_name="Zephyr",  # Energetic
-                                    )
-                                ),
-                            ),
-                            types.SpeakerVoiceConfig(
-                                speaker="Mark",
-                                voice_config=types.VoiceConfig(
-                                    prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                                        voice_name="Puck",  # Skeptical/Curious
-                                    )
-                                ),
-                            ),
-                        ]
-                    )
-                ),
-            ),
+
+def _variant_size(source_size, w, h, fit):
+    """
+    Output size for a w/h box; never larger than the source
+    """
+    width, height = source_size
+    if w and h:
+        scale = (min if fit == "inside" else max)(w / width, h / height)
+    elif w:
+        scale = w / width
+    elif h:
+        scale = h / height
+    else:
+        scale = 1.0
+    scale = min(scale, 1.0)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def render_variant(payload: bytes, w, h, fit: str, q, image_format: str) -> bytes:
+    """
+    Resize and re-encode a proxied image
+    """
+    img = Image.open(io.BytesIO(payload))
+    target = _variant_size(displayed_size(img), w, h, fit)
+    img = decode_oriented(img, target)
+    if fit == "cover" and w and h:
+        crop_box = (min(w, target[0]), min(h, target[1]))
+        if crop_box != img.size:
+            img = ImageOps.fit(img, crop_box, Image.LANCZOS)
+
+    has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+    if image_format == "JPEG" and has_alpha:
+        image_format = "PNG"
+
+    buffer = io.BytesIO()
+    if image_format == "PNG":
+        img.save(buffer, "PNG", optimize=True)
+    else:
+        if image_format == "JPEG" or not has_alpha:
+            img = img.convert("RGB")
+        elif img.mode != "RGBA":
+            img = img.convert("RGBA")
+        img.save(
+            buffer,
+            image_format,
+            quality=q or PROXY_DEFAULT_QUALITY[image_format],
+            **({"method": 4} if image_format == "WEBP" else {"optimize": True, "progressive": True}),
         )
+    return buffer.getvalue()
 
-        audio_data_base64 = ""
 
-        if audio_response.parts:
-            for part in audio_response.parts:
-                if part.inline_data:
-                    pcm_bytes = part.inline_data.data
+def negotiate_image_format(accept: str, source_media_type: str) -> str:
+    # Keep PNG sources lossless-capable when WebP is not an option
+    fallback = "PNG" if source_media_type == "image/png" else "JPEG"
+    # WebP only when named explicitly (not via image/* or */*), since clients
+    # that cannot decode it commonly send */*; the fallback is served even
+    # when the client accepts neither
+    media_type = preferred_media_type(
+        parse_accept(accept),
+        [("image/webp", True), (OUTPUT_MEDIA_TYPES[fallback], False)],
+    )
+    return "WEBP" if media_type == "image/webp" else fallback
 
-                    # Save to a temporary file, then read it back as bytes
-                    with tempfile.NamedTemporaryFile(
-                        suffix=".wav", delete=False
-                    ) as tmp_file:
-                        tmp_path = tmp_file.name
 
-                    try:
-                        # Write PCM data to WAV file
-                        with wave.open(tmp_path, "wb") as wav_file:
-                            wav_file.setnchannels(1)
-                            wav_file.setsampwidth(2)
-                            wav_file.setframerate(24000)
-                            wav_file.writeframes(pcm_bytes)
-
-                        # Read back the WAV file
-                        with open(tmp_path, "rb") as f:
-                            wav_bytes = f.read()
-
-                        logger.info(
-                            f"Converted PCM to WAV via temp file. Size: {len(wav_bytes)} bytes"
-                        )
-                        audio_data_base64 = base64.b64encode(wav_bytes).decode("utf-8")
-
-                    finally:
-                        # Clean up the temporary file
-                        if os.path.exists(tmp_path):
-                            os.remove(tmp_path)
+async def _proxy_variant(request: Request, url: str, w, h, fit: str, q) -> Response:
+    """
+    Resized / re-encoded proxy response; variants are cached per original
+    ETag and parameters
+    """
+    for name, value in (("w", w), ("h", h)):
+        if value is not None and not 1 <= value <= PROXY_MAX_DIMENSION:
+            raise HTTPException(
+                status_code=400, detail=f"{name} must be between 1 and {PROXY_MAX_DIMENSION}"
+            )
+    if q is not None and not 1 <= q <= 100:
+        raise HTTPException(status_code=400, detail="q must be between 1 and 100")
+    if fit not in PROXY_FIT_MODES:
+        raise HTTPException(
+            status_code=400, detail=f"fit must be one of: {', '.join(PROXY_FIT_MODES)}"
+        )
 
-                    break
+    payload, meta, source, upstream = await _lookup_proxied(url)
+    if payload is None:
+        try:
+            payload = b"".join([chunk async for chunk in _stream_upstream(upstream, PROXY_MAX_BYTES)])
+        except ProxyBodyTooLarge:
+            raise HTTPException(status_code=413, detail="Image too large to proxy")
+        meta = await proxy_cache.put(url, payload, _upstream_meta(upstream))
+
+    image_format = negotiate_image_format(request.headers.get("accept"), meta["media_type"])
+    variant_url = f"{url}#w={w}&h={h}&fit={fit}&q={q}&format={image_format}&etag={meta['etag']}"
+
+    cached = await proxy_cache.get(variant_url)
+    if cached is not None:
+        proxy_cache.variant_hits += 1
+        response = _serve_cached(request, cached[0], cached[1], "HIT")
+    else:
+        started = time.monotonic()
+        async with admit_images(payload):
+            with timed_stage("proxy_render"):
+                variant = await asyncio.to_thread(
+                    render_variant, payload, w, h, fit, q, image_format
+                )
+        proxy_cache.variants_rendered += 1
+        logger.info(
+            f"Rendered {w}x{h} {fit} {image_format} variant in "
+            f"{(time.monotonic() - started) * 1000:.0f}ms: {len(payload)} -> {len(variant)} bytes"
+        )
+        variant_meta = await proxy_cache.put(
+            variant_url,
+            variant,
+            {
+                "media_type": "image/png" if variant[:4] == b"\x89PNG" else f"image/{image_format.lower()}",
+                "last_modified": meta.get("last_modified"),
+            },
+        )
+        response = _serve_cached(request, variant, variant_meta, "MISS")
 
-        if not audio_data_base64:
-            raise HTTPException(status_code=500, detail="Failed to generate audio")
+    response.headers["Vary"] = "Accept"
+    return response
 
-        return {"script_text": script_text, "audio_data": audio_data_base64}
 
-    except Exception as e:
-        logger.error(f"Error in podcast creator: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+async def _lookup_proxied(url: str):
+    """
+    Answer from the proxy cache, revalidating a stale entry with the origin
+    Returns:
+        (payload, meta, source, None) when the cache can answer, otherwise
+        (None, None, "MISS", upstream) with the origin's streamed 200 response
+    """
+    cached = await proxy_cache.get(url)
+    if cached is None:
+        proxy_cache.misses += 1
+        return None, None, "MISS", await _open_upstream(url, {})
+
+    payload, meta = cached
+    if proxy_cache.is_fresh(meta):
+        proxy_cache.hits += 1
+        proxy_cache.bytes_saved += len(payload)
+        return payload, meta, "HIT", None
+
+    conditional = {"If-None-Match": meta["etag"]}
+    if meta.get("last_modified"):
+        conditional["If-Modified-Since"] = meta["last_modified"]
+    try:
+        upstream = await _open_upstream(url, conditional)
+    except (httpx.HTTPError, HTTPException) as e:
+        if isinstance(e, HTTPException) and e.status_code < 500:
+            # Gone or forbidden at the origin; stop serving it
+            await proxy_cache.remove(url)
+            raise e
+        # The origin being down is no reason to fail a request we can answer
+        logger.warning(f"Revalidation failed for {url}, serving cached copy: {e}")
+        proxy_cache.stale_served += 1
+        proxy_cache.bytes_saved += len(payload)
+        return payload, meta, "STALE", None
+
+    if upstream.status_code == 304:
+        await upstream.aclose()
+        proxy_cache.revalidated += 1
+        proxy_cache.bytes_saved += len(payload)
+        meta = await proxy_cache.put(url, payload, meta)
+        return payload, meta, "REVALIDATED", None
+
+    proxy_cache.refreshed += 1
+    return None, None, "MISS", upstream
 
 
 @app.get("/api/proxy-image")
-async def proxy_image(url: str):
+async def proxy_image(
+    url: str,
+    request: Request,
+    w: int = None,
+    h: int = None,
+    fit: str = "inside",
+    q: int = None,
+):
     """
-    Proxy endpoint to fetch images from S3 or external URLs, bypassing CORS issues
+    Proxy endpoint to fetch images from S3 or external URLs, bypassing CORS issues.
+    The image is streamed through as it downloads; Range requests are forwarded.
+    Whole-object responses are cached on disk and revalidated with the origin.
+    With w/h/q a resized, re-encoded variant is returned instead (WebP when the
+    Accept header allows it); fit is "inside" (keep the whole image) or "cover"
+    (fill w x h, cropping the overflow).
     """
     try:
         # Validate URL format for security
@@ -1207,56 +3931,57 @@ async def proxy_image(url: str):
 
         logger.info(f"Proxying image request: {url}")
 
-        # Fetch image from URL
-        with urllib.request.urlopen(url) as response:
-            image_data = response.read()
-            content_type = response.headers.get("Content-Type", "image/jpeg")
+        if w is not None or h is not None or q is not None:
+            return await _proxy_variant(request, url, w, h, fit, q)
+
+        # Partial requests go straight to the origin
+        if "range" in request.headers:
+            upstream = await _open_upstream(
+                url,
+                {
+                    name: request.headers[name]
+                    for name in PROXY_FORWARD_REQUEST_HEADERS
+                    if name in request.headers
+                },
+            )
+            return _forwarded_response(upstream, _stream_upstream(upstream, PROXY_MAX_BYTES))
 
-        return Response(content=image_data, media_type=content_type)
+        payload, meta, source, upstream = await _lookup_proxied(url)
+        if payload is not None:
+            return _serve_cached(request, payload, meta, source)
 
-    except urllib.error.HTTPError as e:
-        logger.error(f"HTTP error fetching image: {e}")
-        raise HTTPException(
-            status_code=e.code, detail=f"Failed to fetch image: {e.reason}"
+        response = _forwarded_response(
+            upstream,
+            _stream_upstream(upstream, PROXY_MAX_BYTES, cache_url=url if upstream.status_code == 200 else None),
         )
+        response.headers["X-Cache"] = "MISS"
+        return response
+
+    except HTTPException as he:
+        raise he
+    except httpx.TimeoutException as e:
+        logger.error(f"Timed out fetching image: {e}")
+        raise HTTPException(status_code=504, detail="Timed out fetching image")
+    except httpx.HTTPError as e:
+        logger.error(f"Error fetching image: {e}")
+        raise HTTPException(status_code=502, detail=f"Failed to fetch image: {e}")
     except Exception as e:
         logger.error(f"Error proxying image: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-# adding the cinematic backend service
-@app.post("/api/cinematic-storyboard")
-async def cinematic_storyboard(
-    source_image: UploadFile = File(...),
-    scene_type: str = Form(""),
-    mood: str = Form(""),
-    custom_prompt: str = Form(""),
-):
-    """
-    Cinematic Storyboard endpoint - generates a 2x3 grid with 6 different camera angles
-    """
-    try:
-        logger.info(
-            f"Processing cinematic storyboard request. Image: {source_image.filename}, Scene: {scene_type}, Mood: {mood}"
-        )
-
-        # Read image
-        source_bytes = await source_image.read()
-        source_pil = Image.open(io.BytesIO(source_bytes))
-
-        # For a 2x3 grid, use 2:3 aspect ratio
-        aspect_ratio = "2:3"
 
-        logger.info(f"Using aspect ratio: {aspect_ratio} for 2x3 storyboard grid")
+# adding the cinematic backend service
+async def _cinematic_storyboard(source_bytes: bytes, scene_type: str, mood: str, custom_prompt: str, options: OutputOptions = None) -> Response:
+    options = options or OutputOptions()
+    (source,) = await prepare_uploads("cinematic-storyboard", source_bytes)
 
-        api_key = os.getenv("GOOGLE_API_KEY")
-        if not api_key:
-            logger.error("GOOGLE_API_KEY not set")
-            raise HTTPException(status_code=500, detail="GOOGLE_API_KEY not set")
+    # For a 2x3 grid, use 2:3 aspect ratio
+    aspect_ratio = "2:3"
 
-        client = genai.Client(api_key=api_key)
+    logger.info(f"Using aspect ratio: {aspect_ratio} for 2x3 storyboard grid")
 
-        # Build the prompt
-        base_prompt = """Cinematic Storyboard Task:
+    # Build the prompt
+    base_prompt = """Cinematic Storyboard Task:
 Analyze the uploaded photo and create a cinematic storyboard showing the same scene from 6 different camera angles.
 
 Requirements:
@@ -1276,131 +4001,97 @@ Requirements:
 8. Maintain visual continuity - it should feel like a real film storyboard.
 """
 
-        # Add optional customizations
-        if scene_type:
-            base_prompt += f"\n\nScene Type: {scene_type} - Adjust the cinematography and mood to match this genre but keep it realistic and professional unless mentioned specifically."
-        
-        if mood:
-            base_prompt += f"\n\nMood/Tone: {mood} - The lighting, colors, and composition should reflect this mood but keep it realistic and professional unless mentioned specifically."
-        
-        if custom_prompt:
-            base_prompt += f"\n\nAdditional Instructions: {custom_prompt}"
-
-        # Prepare the config (reusable for both models)
-        generate_config = types.GenerateContentConfig(
-            response_modalities=["IMAGE"],
-            image_config=types.ImageConfig(aspect_ratio=aspect_ratio),
-            safety_settings=[
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_HARASSMENT,
-                    threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-                ),
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-                    threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-                ),
-            ],
-        )
+    # Add optional customizations
+    if scene_type:
+        base_prompt += f"\n\nScene Type: {scene_type} - Adjust the cinematography and mood to match this genre but keep it realistic and professional unless mentioned specifically."
 
-        # Try primary model first, fallback to secondary on 429
-        response = None
-        model_used = "gemini-3-pro-image-preview"
-        
-        try:
-            logger.info("Sending request to Gemini API for Cinematic Storyboard (using gemini-3-pro-image-preview)...")
-            response = client.models.generate_content(
-                model="gemini-3-pro-image-preview",
-                contents=[source_pil, base_prompt],
-                config=generate_config,
-            )
-            logger.info("Received response from Gemini API (gemini-3-pro-image-preview)")
-        except Exception as e:
-            # Check if it's a 429 rate limit error
-            error_str = str(e).lower()
-            status_code = None
-            
-            # Try to extract status code from exception
-            if hasattr(e, 'status_code'):
-                status_code = e.status_code
-            elif hasattr(e, 'response') and hasattr(e.response, 'status_code'):
-                status_code = e.response.status_code
-            elif '429' in error_str or 'rate limit' in error_str or 'too many requests' in error_str:
-                status_code = 429
-            
-            if status_code == 429:
-                logger.warning("Rate limit (429) encountered with gemini-3-pro-image-preview, falling back to gemini-2.5-flash-image")
-                try:
-                    response = client.models.generate_content(
-                        model="gemini-2.5-flash-image",
-                        contents=[source_pil, base_prompt],
-                        config=generate_config,
-                    )
-                    model_used = "gemini-2.5-flash-image"
-                    logger.info("Received response from Gemini API (gemini-2.5-flash-image fallback)")
-                except Exception as fallback_error:
-                    logger.error(f"Fallback model also failed: {fallback_error}")
-                    raise HTTPException(
-                        status_code=503,
-                        detail="Service temporarily unavailable due to rate limits. Please try again later."
-                    )
-            else:
-                # Re-raise if it's not a 429 error
-                logger.error(f"Error calling Gemini API: {e}")
-                raise
+    if mood:
+        base_prompt += f"\n\nMood/Tone: {mood} - The lighting, colors, and composition should reflect this mood but keep it realistic and professional unless mentioned specifically."
 
-        if response is None:
-            logger.error("No response received from Gemini API")
-            raise HTTPException(
-                status_code=500,
-                detail="Failed to get response from image generation service."
-            )
+    if custom_prompt:
+        base_prompt += f"\n\nAdditional Instructions: {custom_prompt}"
+
+    # Prepare the config (reusable for both models)
+    generate_config = types.GenerateContentConfig(
+        response_modalities=["IMAGE"],
+        image_config=types.ImageConfig(aspect_ratio=aspect_ratio),
+        safety_settings=[
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_HARASSMENT,
+                threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+            ),
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+                threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+            ),
+        ],
+    )
+
+    # Primary model first; the router falls back (or skips straight to the
+    # fallback while its circuit breaker is open) on rate limits
+    response, model_used = await image_model_router.generate(
+        contents=[source.part(), base_prompt],
+        config=generate_config,
+        label="Cinematic Storyboard",
+    )
 
-        generated_image_bytes = None
+    generated_image_bytes = await watermarked_image_from_response(response, options)
 
+    if not generated_image_bytes:
+        text_response = ""
         if response.parts:
             for part in response.parts:
-                if part.inline_data:
-                    img = part.as_image()
+                if part.text:
+                    text_response += part.text
 
-                    # Save to a temporary file
-                    with tempfile.NamedTemporaryFile(
-                        suffix=".png", delete=False
-                    ) as tmp_file:
-                        tmp_path = tmp_file.name
+        logger.warning(f"No image generated. Text response: {text_response}")
 
-                    img.save(tmp_path)
+        if text_response:
+            raise HTTPException(
+                status_code=400, detail=f"Generation failed: {text_response}"
+            )
+        else:
+            raise HTTPException(
+                status_code=500,
+                detail="Failed to generate image. The model might have failed to process the request.",
+            )
 
-                    # Add watermark in-place
-                    add_watermark(tmp_path)
+    logger.info(f"Cinematic storyboard successful using {model_used}, returning image.")
+    return Response(content=generated_image_bytes, media_type=options.media_type)
 
-                    # Read back the watermarked image
-                    with open(tmp_path, "rb") as f:
-                        generated_image_bytes = f.read()
 
-                    os.remove(tmp_path)
-                    break
+def _cached_cinematic_storyboard(
+    source_bytes: bytes, scene_type: str, mood: str, custom_prompt: str, options: OutputOptions
+):
+    return cached_result(
+        "cinematic-storyboard",
+        [IMAGE_MODELS_KEY, options.cache_key(), scene_type, mood, custom_prompt, source_bytes],
+        lambda: _cinematic_storyboard(source_bytes, scene_type, mood, custom_prompt, options),
+    )
 
-        if not generated_image_bytes:
-            text_response = ""
-            if response.parts:
-                for part in response.parts:
-                    if part.text:
-                        text_response += part.text
 
-            logger.warning(f"No image generated. Text response: {text_response}")
+@app.post("/api/cinematic-storyboard")
+async def cinematic_storyboard(
+    source_image: UploadFile = File(...),
+    scene_type: str = Form(""),
+    mood: str = Form(""),
+    custom_prompt: str = Form(""),
+    options: OutputOptions = Depends(output_options("PNG")),
+):
+    """
+    Cinematic Storyboard endpoint - generates a 2x3 grid with 6 different camera angles
+    """
+    try:
+        logger.info(
+            f"Processing cinematic storyboard request. Image: {source_image.filename}, Scene: {scene_type}, Mood: {mood}"
+        )
 
-            if text_response:
-                raise HTTPException(
-                    status_code=400, detail=f"Generation failed: {text_response}"
-                )
-            else:
-                raise HTTPException(
-                    status_code=500,
-                    detail="Failed to generate image. The model might have failed to process the request.",
-                )
+        # Read image
+        source_bytes = await source_image.read()
 
-        logger.info(f"Cinematic storyboard successful using {model_used}, returning image.")
-        return Response(content=generated_image_bytes, media_type="image/png")
+        return await _cached_cinematic_storyboard(
+            source_bytes, scene_type, mood, custom_prompt, options
+        )
 
     except HTTPException as he:
         logger.error(f"HTTP Exception in cinematic storyboard: {he.detail}")
@@ -1409,6 +4100,435 @@ Requirements:
         logger.error(f"Unexpected error in cinematic storyboard: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+
+class JobStore:
+    """
+    SQLite-backed record of asynchronous jobs and their results. The database
+    file is shared by all uvicorn workers, so a job submitted to one worker can
+    be polled and fetched through any of them.
+    """
+
+    def __init__(self, path: str, result_ttl: float):
+        self.path = path
+        self.result_ttl = result_ttl
+        self._last_cleanup = 0.0
+        # Jobs are owned by this id rather than the pid, which a restarted
+        # container readily hands to a new worker. The instance holds an flock
+        # on instances/<id>.lock for its lifetime, so the kernel marks it dead.
+        self.instance_id = uuid.uuid4().hex
+        self._instances_dir = os.path.join(os.path.dirname(path), "job-instances")
+        self._instance_fd = None
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def init(self) -> None:
+        os.makedirs(self._instances_dir, exist_ok=True)
+        if self._instance_fd is None:
+            fd = os.open(self._instance_lock(self.instance_id), os.O_CREAT | os.O_RDWR, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            self._instance_fd = fd
+
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    tool TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    worker_pid INTEGER NOT NULL,
+                    owner TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    error_status INTEGER,
+                    error TEXT,
+                    media_type TEXT,
+                    headers TEXT,
+                    result BLOB
+                )
+                """
+            )
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "owner" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+
+            # Jobs owned by an instance that no longer exists will never finish
+            live = {
+                entry[: -len(".lock")]
+                for entry in os.listdir(self._instances_dir)
+                if entry.endswith(".lock") and self._instance_alive(entry[: -len(".lock")])
+            }
+            orphaned = [
+                row["id"]
+                for row in conn.execute(
+                    "SELECT id, owner FROM jobs WHERE status IN ('queued', 'running')"
+                )
+                if row["owner"] not in live
+            ]
+            conn.executemany(
+                "UPDATE jobs SET status = 'failed', error_status = 500, "
+                "error = 'Job was interrupted by a server restart', finished_at = ? WHERE id = ?",
+                [(time.time(), job_id) for job_id in orphaned],
+            )
+
+    def create(self, job_id: str, tool: str, user_id: str) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, tool, user_id, status, worker_pid, owner, created_at) "
+                "VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                (job_id, tool, user_id, os.getpid(), self.instance_id, time.time()),
+            )
+        if time.monotonic() - self._last_cleanup > 300:
+            self.cleanup()
+
+    def mark_running(self, job_id: str) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?",
+                (time.time(), job_id),
+            )
+
+    def succeed(self, job_id: str, payload: bytes, media_type: str, headers: dict) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'succeeded', finished_at = ?, media_type = ?, "
+                "headers = ?, result = ? WHERE id = ?",
+                (time.time(), media_type, json.dumps(headers), payload, job_id),
+            )
+
+    def fail(self, job_id: str, status_code: int, error: str) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', finished_at = ?, error_status = ?, "
+                "error = ? WHERE id = ?",
+                (time.time(), status_code, error, job_id),
+            )
+
+    def get(self, job_id: str, with_result: bool = False):
+        columns = "*" if with_result else (
+            "id, tool, user_id, status, created_at, started_at, finished_at, error_status, error"
+        )
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT {columns} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def _instance_lock(self, instance_id: str) -> str:
+        return os.path.join(self._instances_dir, f"{instance_id}.lock")
+
+    def _instance_alive(self, instance_id: str) -> bool:
+        """
+        Whether the instance's lock is still held; a dead instance's lock file
+        is removed
+        """
+        if instance_id == self.instance_id:
+            return True
+        try:
+            fd = os.open(self._instance_lock(instance_id), os.O_RDWR)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        else:
+            try:
+                os.remove(self._instance_lock(instance_id))
+            except FileNotFoundError:
+                pass
+            return False
+        finally:
+            os.close(fd)
+
+    def cleanup(self) -> None:
+        self._last_cleanup = time.monotonic()
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?",
+                (time.time() - self.result_ttl,),
+            )
+
+
+class JobRunner:
+    """
+    Runs submitted jobs as background tasks in this worker, at most
+    tool_limits[tool] at a time per tool, and records the outcome in the
+    JobStore. Jobs keep running when the submitting client disconnects.
+    """
+
+    def __init__(self, store: JobStore, queue_depth: int, tool_limits: dict, default_limit: int):
+        self.store = store
+        self.queue_depth = queue_depth
+        self.tool_limits = tool_limits
+        self.default_limit = default_limit
+        self._semaphores = {}
+        self._tasks = set()
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def has_capacity(self) -> bool:
+        return len(self._tasks) < self.queue_depth
+
+    def start(self, job_id: str, tool: str, run) -> None:
+        task = asyncio.ensure_future(self._execute(job_id, tool, run))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, job_id: str, tool: str, run) -> None:
+        if tool not in self._semaphores:
+            self._semaphores[tool] = asyncio.Semaphore(
+                self.tool_limits.get(tool, self.default_limit)
+            )
+
+        async with self._semaphores[tool]:
+            self.running += 1
+            # The job's own stage timings, served with its result
+            timings = []
+            _request_timings.set(timings)
+            started = time.perf_counter()
+            try:
+                await asyncio.to_thread(self.store.mark_running, job_id)
+                logger.info(f"Running {tool} job {job_id}")
+                response = await run()
+                headers = {
+                    name: value
+                    for name, value in response.headers.items()
+                    if name not in ("content-length", "content-type")
+                }
+                headers["server-timing"] = server_timing(timings, time.perf_counter() - started)
+                await asyncio.to_thread(
+                    self.store.succeed, job_id, response.body, response.media_type, headers
+                )
+                self.completed += 1
+                logger.info(f"{tool} job {job_id} succeeded")
+            except Exception as e:
+                self.failed += 1
+                if isinstance(e, HTTPException):
+                    status_code, error = e.status_code, str(e.detail)
+                elif isinstance(e, PoolSaturatedError):
+                    status_code, error = 503, str(e)
+                else:
+                    status_code, error = 500, str(e)
+                logger.error(f"{tool} job {job_id} failed: {error}")
+                await asyncio.to_thread(self.store.fail, job_id, status_code, error)
+            finally:
+                self.running -= 1
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "pending": len(self._tasks),
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
+
+
+job_store = JobStore(
+    path=os.path.join(CACHE_ROOT, "jobs.sqlite3"),
+    result_ttl=float(os.getenv("JOB_RESULT_TTL", "3600")),
+)
+
+job_runner = JobRunner(
+    job_store,
+    queue_depth=int(os.getenv("JOB_QUEUE_DEPTH", "20")),
+    tool_limits=_parse_limits(os.getenv("JOB_TOOL_CONCURRENCY", "")),
+    default_limit=int(os.getenv("JOB_DEFAULT_CONCURRENCY", "2")),
+)
+
+# Longest a status request may long-poll before answering
+JOB_MAX_WAIT = float(os.getenv("JOB_MAX_WAIT", "60"))
+
+
+def _job_virtual_try_on(files: dict, fields: dict, options: OutputOptions):
+    return lambda: _cached_virtual_try_on(files["person_image"], files["garment_image"], options)
+
+
+def _job_hand_drawn_portrait(files: dict, fields: dict, options: OutputOptions):
+    return lambda: _cached_hand_drawn_portrait(files["file"], options)
+
+
+def _job_face_swap(files: dict, fields: dict, options: OutputOptions):
+    return lambda: _cached_face_swap(files["source_image"], files["target_image"], options)
+
+
+def _job_celebrity_selfie(files: dict, fields: dict, options: OutputOptions):
+    return lambda: _cached_celebrity_selfie(
+        files["source_image"], files["target_image"], fields["custom_prompt"], options
+    )
+
+
+def _job_hairstyle_grid(files: dict, fields: dict, options: OutputOptions):
+    return lambda: _cached_hairstyle_grid(files["source_image"], options)
+
+
+def _job_cinematic_storyboard(files: dict, fields: dict, options: OutputOptions):
+    return lambda: _cached_cinematic_storyboard(
+        files["source_image"], fields["scene_type"], fields["mood"], fields["custom_prompt"], options
+    )
+
+
+def _job_podcast_creator(files: dict, fields: dict, options: OutputOptions):
+    request = PodcastRequest(topic=fields["topic"], language=fields["language"] or "en-US")
+    audio_format = negotiate_audio_format(fields["format"], None)
+    return lambda: _cached_podcast_creator(request, audio_format)
+
+
+# tool -> (upload field names, form fields with defaults (None = required),
+# prepare). prepare(files, fields, options) runs at submission, raising an
+# HTTPException for invalid input, and returns the job's coroutine function.
+JOB_TOOLS = {
+    "virtual-try-on": (["person_image", "garment_image"], {}, _job_virtual_try_on),
+    "hand-drawn-portrait": (["file"], {}, _job_hand_drawn_portrait),
+    "face-swap": (["source_image", "target_image"], {}, _job_face_swap),
+    "celebrity-selfie": (
+        ["source_image", "target_image"],
+        {"custom_prompt": ""},
+        _job_celebrity_selfie,
+    ),
+    "hairstyle-grid": (["source_image"], {}, _job_hairstyle_grid),
+    "cinematic-storyboard": (
+        ["source_image"],
+        {"scene_type": "", "mood": "", "custom_prompt": ""},
+        _job_cinematic_storyboard,
+    ),
+    "podcast-creator": (
+        [],
+        {"topic": None, "language": "en-US", "format": ""},
+        _job_podcast_creator,
+    ),
+}
+
+# Tools whose image output defaults to something other than PNG
+JOB_OUTPUT_FORMATS = {"face-swap": "JPEG"}
+
+
+def _job_status(job: dict) -> dict:
+    status = {
+        "job_id": job["id"],
+        "tool": job["tool"],
+        "status": job["status"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+    }
+    if job["status"] == "succeeded":
+        status["result_url"] = f"/api/jobs/{job['id']}/result"
+    if job["status"] == "failed":
+        status["error"] = job["error"]
+    return status
+
+
+async def _get_user_job(job_id: str, request: Request, with_result: bool = False) -> dict:
+    job = await asyncio.to_thread(job_store.get, job_id, with_result)
+    # Other users' jobs are reported as missing rather than forbidden
+    if job is None or job["user_id"] != request.headers.get("X-User-ID"):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.post("/api/jobs/{tool}", status_code=202)
+async def submit_job(tool: str, request: Request):
+    """
+    Queue a long-running generation and return immediately with a job id.
+    Takes the same multipart fields and output query parameters as the
+    tool's synchronous endpoint (podcast-creator takes topic, language and
+    format as form fields).
+    """
+    if tool not in JOB_TOOLS:
+        raise HTTPException(status_code=404, detail=f"Unknown tool: {tool}")
+
+    # Reject bad output options now rather than when the job runs
+    options = OutputOptions.parse(request.query_params, JOB_OUTPUT_FORMATS.get(tool, "PNG"))
+
+    if not job_runner.has_capacity():
+        job_runner.rejected += 1
+        logger.warning(f"Rejected {tool} job - job queue is full")
+        raise HTTPException(
+            status_code=503,
+            detail="Job queue is full. Please try again shortly.",
+            headers={"Retry-After": "10"},
+        )
+
+    file_names, field_defaults, prepare = JOB_TOOLS[tool]
+    form = await request.form()
+
+    files = {}
+    for name in file_names:
+        upload = form.get(name)
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=422, detail=f"Missing file field: {name}")
+        files[name] = await upload.read()
+
+    fields = {}
+    for name, default in field_defaults.items():
+        value = form.get(name, default)
+        if value is None:
+            raise HTTPException(status_code=422, detail=f"Missing form field: {name}")
+        fields[name] = value
+
+    # Invalid fields are rejected here, before the job gets an id
+    run = prepare(files, fields, options)
+
+    job_id = uuid.uuid4().hex
+    await asyncio.to_thread(job_store.create, job_id, tool, request.headers.get("X-User-ID"))
+    job_runner.start(job_id, tool, run)
+    logger.info(f"Queued {tool} job {job_id}")
+
+    return {
+        "job_id": job_id,
+        "tool": tool,
+        "status": "queued",
+        "status_url": f"/api/jobs/{job_id}",
+        "result_url": f"/api/jobs/{job_id}/result",
+    }
+
+
+@app.get("/api/jobs/{job_id}")
+async def job_status(job_id: str, request: Request, wait: float = 0):
+    """
+    Job status; with wait > 0 the request long-polls until the job finishes
+    or wait seconds (capped at JOB_MAX_WAIT) pass
+    """
+    job = await _get_user_job(job_id, request)
+    deadline = time.monotonic() + min(max(wait, 0), JOB_MAX_WAIT)
+    while job["status"] in ("queued", "running") and time.monotonic() < deadline:
+        await asyncio.sleep(0.5)
+        job = await _get_user_job(job_id, request)
+    return _job_status(job)
+
+
+@app.get("/api/jobs/{job_id}/result")
+async def job_result(job_id: str, request: Request):
+    """
+    The finished job's output, exactly as the synchronous endpoint returns it
+    """
+    job = await _get_user_job(job_id, request, with_result=True)
+
+    if job["status"] == "failed":
+        raise HTTPException(status_code=job["error_status"] or 500, detail=job["error"])
+    if job["status"] != "succeeded":
+        return JSONResponse(status_code=409, content=_job_status(job))
+
+    return Response(
+        content=job["result"],
+        media_type=job["media_type"],
+        headers=json.loads(job["headers"] or "{}"),
+    )
+
+
 if __name__ == "__main__":
     import uvicorn
 